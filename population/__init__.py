@@ -0,0 +1 @@
+"""Shared code for the scripts updating the French population (P1082) on Wikidata."""
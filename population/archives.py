@@ -0,0 +1,109 @@
+import csv
+import io
+import os
+import posixpath
+import re
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+SPREADSHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+CELL_REFERENCE = re.compile(r'([A-Z]+)')
+
+
+def _column_index(reference):
+    """'C12' -> 2"""
+    index = 0
+    for letter in CELL_REFERENCE.match(reference).group(1):
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def _shared_strings(workbook):
+    if 'xl/sharedStrings.xml' not in workbook.namelist():
+        return []
+    strings = []
+    with workbook.open('xl/sharedStrings.xml') as xml_file:
+        for _, element in iterparse(xml_file):
+            if element.tag == SPREADSHEET_NS + 'si':
+                # Rich text strings are split in several runs
+                strings.append(''.join(text.text or '' for text in element.iter(SPREADSHEET_NS + 't')))
+                element.clear()
+    return strings
+
+
+def _sheet_paths(workbook):
+    """[(sheet name, path of its XML in the workbook)] in the order of the workbook."""
+    with workbook.open('xl/_rels/workbook.xml.rels') as xml_file:
+        targets = {}
+        for _, element in iterparse(xml_file):
+            if element.tag == PACKAGE_RELATIONSHIP_NS + 'Relationship':
+                target = element.get('Target')
+                targets[element.get('Id')] = target.lstrip('/') if target.startswith('/') else posixpath.join('xl', target)
+    with workbook.open('xl/workbook.xml') as xml_file:
+        return [(element.get('name'), targets[element.get(RELATIONSHIP_NS + 'id')]) for _, element in iterparse(xml_file) if element.tag == SPREADSHEET_NS + 'sheet']
+
+
+def _cell_value(cell, strings):
+    cell_type = cell.get('t')
+    if cell_type == 'inlineStr':
+        return ''.join(text.text or '' for text in cell.iter(SPREADSHEET_NS + 't'))
+    value = cell.find(SPREADSHEET_NS + 'v')
+    if value is None or value.text is None:
+        return ''
+    if cell_type == 's':
+        return strings[int(value.text)]
+    if cell_type in (None, 'n') and value.text.endswith('.0'):
+        return value.text[:-2]  # Whole numbers written as floats
+    return value.text
+
+
+def _sheet_rows(workbook, path, strings):
+    """Yield the rows of a sheet as lists of strings, the XML is parsed as it is read and each row freed once yielded."""
+    with workbook.open(path) as xml_file:
+        for _, element in iterparse(xml_file):
+            if element.tag != SPREADSHEET_NS + 'row':
+                continue
+            row = []
+            for cell in element.iter(SPREADSHEET_NS + 'c'):
+                reference = cell.get('r')
+                if reference:
+                    # Empty cells are not written, keep the columns in place
+                    row.extend([''] * (_column_index(reference) - len(row)))
+                row.append(_cell_value(cell, strings))
+            element.clear()
+            yield row
+
+
+def iter_xlsx_tables(xlsx_file):
+    """Yield (sheet name, rows) for each sheet of an xlsx workbook, a path or a seekable file, rows must be read before the next sheet."""
+    with zipfile.ZipFile(xlsx_file) as workbook:
+        strings = _shared_strings(workbook)
+        for name, path in _sheet_paths(workbook):
+            yield name, _sheet_rows(workbook, path, strings)
+
+
+def iter_archive_tables(path):
+    """Yield (name, rows, positional) for each table of an INSEE archive: the CSV files of a zip, the sheets of the xlsx workbooks in it or of an xlsx file.
+
+    name is the file name of a CSV, the sheet name of a workbook. Nothing is extracted to disk. positional is whether the historical column
+    positions of the CSV files apply when the header is not found.
+    """
+    if path.lower().endswith('.xlsx'):
+        for name, rows in iter_xlsx_tables(path):
+            yield name, rows, False
+        return
+
+    with zipfile.ZipFile(path) as archive:
+        for member in archive.infolist():
+            extension = os.path.splitext(member.filename)[1].lower()
+            if extension == '.csv':
+                with archive.open(member) as member_file:
+                    # utf-8-sig: a byte order mark would hide the first header name
+                    yield posixpath.basename(member.filename), csv.reader(io.TextIOWrapper(member_file, encoding='utf-8-sig', newline=''), delimiter=';'), True
+            elif extension == '.xlsx':
+                with archive.open(member) as member_file:
+                    for name, rows in iter_xlsx_tables(member_file):
+                        yield name, rows, False
@@ -0,0 +1,238 @@
+import argparse
+import bz2
+import gzip
+import os
+import shutil
+import subprocess
+import time
+from collections import deque
+from multiprocessing import Pool
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    import json
+
+    loads = json.loads
+
+from population.levels import LEVEL_SCRIPTS, load_levels
+from population.snapshots import SnapshotStore, snapshot_key
+from population.state import PopulationState
+from population.validity import wikibase_date
+
+# Snapshot kind of the states saved by ingest, changed with the way they are stored
+DUMP_KIND = 'dump-compact'
+
+# Parallel decompressors first, reading their output through a pipe also moves the decompression out of the Python process
+DECOMPRESSORS = {
+    '.gz': ['pigz', 'gzip'],
+    '.bz2': ['lbzip2', 'pbzip2', 'bzip2'],
+}
+
+
+def iter_dump_lines(path):
+    """Yield the lines of a Wikidata JSON dump, compressed (.gz, .bz2) or not, without loading it in memory."""
+    extension = os.path.splitext(path)[1]
+    for command in DECOMPRESSORS.get(extension, []):
+        if shutil.which(command):
+            process = subprocess.Popen([command, '-dc', path], stdout=subprocess.PIPE, bufsize=1 << 20)
+            try:
+                yield from process.stdout
+            finally:
+                process.stdout.close()
+                process.wait()
+            return
+
+    if extension == '.gz':
+        dump_file = gzip.open(path, 'rb')
+    elif extension == '.bz2':
+        dump_file = bz2.open(path, 'rb')
+    else:
+        dump_file = open(path, 'rb')
+    with dump_file:
+        yield from dump_file
+
+
+def level_spec(level):
+    """Picklable description of what an item needs to belong to a level: (name, type, [(property, item)], code property)."""
+    level_type = None
+    filters = []
+    for claim in level.base_filter:
+        value = (claim.mainsnak.datavalue or {}).get('value')
+        if claim.mainsnak.property_number == 'P31':
+            level_type = value['id']
+        elif value:
+            filters.append((claim.mainsnak.property_number, value['id']))
+    return level.name, level_type, filters, level.insee_property
+
+
+def _statements(entity, prop):
+    return [statement for statement in entity.get('claims', {}).get(prop, []) if statement.get('rank') != 'deprecated']
+
+
+def _value(snak):
+    if snak.get('snaktype') != 'value':
+        return None
+    return snak['datavalue']['value']
+
+
+def _item_id(snak):
+    value = _value(snak)
+    return value.get('id') if isinstance(value, dict) else None
+
+
+def _first_qualifier(statement, prop):
+    for snak in statement.get('qualifiers', {}).get(prop, []):
+        return _value(snak)
+    return None
+
+
+def _qualifiers(statement, prop):
+    """Values of the prop qualifiers of statement, [None] without any like the unbound OPTIONAL of a query."""
+    return [_value(snak) for snak in statement.get('qualifiers', {}).get(prop, [])] or [None]
+
+
+def _date(time_value):
+    """'+2020-00-00T00:00:00Z' -> '2020-01-01', the format of population.insee_index"""
+    if not time_value:
+        return None
+    return wikibase_date(time_value['time'], time_value.get('precision', 11))
+
+
+def _fingerprints(entity):
+    """One fingerprint per point in time, method and stated in of each P1082 statement, like the rows of population.extract.build_population_query."""
+    fingerprints = set()
+    for statement in entity.get('claims', {}).get('P1082', []):
+        amount = _value(statement['mainsnak'])
+        stated_in = [_item_id(snak) for reference in statement.get('references', []) for snak in reference.get('snaks', {}).get('P248', [])] or [None]
+        for point_in_time in _qualifiers(statement, 'P585'):
+            for method in _qualifiers(statement, 'P459'):
+                for reference in stated_in:
+                    fingerprints.add((amount['amount'] if amount else None, point_in_time['time'] if point_in_time else None, method['id'] if method else None,
+                                      reference, statement.get('rank')))
+    return fingerprints
+
+
+def _match(entity, spec):
+    name, level_type, filters, code_property = spec
+
+    types = [statement for statement in _statements(entity, 'P31') if _item_id(statement['mainsnak']) == level_type]
+    if not types:
+        return None
+    for prop, value in filters:
+        if not any(_item_id(statement['mainsnak']) == value for statement in _statements(entity, prop)):
+            return None
+
+    codes = [(_value(statement['mainsnak']), _date(_first_qualifier(statement, 'P580')), _date(_first_qualifier(statement, 'P582')))
+             for statement in _statements(entity, code_property) if _value(statement['mainsnak'])]
+    if not codes:
+        return None
+
+    periods = [(_date(_first_qualifier(statement, 'P580')), _date(_first_qualifier(statement, 'P582'))) for statement in types]
+    dissolved = [_date(_value(statement['mainsnak'])) for statement in _statements(entity, 'P576') if _value(statement['mainsnak'])]
+    return name, entity['id'], codes, periods, dissolved, _fingerprints(entity)
+
+
+_specs = []
+
+
+def _init_worker(specs):
+    global _specs
+    _specs = specs
+
+
+def _parse_lines(lines):
+    results = []
+    for line in lines:
+        entity = loads(line)
+        for spec in _specs:
+            result = _match(entity, spec)
+            if result:
+                results.append(result)
+    return results
+
+
+def _candidate_lines(lines, specs):
+    """Strip the array syntax of the dump and drop the lines that cannot match any level without parsing them."""
+    code_markers = [f'"{spec[3]}"'.encode() for spec in specs]
+    type_markers = [f'"{spec[1]}"'.encode() for spec in specs]
+    for line in lines:
+        line = line.rstrip(b',\r\n')
+        if len(line) < 2:  # '[' and ']' lines
+            continue
+        if any(marker in line for marker in code_markers) and any(marker in line for marker in type_markers):
+            yield line
+
+
+def _batches(lines, size):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ingest(path, levels, workers=None, batch_size=1000, subset=None):
+    """Read a dump once and return a PopulationState per level name.
+
+    Lines are parsed by a pool of workers, at most two batches per worker are waiting at any time so the memory stays bounded.
+    subset, when given, receives the lines kept by the cheap pre-filter, to run again on a much smaller file.
+    """
+    specs = [level_spec(level) for level in levels]
+    states = {spec[0]: PopulationState() for spec in specs}
+    workers = workers or os.cpu_count() or 1
+
+    def collect(results):
+        for name, item, codes, periods, dissolved, fingerprints in results:
+            states[name].index.add_candidate(item, codes, periods, dissolved)
+            states[name].claims.add(item, fingerprints)
+
+    subset_file = gzip.open(subset, 'wb') if subset else None
+    try:
+        with Pool(workers, initializer=_init_worker, initargs=(specs,)) as pool:
+            pending = deque()
+            for batch in _batches(_candidate_lines(iter_dump_lines(path), specs), batch_size):
+                if subset_file:
+                    subset_file.writelines(line + b'\n' for line in batch)
+                pending.append(pool.apply_async(_parse_lines, (batch,)))
+                if len(pending) >= workers * 2:
+                    collect(pending.popleft().get())
+            while pending:
+                collect(pending.popleft().get())
+    finally:
+        if subset_file:
+            subset_file.close()
+
+    return states
+
+
+def load_dump_state(level, snapshots):
+    """State of level saved by the last ingestion, whatever its age: a dump is as old as it is."""
+    return snapshots.load(snapshot_key(level.base_filter, kind=DUMP_KIND), max_age=float('inf'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the population state of the levels from a Wikidata JSON dump.')
+    parser.add_argument('dump', help='latest-all.json.gz, latest-all.json.bz2 or a subset with one entity per line')
+    parser.add_argument('--levels', nargs='+', choices=list(LEVEL_SCRIPTS), help='levels to extract, all by default')
+    parser.add_argument('--workers', type=int, help='parsing processes, one per CPU by default')
+    parser.add_argument('--subset', help='also write the entities that may match to this .json.gz file')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    selected_levels = load_levels(args.levels)
+    level_states = ingest(args.dump, selected_levels, workers=args.workers, subset=args.subset)
+
+    store = SnapshotStore()
+    for selected_level in selected_levels:
+        state = level_states[selected_level.name]
+        print(f'{selected_level.name}: {len(state.index.by_code)} codes, {len(state.index.items)} items, {len(state.claims)} population claims')
+        store.save(snapshot_key(selected_level.base_filter, kind=DUMP_KIND), state)
+    store.close()
+
+    print("--- %s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,246 @@
+import argparse
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from population.insee_index import base_filter_patterns, build_query, state_key, state_types
+from population.levels import LEVEL_SCRIPTS, load_level
+from population.metrics import metrics
+from population.snapshots import SnapshotStore
+from population.sparql import entity_id, keyset_pages
+from population.state import PopulationState
+from population.validity import wikibase_date
+
+# Snapshot kinds of the state built by extract_state and of the progress of an extraction not finished yet
+STATE_KIND = 'sparql'
+PROGRESS_KIND = 'sparql-progress'
+SHARD_KIND = 'sparql-shard'
+
+# The levels coded by commune (P374) are read in one shard per département, by the prefix of the code
+SHARDED_PROPERTIES = {'P374'}
+DEPARTEMENT_PREFIXES = [f'{number:02d}' for number in range(1, 96) if number != 20] + ['2A', '2B'] + [str(number) for number in range(971, 977)]
+
+RANKS = {
+    'http://wikiba.se/ontology#PreferredRank': 'preferred',
+    'http://wikiba.se/ontology#NormalRank': 'normal',
+    'http://wikiba.se/ontology#DeprecatedRank': 'deprecated'
+}
+
+
+def build_population_query(level, code_prefix=None):
+    """Query listing only what the lookups compare of the P1082 statements of the level items: amount, point in time, method, stated in and rank.
+
+    With code_prefix, only the items having an INSEE code starting with it, the same items as build_query with this prefix.
+    """
+    _, filters = base_filter_patterns(level)
+    types = ' '.join(f'wd:{level_type}' for level_type in state_types(level))
+    if code_prefix:
+        code_pattern = f'?item p:{level.insee_property}/ps:{level.insee_property} ?code. FILTER(STRSTARTS(?code, "{code_prefix}"))'
+    else:
+        code_pattern = f'?item wdt:{level.insee_property} [].'
+    return f'''
+SELECT ?item ?statement ?amount ?pointInTime ?method ?statedIn ?rank WHERE {{
+  VALUES ?type {{ {types} }}
+  ?item wdt:P31 ?type.
+  {filters}
+  {code_pattern}
+  {{cursor}}
+  ?item p:P1082 ?statement.
+  ?statement ps:P1082 ?amount;
+             wikibase:rank ?rank.
+  OPTIONAL {{ ?statement pq:P585 ?pointInTime. }}
+  OPTIONAL {{ ?statement pq:P459 ?method. }}
+  OPTIONAL {{ ?statement prov:wasDerivedFrom/pr:P248 ?statedIn. }}
+}}'''
+
+
+def _fingerprint(binding):
+    """Same tuple as population.dump gives for a statement, see population.state.population_fingerprint."""
+    point_in_time = binding.get('pointInTime', {}).get('value')
+    # An unknown point in time is a blank node, like a statement without one for population.dump
+    if wikibase_date(point_in_time) is None:
+        point_in_time = None
+    return (binding['amount']['value'], point_in_time, entity_id(binding['method']) if 'method' in binding else None,
+            entity_id(binding['statedIn']) if 'statedIn' in binding else None, RANKS.get(binding['rank']['value']))
+
+
+def _add_index(index, bindings):
+    for binding in bindings:
+        index.add(binding)
+
+
+def _add_claims(claims, bindings):
+    """Add the P1082 statements of a page, the rows of an item are all in the same page."""
+    by_item = {}
+    for binding in bindings:
+        by_item.setdefault(entity_id(binding['item']), set()).add(_fingerprint(binding))
+    for item, fingerprints in by_item.items():
+        claims.add(item, fingerprints)
+
+
+def _progress_key(level, code_prefix=None):
+    return state_key(level, f'{PROGRESS_KIND}:{code_prefix}' if code_prefix else PROGRESS_KIND)
+
+
+def extract_state(level, snapshots, page_size=10000, code_prefix=None):
+    """Build the PopulationState of a level with two keyset-paginated queries, the INSEE index then the P1082 statements.
+
+    The state read so far and the cursor are saved after each page: an extraction stopped by a timeout starts again at the page that failed.
+    code_prefix restricts the extraction to the items whose INSEE code starts with it.
+    """
+    name = f'{level.name} {code_prefix}' if code_prefix else level.name
+    progress_key = _progress_key(level, code_prefix)
+    progress = snapshots.load(progress_key)
+    if progress is None:
+        progress = {'phase': 'index', 'cursor': None, 'pages': 0, 'state': PopulationState()}
+    else:
+        print(f"Resuming the {progress['phase']} extraction of {name} after {progress['cursor']} ({progress['pages']} pages read)")
+    state = progress['state']
+
+    phases = [('index', build_query(level, code_prefix), lambda bindings: _add_index(state.index, bindings)),
+              ('claims', build_population_query(level, code_prefix), lambda bindings: _add_claims(state.claims, bindings))]
+    for phase, query, add in phases:
+        if phase != progress['phase']:
+            continue
+        for bindings, cursor in metrics.timed_iter(keyset_pages(query, page_size=page_size, cursor=progress['cursor']), 'extract_page'):
+            add(bindings)
+            progress['pages'] += 1
+            progress['cursor'] = cursor
+            if cursor is not None:
+                snapshots.save(progress_key, progress)
+            logging.debug('%s %s page %d read, next after %s', name, phase, progress['pages'], cursor)
+        if phase == 'index':
+            progress.update(phase='claims', cursor=None)
+            snapshots.save(progress_key, progress)
+
+    snapshots.invalidate(progress_key)
+    logging.info('%s: %d items, %d population claims extracted in %d pages', name, len(state.index.items), len(state.claims), progress['pages'])
+    return state
+
+
+class CircuitBreaker:
+    """Stop sending queries after threshold failures in a row, until cooldown seconds have passed; then one query is tried again."""
+
+    def __init__(self, threshold=3, cooldown=300):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened < self.cooldown:
+                return False
+            # Half open: the next failure opens it again at once
+            self.opened = None
+            self.failures = self.threshold - 1
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened is None:
+                logging.warning('%d shard extractions failed in a row, using the last good shard snapshots for %d seconds', self.failures, self.cooldown)
+                self.opened = time.time()
+
+
+def _load_shard(level, path, code_prefix, breaker, refresh):
+    """(state, outcome) of one shard: its recent snapshot, a new extraction or, when the extraction fails or the breaker is open, its last good snapshot."""
+    # SQLite connections are not shared between threads
+    snapshots = SnapshotStore(path)
+    key = state_key(level, f'{SHARD_KIND}:{code_prefix}')
+    try:
+        if refresh:
+            snapshots.invalidate(_progress_key(level, code_prefix))
+        else:
+            state = snapshots.load(key)
+            if state is not None:
+                return state, 'cached'
+
+        if breaker.allow():
+            try:
+                state = extract_state(level, snapshots, code_prefix=code_prefix)
+            except Exception as e:
+                breaker.failure()
+                logging.warning('Extraction of %s %s failed: %s', level.name, code_prefix, e)
+            else:
+                breaker.success()
+                snapshots.save(key, state)
+                return state, 'extracted'
+
+        state = snapshots.load(key, max_age=float('inf'))
+        if state is None:
+            raise RuntimeError(f'Unable to extract {level.name} {code_prefix} and no snapshot of it to fall back to')
+        return state, 'fallback'
+    finally:
+        snapshots.close()
+
+
+def extract_sharded(level, snapshots, refresh=False, workers=None):
+    """State of a level extracted in one shard per département, shard_workers (default 4) at a time, each shard kept in its own snapshot.
+
+    Return (state, complete), complete is False when a shard came from an old snapshot.
+    """
+    breaker = CircuitBreaker(getattr(config, 'shard_failures', 3), getattr(config, 'shard_cooldown', 300))
+    state = PopulationState()
+    outcomes = {}
+    with ThreadPoolExecutor(max_workers=workers or getattr(config, 'shard_workers', 4)) as executor:
+        shards = [executor.submit(_load_shard, level, snapshots.path, code_prefix, breaker, refresh) for code_prefix in DEPARTEMENT_PREFIXES]
+        for shard in shards:
+            shard_state, outcome = shard.result()
+            state.index.merge(shard_state.index)
+            state.claims.merge(shard_state.claims)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            metrics.count('shards', outcome=outcome)
+    print(f"{level.name}: {len(state.index.items)} items, {len(state.claims)} population claims from {len(shards)} shards "
+          f"({', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items()))})")
+    return state, 'fallback' not in outcomes
+
+
+def load_sparql_state(level, snapshots, refresh=False):
+    """State of the level from its snapshot, extracted again when there is none, it is too old or refresh is set."""
+    key = state_key(level, STATE_KIND)
+    if refresh:
+        snapshots.invalidate(key)
+        snapshots.invalidate(_progress_key(level))
+
+    with metrics.time('snapshot_load'):
+        state = snapshots.load(key)
+    if state is not None:
+        print('Population state loaded from snapshot')
+        return state
+
+    if level.insee_property in SHARDED_PROPERTIES:
+        state, complete = extract_sharded(level, snapshots, refresh=refresh)
+        if not complete:
+            # Not kept as a whole, the failed shards are tried again by the next run
+            return state
+    else:
+        state = extract_state(level, snapshots)
+        print(f'{level.name}: {len(state.index.items)} items, {len(state.claims)} population claims extracted')
+    snapshots.save(key, state)
+    return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the items and P1082 claims of levels from the SPARQL endpoint, resuming an interrupted extraction.')
+    parser.add_argument('--levels', nargs='+', choices=list(LEVEL_SCRIPTS), help='levels to extract, all by default')
+    parser.add_argument('--refresh', action='store_true', help='extract again even when the snapshot is recent enough')
+    args = parser.parse_args()
+
+    store = SnapshotStore()
+    try:
+        for name in args.levels or list(LEVEL_SCRIPTS):
+            load_sparql_state(load_level(name), store, refresh=args.refresh)
+    finally:
+        store.close()
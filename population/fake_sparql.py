@@ -0,0 +1,818 @@
+"""A small in-memory SPARQL engine answering the queries of these scripts from Wikibase entity JSON.
+
+It knows the Wikidata RDF mapping of statements (wdt:, p:, ps:, pq:, psv:, pqv:, prov:wasDerivedFrom, pr:, wikibase:rank) and a subset of
+SPARQL: PREFIX, SELECT [DISTINCT] with variables or *, triple patterns with ';' and ',', [] property lists, sequence paths (a/b), OPTIONAL, UNION, MINUS, VALUES,
+BIND, FILTER with the usual operators and string functions, ORDER BY, LIMIT and OFFSET. SERVICE blocks (the label service) are ignored.
+Other property paths, aggregates and sub-queries are not supported and raise SparqlError.
+"""
+import hashlib
+import re
+from decimal import Decimal, InvalidOperation
+
+PREFIXES = {
+    'wd': 'http://www.wikidata.org/entity/',
+    'wds': 'http://www.wikidata.org/entity/statement/',
+    'wdv': 'http://www.wikidata.org/value/',
+    'wdref': 'http://www.wikidata.org/reference/',
+    'wdt': 'http://www.wikidata.org/prop/direct/',
+    'p': 'http://www.wikidata.org/prop/',
+    'ps': 'http://www.wikidata.org/prop/statement/',
+    'psv': 'http://www.wikidata.org/prop/statement/value/',
+    'pq': 'http://www.wikidata.org/prop/qualifier/',
+    'pqv': 'http://www.wikidata.org/prop/qualifier/value/',
+    'pr': 'http://www.wikidata.org/prop/reference/',
+    'prv': 'http://www.wikidata.org/prop/reference/value/',
+    'wikibase': 'http://wikiba.se/ontology#',
+    'prov': 'http://www.w3.org/ns/prov#',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'schema': 'http://schema.org/',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+    'bd': 'http://www.bigdata.com/rdf#',
+}
+
+XSD_DECIMAL = PREFIXES['xsd'] + 'decimal'
+XSD_INTEGER = PREFIXES['xsd'] + 'integer'
+XSD_DOUBLE = PREFIXES['xsd'] + 'double'
+XSD_DATETIME = PREFIXES['xsd'] + 'dateTime'
+XSD_BOOLEAN = PREFIXES['xsd'] + 'boolean'
+NUMERIC_TYPES = {XSD_DECIMAL, XSD_INTEGER, XSD_DOUBLE}
+GENID = 'http://www.wikidata.org/.well-known/genid/'
+
+RANKS = {
+    'preferred': PREFIXES['wikibase'] + 'PreferredRank',
+    'normal': PREFIXES['wikibase'] + 'NormalRank',
+    'deprecated': PREFIXES['wikibase'] + 'DeprecatedRank',
+}
+
+
+class SparqlError(Exception):
+    pass
+
+
+# Terms are ('uri', iri) or ('literal', value, datatype, language)
+
+def uri(iri):
+    return 'uri', iri
+
+
+def literal(value, datatype=None, language=None):
+    return 'literal', value, datatype, language
+
+
+class Graph:
+    """Triples of a set of entities, indexed by subject and predicate, and by predicate and object."""
+
+    def __init__(self, entities=()):
+        self.by_subject = {}
+        self.by_object = {}
+        self.by_predicate = {}
+        self.triples = set()
+        for entity in entities:
+            self.add_entity(entity)
+
+    def add(self, subject, predicate, obj):
+        # A reference shared by several statements is the same node, its triples are only added once
+        if (subject, predicate, obj) in self.triples:
+            return
+        self.triples.add((subject, predicate, obj))
+        self.by_subject.setdefault((subject, predicate), []).append(obj)
+        self.by_object.setdefault((predicate, obj), []).append(subject)
+        self.by_predicate.setdefault(predicate, []).append((subject, obj))
+
+    def add_entity(self, entity):
+        subject = uri(PREFIXES['wd'] + entity['id'])
+        for prop, statements in entity.get('claims', {}).items():
+            ranks = {statement.get('rank', 'normal') for statement in statements}
+            best_rank = 'preferred' if 'preferred' in ranks else 'normal'
+            for statement in statements:
+                rank = statement.get('rank', 'normal')
+                node = uri(PREFIXES['wds'] + statement.get('id', entity['id'] + '$' + _hash(statement)).replace('$', '-'))
+                self.add(subject, uri(PREFIXES['p'] + prop), node)
+                self.add(node, uri(PREFIXES['wikibase'] + 'rank'), uri(RANKS[rank]))
+
+                value = self._add_snak(node, 'ps', 'psv', statement['mainsnak'])
+                if value is not None and rank == best_rank:
+                    self.add(subject, uri(PREFIXES['wdt'] + prop), value)
+
+                for qualifier_prop, snaks in statement.get('qualifiers', {}).items():
+                    for snak in snaks:
+                        self._add_snak(node, 'pq', 'pqv', snak, qualifier_prop)
+
+                for reference in statement.get('references', []):
+                    reference_node = uri(PREFIXES['wdref'] + reference.get('hash', _hash(reference)))
+                    self.add(node, uri(PREFIXES['prov'] + 'wasDerivedFrom'), reference_node)
+                    for reference_prop, snaks in reference.get('snaks', {}).items():
+                        for snak in snaks:
+                            self._add_snak(reference_node, 'pr', 'prv', snak, reference_prop)
+
+    def _add_snak(self, node, simple_prefix, value_prefix, snak, prop=None):
+        prop = prop or snak['property']
+        if snak.get('snaktype') == 'somevalue':
+            # An unknown value is a blank node, skolemized by the Wikidata Query Service
+            term = uri(GENID + _hash((node, prop)))
+            self.add(node, uri(PREFIXES[simple_prefix] + prop), term)
+            return term
+        if snak.get('snaktype', 'value') != 'value':
+            return None
+
+        datavalue = snak['datavalue']
+        value = datavalue['value']
+        kind = datavalue.get('type')
+        if kind == 'wikibase-entityid':
+            term = uri(PREFIXES['wd'] + value['id'])
+        elif kind == 'time':
+            term = literal(_rdf_time(value['time']), XSD_DATETIME)
+        elif kind == 'quantity':
+            term = literal(value['amount'].lstrip('+'), XSD_DECIMAL)
+        elif kind == 'monolingualtext':
+            term = literal(value['text'], language=value['language'])
+        elif isinstance(value, str):
+            term = literal(value)
+        else:
+            return None
+
+        self.add(node, uri(PREFIXES[simple_prefix] + prop), term)
+
+        if kind in ('time', 'quantity'):
+            value_node = uri(PREFIXES['wdv'] + _hash(value))
+            self.add(node, uri(PREFIXES[value_prefix] + prop), value_node)
+            if kind == 'time':
+                self.add(value_node, uri(PREFIXES['wikibase'] + 'timeValue'), term)
+                self.add(value_node, uri(PREFIXES['wikibase'] + 'timePrecision'), literal(str(value.get('precision', 11)), XSD_INTEGER))
+            else:
+                self.add(value_node, uri(PREFIXES['wikibase'] + 'quantityAmount'), term)
+        return term
+
+    def match(self, subject, predicate, obj):
+        """Yield the (subject, predicate, object) triples matching the given terms, None matches anything."""
+        if predicate is None:
+            for (s, p), objects in self.by_subject.items():
+                if subject is not None and s != subject:
+                    continue
+                for o in objects:
+                    if obj is None or o == obj:
+                        yield s, p, o
+        elif subject is not None:
+            for o in self.by_subject.get((subject, predicate), []):
+                if obj is None or o == obj:
+                    yield subject, predicate, o
+        elif obj is not None:
+            for s in self.by_object.get((predicate, obj), []):
+                yield s, predicate, obj
+        else:
+            for s, o in self.by_predicate.get(predicate, []):
+                yield s, predicate, o
+
+
+def _hash(value):
+    return hashlib.sha1(repr(value).encode()).hexdigest()
+
+
+def _rdf_time(time_value):
+    """'+2020-00-00T00:00:00Z' -> '2020-01-01T00:00:00Z', like the Wikidata Query Service"""
+    date, _, rest = time_value.lstrip('+').partition('T')
+    year, month, day = date.rsplit('-', 2) if date.count('-') >= 2 else (date, '01', '01')
+    return f"{year}-{month if month != '00' else '01'}-{day if day != '00' else '01'}T{rest or '00:00:00Z'}"
+
+
+# Parsing
+
+TOKEN = re.compile(r'''
+    (?P<ws>\s+|\#[^\n]*)
+  | (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<var>[?$][A-Za-z_][\w]*)
+  | (?P<number>[+-]?\d+(?:\.\d+)?)
+  | (?P<langtag>@[A-Za-z]+(?:-[A-Za-z0-9]+)*)
+  | (?P<pname>(?:[A-Za-z][\w-]*)?:[\w-]*|_:[\w]+)
+  | (?P<keyword>[A-Za-z][\w]*)
+  | (?P<op>\^\^|&&|\|\||!=|<=|>=|[{}().;,*=<>!+\-/\[\]|^])
+''', re.VERBOSE)
+
+
+def tokenize(query):
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = TOKEN.match(query, position)
+        if not match:
+            raise SparqlError(f'Unexpected character at {position}: {query[position:position + 20]!r}')
+        position = match.end()
+        kind = match.lastgroup
+        if kind != 'ws':
+            tokens.append((kind, match.group()))
+    return tokens
+
+
+class Parser:
+    def __init__(self, query):
+        self.tokens = tokenize(query)
+        self.position = 0
+        self.prefixes = dict(PREFIXES)
+        self.blank_nodes = 0
+
+    def peek(self, offset=0):
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return None, None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def accept(self, value):
+        kind, text = self.peek()
+        if text is not None and (text == value or (kind == 'keyword' and text.upper() == value)):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.accept(value):
+            raise SparqlError(f'Expected {value}, found {self.peek()[1]}')
+
+    def parse(self):
+        while self.accept('PREFIX'):
+            _, name = self.next()
+            _, iri = self.next()
+            self.prefixes[name[:-1]] = iri[1:-1]
+
+        self.expect('SELECT')
+        distinct = self.accept('DISTINCT') or self.accept('REDUCED')
+        variables = []
+        if self.accept('*'):
+            variables = None
+        else:
+            while self.peek()[0] == 'var':
+                variables.append(self.next()[1][1:])
+            if self.peek()[1] == '(':
+                raise SparqlError('Expressions in SELECT are not supported')
+
+        self.accept('WHERE')
+        where = self.group()
+
+        order = []
+        if self.accept('ORDER'):
+            self.expect('BY')
+            while True:
+                if self.accept('ASC') or self.peek()[1] == '(':
+                    self.expect('(')
+                    order.append((self.expression(), False))
+                    self.expect(')')
+                elif self.accept('DESC'):
+                    self.expect('(')
+                    order.append((self.expression(), True))
+                    self.expect(')')
+                elif self.peek()[0] == 'var':
+                    order.append((('var', self.next()[1][1:]), False))
+                elif self.peek()[0] == 'keyword' and self.peek()[1].upper() not in ('LIMIT', 'OFFSET'):
+                    order.append((self.primary(), False))
+                else:
+                    break
+
+        limit = offset = None
+        while self.peek()[1] is not None:
+            if self.accept('LIMIT'):
+                limit = int(self.next()[1])
+            elif self.accept('OFFSET'):
+                offset = int(self.next()[1])
+            else:
+                raise SparqlError(f'Unexpected {self.peek()[1]}')
+
+        return {'variables': variables, 'distinct': distinct, 'where': where, 'order': order, 'limit': limit, 'offset': offset}
+
+    def group(self):
+        """{ ... } -> list of ('triples', [...]), ('optional', group), ('union', [groups]), ('minus', group), ('values', ...), ('bind', ...), ('filter', expr)"""
+        self.expect('{')
+        elements = []
+        triples = []
+        while not self.accept('}'):
+            kind, text = self.peek()
+            upper = text.upper() if kind == 'keyword' else None
+            if upper in ('OPTIONAL', 'MINUS', 'FILTER', 'BIND', 'VALUES', 'SERVICE') or text == '{':
+                if triples:
+                    elements.append(('triples', triples))
+                    triples = []
+
+            if upper == 'OPTIONAL':
+                self.next()
+                elements.append(('optional', self.group()))
+            elif upper == 'MINUS':
+                self.next()
+                elements.append(('minus', self.group()))
+            elif upper == 'FILTER':
+                self.next()
+                if self.peek()[1] == '(':
+                    self.next()
+                    elements.append(('filter', self.expression()))
+                    self.expect(')')
+                else:
+                    elements.append(('filter', self.primary()))
+            elif upper == 'BIND':
+                self.next()
+                self.expect('(')
+                expression = self.expression()
+                self.expect('AS')
+                variable = self.next()[1][1:]
+                self.expect(')')
+                elements.append(('bind', expression, variable))
+            elif upper == 'VALUES':
+                self.next()
+                elements.append(self.values())
+            elif upper == 'SERVICE':
+                self.next()
+                self.next()
+                self.skip_group()
+            elif text == '{':
+                groups = [self.group()]
+                while self.accept('UNION'):
+                    groups.append(self.group())
+                elements.append(('union', groups) if len(groups) > 1 else ('group', groups[0]))
+            elif text == '.':
+                self.next()
+            else:
+                self.triples_block(triples)
+        if triples:
+            elements.append(('triples', triples))
+        return elements
+
+    def skip_group(self):
+        self.expect('{')
+        depth = 1
+        while depth:
+            _, text = self.next()
+            if text is None:
+                raise SparqlError('Unclosed group')
+            depth += {'{': 1, '}': -1}.get(text, 0)
+
+    def values(self):
+        variables = []
+        if self.accept('('):
+            while not self.accept(')'):
+                variables.append(self.next()[1][1:])
+            rows = []
+            self.expect('{')
+            while not self.accept('}'):
+                self.expect('(')
+                row = []
+                while not self.accept(')'):
+                    row.append(self.value_term())
+                rows.append(row)
+        else:
+            variables.append(self.next()[1][1:])
+            rows = []
+            self.expect('{')
+            while not self.accept('}'):
+                rows.append([self.value_term()])
+        return 'values', variables, rows
+
+    def value_term(self):
+        if self.accept('UNDEF'):
+            return None
+        return self.term()
+
+    def triples_block(self, triples):
+        subject = self.subject(triples)
+        self.property_list(subject, triples)
+        self.accept('.')
+
+    def subject(self, triples):
+        if self.peek()[1] == '[':
+            return self.blank_node(triples)
+        return self.term()
+
+    def blank_node(self, triples):
+        self.expect('[')
+        self.blank_nodes += 1
+        node = ('var', f' blank{self.blank_nodes}')
+        if not self.accept(']'):
+            self.property_list(node, triples)
+            self.expect(']')
+        return node
+
+    def property_list(self, subject, triples):
+        while True:
+            predicate = self.verb()
+            while True:
+                obj = self.blank_node(triples) if self.peek()[1] == '[' else self.term()
+                # A sequence path goes through one hidden variable per step
+                node = subject
+                for step in predicate[:-1]:
+                    self.blank_nodes += 1
+                    hidden = ('var', f' blank{self.blank_nodes}')
+                    triples.append((node, step, hidden))
+                    node = hidden
+                triples.append((node, predicate[-1], obj))
+                if not self.accept(','):
+                    break
+            if not self.accept(';'):
+                return
+            if self.peek()[1] in ('.', ']', '}'):
+                return
+
+    def verb(self):
+        """Predicate, or the steps of a sequence path like prov:wasDerivedFrom/pr:P248, as a list"""
+        steps = []
+        while True:
+            if self.accept('a'):
+                steps.append(('const', uri(PREFIXES['rdf'] + 'type')))
+            else:
+                steps.append(self.term())
+            if not self.accept('/'):
+                break
+        if self.peek()[1] in ('|', '*', '+', '?', '^'):
+            raise SparqlError('Only sequence property paths are supported')
+        return steps
+
+    def term(self):
+        kind, text = self.next()
+        if kind == 'var':
+            return 'var', text[1:]
+        if kind == 'iri':
+            return 'const', uri(text[1:-1])
+        if kind == 'pname':
+            return 'const', uri(self.expand(text))
+        if kind == 'string':
+            return 'const', self.literal_rest(_unescape(text[1:-1]))
+        if kind == 'number':
+            return 'const', literal(text, XSD_DECIMAL if '.' in text else XSD_INTEGER)
+        if kind == 'keyword' and text in ('true', 'false'):
+            return 'const', literal(text, XSD_BOOLEAN)
+        raise SparqlError(f'Unexpected term {text}')
+
+    def literal_rest(self, value):
+        if self.peek()[0] == 'langtag':
+            return literal(value, language=self.next()[1][1:])
+        if self.accept('^^'):
+            kind, text = self.next()
+            return literal(value, text[1:-1] if kind == 'iri' else self.expand(text))
+        return literal(value)
+
+    def expand(self, name):
+        prefix, _, local = name.partition(':')
+        if prefix not in self.prefixes:
+            raise SparqlError(f'Unknown prefix {prefix}')
+        return self.prefixes[prefix] + local
+
+    # Expressions, as ('var', name), ('const', term), ('call', name, args), ('op', operator, args)
+
+    def expression(self):
+        left = self.and_expression()
+        while self.accept('||'):
+            left = ('op', '||', [left, self.and_expression()])
+        return left
+
+    def and_expression(self):
+        left = self.relational()
+        while self.accept('&&'):
+            left = ('op', '&&', [left, self.relational()])
+        return left
+
+    def relational(self):
+        left = self.additive()
+        operator = self.peek()[1]
+        if operator in ('=', '!=', '<', '>', '<=', '>='):
+            self.next()
+            return 'op', operator, [left, self.additive()]
+        if self.peek()[0] == 'keyword' and operator.upper() in ('IN', 'NOT'):
+            negate = self.accept('NOT')
+            self.expect('IN')
+            self.expect('(')
+            values = []
+            while not self.accept(')'):
+                values.append(self.expression())
+                self.accept(',')
+            return 'op', 'NOT IN' if negate else 'IN', [left] + values
+        return left
+
+    def additive(self):
+        left = self.unary()
+        while self.peek()[1] in ('+', '-'):
+            operator = self.next()[1]
+            left = ('op', operator, [left, self.unary()])
+        return left
+
+    def unary(self):
+        if self.accept('!'):
+            return 'op', '!', [self.unary()]
+        return self.primary()
+
+    def primary(self):
+        kind, text = self.peek()
+        if text == '(':
+            self.next()
+            expression = self.expression()
+            self.expect(')')
+            return expression
+        if kind == 'keyword' and text not in ('true', 'false'):
+            self.next()
+            name = text.upper()
+            self.expect('(')
+            args = []
+            if name == 'BOUND':
+                args.append(('var', self.next()[1][1:]))
+                self.expect(')')
+                return 'call', name, args
+            while not self.accept(')'):
+                args.append(self.expression())
+                self.accept(',')
+            return 'call', name, args
+        if kind == 'pname' and self.peek(1)[1] == '(':
+            # Casts like xsd:integer(?x)
+            self.next()
+            self.expect('(')
+            args = [self.expression()]
+            self.expect(')')
+            return 'call', 'CAST', [('const', uri(self.expand(text)))] + args
+        return self.term()
+
+
+def _unescape(text):
+    return re.sub(r'\\(.)', lambda match: {'n': '\n', 't': '\t'}.get(match.group(1), match.group(1)), text)
+
+
+# Evaluation
+
+def _is_var(node):
+    return node[0] == 'var'
+
+
+def _resolve(node, solution):
+    if _is_var(node):
+        return solution.get(node[1])
+    return node[1]
+
+
+def evaluate_group(graph, group, solutions):
+    filters = []
+    for element in group:
+        kind = element[0]
+        if kind == 'triples':
+            solutions = [result for solution in solutions for result in _match_triples(graph, element[1], solution)]
+        elif kind == 'optional':
+            joined = []
+            for solution in solutions:
+                extended = evaluate_group(graph, element[1], [solution])
+                joined.extend(extended or [solution])
+            solutions = joined
+        elif kind == 'group':
+            solutions = evaluate_group(graph, element[1], solutions)
+        elif kind == 'union':
+            solutions = [result for branch in element[1] for result in evaluate_group(graph, branch, solutions)]
+        elif kind == 'minus':
+            removed = evaluate_group(graph, element[1], [{}])
+            solutions = [solution for solution in solutions if not any(_compatible(solution, other) and set(solution) & set(other) for other in removed)]
+        elif kind == 'values':
+            variables, rows = element[1], element[2]
+            joined = []
+            for solution in solutions:
+                for row in rows:
+                    candidate = dict(solution)
+                    for variable, value in zip(variables, row):
+                        term = value[1] if value is not None else None
+                        if term is None:
+                            continue
+                        if variable in candidate and candidate[variable] != term:
+                            break
+                        candidate[variable] = term
+                    else:
+                        joined.append(candidate)
+            solutions = joined
+        elif kind == 'bind':
+            extended = []
+            for solution in solutions:
+                solution = dict(solution)
+                try:
+                    solution[element[2]] = evaluate_expression(element[1], solution)
+                except SparqlError:
+                    pass
+                extended.append(solution)
+            solutions = extended
+        elif kind == 'filter':
+            filters.append(element[1])
+
+    for expression in filters:
+        solutions = [solution for solution in solutions if _effective_boolean(expression, solution)]
+    return solutions
+
+
+def _compatible(first, second):
+    return all(first[key] == second[key] for key in first.keys() & second.keys())
+
+
+def _match_triples(graph, patterns, solution):
+    if not patterns:
+        yield solution
+        return
+
+    # Start with the pattern having the most bound terms
+    def bound(pattern):
+        return sum(1 for node in pattern if not _is_var(node) or node[1] in solution)
+
+    pattern = max(patterns, key=bound)
+    rest = [other for other in patterns if other is not pattern]
+    subject, predicate, obj = (_resolve(node, solution) for node in pattern)
+    for triple in graph.match(subject, predicate, obj):
+        extended = dict(solution)
+        for node, value in zip(pattern, triple):
+            if _is_var(node):
+                if node[1] in extended and extended[node[1]] != value:
+                    break
+                extended[node[1]] = value
+        else:
+            yield from _match_triples(graph, rest, extended)
+
+
+def _effective_boolean(expression, solution):
+    try:
+        return _boolean(evaluate_expression(expression, solution))
+    except SparqlError:
+        return False
+
+
+def _boolean(term):
+    if term is None:
+        raise SparqlError('Unbound value')
+    if term[0] == 'uri':
+        raise SparqlError('IRI has no boolean value')
+    value, datatype = term[1], term[2]
+    if datatype == XSD_BOOLEAN:
+        return value == 'true'
+    if datatype in NUMERIC_TYPES:
+        return Decimal(value) != 0
+    return value != ''
+
+
+def _boolean_term(value):
+    return literal('true' if value else 'false', XSD_BOOLEAN)
+
+
+def _string(term):
+    if term is None:
+        raise SparqlError('Unbound value')
+    return term[1]
+
+
+def _compare_key(term):
+    if term is None:
+        return 0, ''
+    if term[0] == 'uri':
+        return 1, term[1]
+    if term[2] in NUMERIC_TYPES:
+        try:
+            return 2, Decimal(term[1])
+        except InvalidOperation:
+            pass
+    return 3, term[1]
+
+
+def _compare(operator, left, right):
+    if left is None or right is None:
+        raise SparqlError('Unbound value')
+    if operator == '=':
+        return left == right or (left[0] == right[0] == 'literal' and _compare_key(left) == _compare_key(right))
+    if operator == '!=':
+        return not _compare('=', left, right)
+    left_key, right_key = _compare_key(left), _compare_key(right)
+    if left_key[0] != right_key[0]:
+        raise SparqlError('Values of different types')
+    return {'<': left_key < right_key, '>': left_key > right_key, '<=': left_key <= right_key, '>=': left_key >= right_key}[operator]
+
+
+def evaluate_expression(expression, solution):
+    kind = expression[0]
+    if kind == 'var':
+        value = solution.get(expression[1])
+        if value is None:
+            raise SparqlError(f'Unbound variable {expression[1]}')
+        return value
+    if kind == 'const':
+        return expression[1]
+
+    if kind == 'op':
+        operator, args = expression[1], expression[2]
+        if operator == '||':
+            return _boolean_term(_effective_boolean(args[0], solution) or _effective_boolean(args[1], solution))
+        if operator == '&&':
+            return _boolean_term(_boolean(evaluate_expression(args[0], solution)) and _boolean(evaluate_expression(args[1], solution)))
+        if operator == '!':
+            return _boolean_term(not _boolean(evaluate_expression(args[0], solution)))
+        if operator in ('IN', 'NOT IN'):
+            value = evaluate_expression(args[0], solution)
+            found = any(_compare('=', value, evaluate_expression(arg, solution)) for arg in args[1:])
+            return _boolean_term(found if operator == 'IN' else not found)
+        if operator in ('+', '-'):
+            left, right = (Decimal(_string(evaluate_expression(arg, solution))) for arg in args)
+            return literal(str(left + right if operator == '+' else left - right), XSD_DECIMAL)
+        return _boolean_term(_compare(operator, evaluate_expression(args[0], solution), evaluate_expression(args[1], solution)))
+
+    name, args = expression[1], expression[2]
+    if name == 'BOUND':
+        return _boolean_term(solution.get(args[0][1]) is not None)
+    if name == 'COALESCE':
+        for arg in args:
+            try:
+                return evaluate_expression(arg, solution)
+            except SparqlError:
+                continue
+        raise SparqlError('No bound value in COALESCE')
+    if name == 'IF':
+        return evaluate_expression(args[1] if _effective_boolean(args[0], solution) else args[2], solution)
+
+    values = [evaluate_expression(arg, solution) for arg in args]
+    if name == 'STR':
+        return literal(_string(values[0]))
+    if name in ('STRSTARTS', 'STRENDS', 'CONTAINS'):
+        text, part = _string(values[0]), _string(values[1])
+        return _boolean_term({'STRSTARTS': text.startswith, 'STRENDS': text.endswith, 'CONTAINS': text.__contains__}[name](part))
+    if name == 'REGEX':
+        flags = re.IGNORECASE if len(values) > 2 and 'i' in _string(values[2]) else 0
+        return _boolean_term(re.search(_string(values[1]), _string(values[0]), flags) is not None)
+    if name == 'LANG':
+        return literal(values[0][3] or '') if values[0][0] == 'literal' else literal('')
+    if name == 'DATATYPE':
+        return uri(values[0][2] or PREFIXES['xsd'] + 'string')
+    if name in ('ISIRI', 'ISURI'):
+        return _boolean_term(values[0][0] == 'uri')
+    if name == 'ISLITERAL':
+        return _boolean_term(values[0][0] == 'literal')
+    if name in ('UCASE', 'LCASE'):
+        return literal(_string(values[0]).upper() if name == 'UCASE' else _string(values[0]).lower())
+    if name == 'STRLEN':
+        return literal(str(len(_string(values[0]))), XSD_INTEGER)
+    if name == 'SUBSTR':
+        text = _string(values[0])
+        start = int(_string(values[1])) - 1
+        length = int(_string(values[2])) if len(values) > 2 else len(text)
+        return literal(text[start:start + length])
+    if name == 'YEAR':
+        return literal(str(int(_string(values[0]).split('-')[0] or '0')), XSD_INTEGER)
+    if name == 'CAST':
+        return literal(_string(values[1]), values[0][1])
+    raise SparqlError(f'Function {name} is not supported')
+
+
+def _order_key(order, solution):
+    key = []
+    for expression, descending in order:
+        try:
+            value = _compare_key(evaluate_expression(expression, solution))
+        except SparqlError:
+            value = (0, '')
+        key.append(_Reversed(value) if descending else value)
+    return key
+
+
+class _Reversed:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def query(graph, text):
+    """Run a SELECT query on graph and return the result in the SPARQL 1.1 JSON format."""
+    parsed = Parser(text).parse()
+    solutions = evaluate_group(graph, parsed['where'], [{}])
+
+    if parsed['order']:
+        solutions.sort(key=lambda solution: _order_key(parsed['order'], solution))
+
+    variables = parsed['variables']
+    if variables is None:
+        variables = sorted({name for solution in solutions for name in solution if not name.startswith(' ')})
+
+    rows = [{name: solution[name] for name in variables if solution.get(name) is not None} for solution in solutions]
+    if parsed['distinct']:
+        seen = set()
+        unique = []
+        for row in rows:
+            key = tuple(sorted(row.items()))
+            if key not in seen:
+                seen.add(key)
+                unique.append(row)
+        rows = unique
+
+    offset = parsed['offset'] or 0
+    rows = rows[offset:offset + parsed['limit'] if parsed['limit'] is not None else None]
+
+    return {'head': {'vars': variables}, 'results': {'bindings': [{name: _json_term(term) for name, term in row.items()} for row in rows]}}
+
+
+def _json_term(term):
+    if term[0] == 'uri':
+        return {'type': 'uri', 'value': term[1]}
+    result = {'type': 'literal', 'value': term[1]}
+    if term[2]:
+        result['datatype'] = term[2]
+    if term[3]:
+        result['xml:lang'] = term[3]
+    return result
@@ -0,0 +1,443 @@
+"""Local stand-in for the Wikidata API and query service, to run the level scripts offline.
+
+It serves, from entities loaded from fixture JSON:
+- the MediaWiki API subset used by WikibaseIntegrator and these scripts: login (login and clientlogin), tokens, userinfo, wbgetentities and wbeditentity
+- a SPARQL endpoint evaluating the queries against the same entities, see population.fake_sparql
+
+Latency, maxlag errors and edit conflicts can be injected to measure the write scheduler and the retries.
+A level script uses it with --fake <fixtures>, or it runs alone with python -m population.fake_wikibase <fixtures>.
+"""
+import argparse
+import copy
+import gzip
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from population import fake_sparql
+
+API_PATH = '/w/api.php'
+SPARQL_PATH = '/sparql'
+SESSION_COOKIE = 'fakewikibase_session'
+
+
+def load_fixtures(path):
+    """Entities of a fixture file: a wbgetentities response, a list of entities, a dict of id to entity or one entity per line (.gz or not)."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as fixture_file:
+        text = fixture_file.read()
+
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        # One entity per line, like a dump or a subset written by population.dump
+        data = [json.loads(line.rstrip(',\n')) for line in text.splitlines() if len(line.strip()) > 1]
+
+    if isinstance(data, dict):
+        data = data.get('entities', data)
+        if 'id' in data:
+            data = [data]
+        else:
+            data = list(data.values())
+    return data
+
+
+class FakeWikibase:
+    """Entities served by a threaded HTTP server on localhost.
+
+    latency (seconds, plus up to jitter) delays every API request, sparql_latency every query.
+    maxlag_rate and ratelimit_rate are the share of requests answered with a maxlag or ratelimited error.
+    conflict_rate is the share of edits for which someone else edits the item first: the revision changes and the edit gets an editconflict.
+    password, when set, is the only password a login accepts. Clearing sessions expires the sessions of the logins done so far.
+    An edit with a baserevid older than the current revision always gets an editconflict.
+    """
+
+    def __init__(self, entities=(), host='127.0.0.1', port=0, latency=0.0, jitter=0.0, sparql_latency=0.0, maxlag_rate=0.0, ratelimit_rate=0.0,
+                 conflict_rate=0.0, seed=None, password=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.sparql_latency = sparql_latency
+        self.maxlag_rate = maxlag_rate
+        self.ratelimit_rate = ratelimit_rate
+        self.conflict_rate = conflict_rate
+        self.password = password
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.entities = {}
+        self.revision = 0
+        self.graph = None
+        self.sessions = {}  # session cookie -> {'user': ..., 'csrftoken': ...}
+        self.stats = Counter()
+
+        for entity in entities:
+            self.add_entity(entity)
+
+        self.server = ThreadingHTTPServer((host, port), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self):
+        return self.url + API_PATH
+
+    @property
+    def sparql_url(self):
+        return self.url + SPARQL_PATH
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-wikibase', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        logging.info(f'Fake Wikibase requests: {dict(self.stats)}')
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_entity(self, entity):
+        entity = copy.deepcopy(entity)
+        self.revision = max(self.revision, entity.get('lastrevid', 0)) + 1
+        entity.setdefault('lastrevid', self.revision)
+        entity.setdefault('type', 'item')
+        entity.setdefault('title', entity['id'])
+        entity.setdefault('modified', _now())
+        for key in ('labels', 'descriptions', 'aliases', 'claims', 'sitelinks'):
+            entity.setdefault(key, {})
+        for statements in entity['claims'].values():
+            for statement in statements:
+                _complete_statement(entity, statement)
+        self.entities[entity['id']] = entity
+        self.graph = None
+
+    def save(self, path):
+        """Write the current entities, edits included, in the wbgetentities format."""
+        with self.lock, open(path, 'w', encoding='utf-8') as output:
+            json.dump({'entities': self.entities}, output, ensure_ascii=False)
+
+    # API
+
+    def api(self, params, cookies):
+        action = params.get('action')
+        self.stats[action] += 1
+        self._wait(self.latency)
+
+        # MediaWiki checks maxlag before anything else when the client sends it
+        if 'maxlag' in params and self.random.random() < self.maxlag_rate:
+            self.stats['maxlag'] += 1
+            lag = int(params['maxlag']) + 1
+            return {'error': {'code': 'maxlag', 'info': f'Waiting for a database server: {lag} seconds lagged.', 'host': 'fake', 'lag': lag}}, {'Retry-After': '1'}
+
+        session = self.sessions.get(cookies.get(SESSION_COOKIE))
+        assertion = params.get('assert')
+        if assertion in ('user', 'bot') and session is None:
+            return _error(f'assert{assertion}failed', 'You are no longer logged in.'), {}
+
+        if action == 'query':
+            return self._query(params, session, cookies), {}
+        if action in ('login', 'clientlogin'):
+            return self._login(action, params, cookies)
+        if action == 'wbgetentities':
+            return self._get_entities(params), {}
+        if action == 'wbeditentity':
+            if self.random.random() < self.ratelimit_rate:
+                self.stats['ratelimited'] += 1
+                return _error('ratelimited', "As an anti-abuse measure, you are limited from performing this action too many times in a short space of time."), {}
+            if session is None and params.get('token') != '+\\':
+                return _error('badtoken', 'Invalid CSRF token.'), {}
+            return self._edit_entity(params), {}
+        return _error('badvalue', f'Unrecognized value for parameter "action": {action}.'), {}
+
+    def _query(self, params, session, cookies):
+        result = {}
+        meta = params.get('meta', '').split('|')
+        if 'tokens' in meta:
+            token_type = params.get('type', 'csrf')
+            if token_type == 'login':
+                # The login token comes with the session cookie the login request has to send back
+                cookie = cookies.get(SESSION_COOKIE) or secrets.token_hex(16)
+                cookies[SESSION_COOKIE] = cookie
+                result['tokens'] = {'logintoken': secrets.token_hex(16) + '+\\'}
+            else:
+                result['tokens'] = {'csrftoken': session['csrftoken'] if session else '+\\'}
+        if 'userinfo' in meta:
+            result['userinfo'] = {'id': 1, 'name': session['user']} if session else {'id': 0, 'name': '127.0.0.1', 'anon': ''}
+        return {'batchcomplete': '', 'query': result}
+
+    def _login(self, action, params, cookies):
+        cookie = cookies.get(SESSION_COOKIE) or secrets.token_hex(16)
+        user = params.get('lgname') or params.get('username') or 'Fake'
+        # Without a password set, any password is accepted and the credentials of config.py are never needed
+        if self.password is not None and (params.get('lgpassword') or params.get('password')) != self.password:
+            if action == 'login':
+                return {'login': {'result': 'Failed', 'reason': 'Incorrect username or password entered. Please try again.'}}, {}
+            return {'clientlogin': {'status': 'FAIL', 'message': 'Incorrect username or password entered. Please try again.'}}, {}
+        self.sessions[cookie] = {'user': user.split('@')[0], 'csrftoken': secrets.token_hex(16) + '+\\'}
+        headers = {'Set-Cookie': f'{SESSION_COOKIE}={cookie}; Path=/; HttpOnly'}
+        if action == 'login':
+            return {'login': {'result': 'Success', 'lguserid': 1, 'lgusername': user.split('@')[0]}}, headers
+        return {'clientlogin': {'status': 'PASS', 'username': user}}, headers
+
+    def _get_entities(self, params):
+        props = params.get('props', 'info|sitelinks|aliases|labels|descriptions|claims|datatype').split('|')
+        entities = {}
+        with self.lock:
+            for entity_id in params.get('ids', '').split('|'):
+                entity = self.entities.get(entity_id)
+                if entity is None:
+                    entities[entity_id] = {'id': entity_id, 'missing': ''}
+                else:
+                    entities[entity_id] = _select_props(entity, props)
+        return {'entities': entities, 'success': 1}
+
+    def _edit_entity(self, params):
+        data = json.loads(params.get('data', '{}'))
+        with self.lock:
+            if 'new' in params:
+                entity_id = f'Q{len(self.entities) + 1000000}'
+                self.add_entity({'id': entity_id})
+            else:
+                entity_id = params.get('id')
+            entity = self.entities.get(entity_id)
+            if entity is None:
+                return _error('no-such-entity', f'Could not find an entity with the ID "{entity_id}".')
+
+            if self.random.random() < self.conflict_rate:
+                # Someone else edited the item in the meantime
+                self._touch(entity)
+                self.stats['injected_conflict'] += 1
+                return _error('editconflict', 'Edit conflict.')
+
+            baserevid = params.get('baserevid')
+            if baserevid and int(baserevid) != entity['lastrevid']:
+                self.stats['editconflict'] += 1
+                return _error('editconflict', 'Edit conflict.')
+
+            if 'clear' in params:
+                for key in ('labels', 'descriptions', 'aliases', 'claims', 'sitelinks'):
+                    entity[key] = {}
+
+            _apply_claims(entity, data.get('claims', {}))
+            for key in ('labels', 'descriptions'):
+                for language, value in data.get(key, {}).items():
+                    if 'remove' in value:
+                        entity[key].pop(language, None)
+                    else:
+                        entity[key][language] = {'language': language, 'value': value['value']}
+
+            self._touch(entity)
+            self.stats['edits'] += 1
+            return {'entity': copy.deepcopy(entity), 'success': 1}
+
+    def _touch(self, entity):
+        self.revision += 1
+        entity['lastrevid'] = self.revision
+        entity['modified'] = _now()
+        self.graph = None
+
+    # SPARQL
+
+    def sparql(self, text):
+        self.stats['sparql'] += 1
+        self._wait(self.sparql_latency)
+        with self.lock:
+            if self.graph is None:
+                self.graph = fake_sparql.Graph(self.entities.values())
+            graph = self.graph
+        return fake_sparql.query(graph, text)
+
+    def _wait(self, latency):
+        if latency or self.jitter:
+            time.sleep(latency + self.random.uniform(0, self.jitter))
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _error(code, info):
+    return {'error': {'code': code, 'info': info}}
+
+
+def _select_props(entity, props):
+    selected = {'id': entity['id'], 'type': entity['type']}
+    if 'info' in props:
+        for key in ('lastrevid', 'modified', 'title', 'pageid', 'ns'):
+            if key in entity:
+                selected[key] = entity[key]
+    for key in ('labels', 'descriptions', 'aliases', 'claims', 'sitelinks'):
+        if key in props:
+            selected[key] = copy.deepcopy(entity[key])
+    return selected
+
+
+def _complete_statement(entity, statement):
+    """Fill what Wikibase adds to a statement and WikibaseIntegrator expects when reading it back: id, rank, snak and reference hashes, orders."""
+    statement.setdefault('type', 'statement')
+    statement.setdefault('rank', 'normal')
+    if not statement.get('id'):
+        statement['id'] = f"{entity['id']}${uuid.uuid4()}"
+    statement['mainsnak'].setdefault('snaktype', 'value')
+    statement['mainsnak'].setdefault('hash', fake_sparql._hash(statement['mainsnak'].get('datavalue')))
+    if statement.get('qualifiers'):
+        for snaks in statement['qualifiers'].values():
+            for snak in snaks:
+                snak.setdefault('snaktype', 'value')
+                snak.setdefault('hash', fake_sparql._hash(snak.get('datavalue')))
+        statement.setdefault('qualifiers-order', list(statement['qualifiers']))
+    for reference in statement.get('references', []):
+        for snaks in reference.get('snaks', {}).values():
+            for snak in snaks:
+                snak.setdefault('snaktype', 'value')
+        reference.setdefault('hash', fake_sparql._hash(reference.get('snaks')))
+        reference.setdefault('snaks-order', list(reference.get('snaks', {})))
+    return statement
+
+
+def _apply_claims(entity, claims):
+    """Apply the claims of a wbeditentity data: statements with an id replace or remove the existing one, the others are added."""
+    if isinstance(claims, dict):
+        claims = [claim for statements in claims.values() for claim in statements]
+
+    for claim in claims:
+        statement_id = claim.get('id')
+        if 'remove' in claim:
+            for prop, statements in entity['claims'].items():
+                entity['claims'][prop] = [statement for statement in statements if statement.get('id') != statement_id]
+            continue
+
+        statement = _complete_statement(entity, copy.deepcopy(claim))
+        prop = statement['mainsnak']['property']
+
+        statements = entity['claims'].setdefault(prop, [])
+        for i, existing in enumerate(statements):
+            if existing.get('id') == statement['id']:
+                statements[i] = statement
+                break
+        else:
+            statements.append(statement)
+
+    entity['claims'] = {prop: statements for prop, statements in entity['claims'].items() if statements}
+
+
+def _handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self._handle(parse_qs(urlsplit(self.path).query))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8')
+            params = parse_qs(urlsplit(self.path).query)
+            if self.headers.get('Content-Type', '').startswith('application/sparql-query'):
+                params['query'] = [body]
+            else:
+                params.update(parse_qs(body, keep_blank_values=True))
+            self._handle(params)
+
+        def _handle(self, params):
+            params = {key: values[-1] for key, values in params.items()}
+            path = urlsplit(self.path).path
+            cookies = dict(cookie.strip().split('=', 1) for cookie in self.headers.get('Cookie', '').split(';') if '=' in cookie)
+            received = dict(cookies)
+            headers = {}
+            try:
+                if path.endswith('api.php'):
+                    result, headers = fake.api(params, cookies)
+                    if cookies.get(SESSION_COOKIE) != received.get(SESSION_COOKIE) and 'Set-Cookie' not in headers:
+                        headers['Set-Cookie'] = f'{SESSION_COOKIE}={cookies[SESSION_COOKIE]}; Path=/; HttpOnly'
+                    content_type = 'application/json; charset=utf-8'
+                elif path.endswith('sparql'):
+                    result = fake.sparql(params.get('query', ''))
+                    content_type = 'application/sparql-results+json; charset=utf-8'
+                else:
+                    self.send_error(404)
+                    return
+                status = 200
+            except fake_sparql.SparqlError as error:
+                result, status, content_type = {'error': str(error)}, 400, 'application/json; charset=utf-8'
+
+            body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, message_format, *args):
+            logging.debug('fake wikibase: ' + message_format, *args)
+
+    return Handler
+
+
+def use_fake_wikibase(fake):
+    """Send the WikibaseIntegrator requests of this process to fake and keep the snapshots, journals, plans, metrics and logs of the run apart from the real ones."""
+    from wikibaseintegrator.wbi_config import config as wbi_config
+
+    import config
+
+    wbi_config['MEDIAWIKI_API_URL'] = fake.api_url
+    wbi_config['SPARQL_ENDPOINT_URL'] = fake.sparql_url
+    # Entity URIs keep the Wikidata concept URI, like the fixtures
+    config.snapshot_path = 'cache/fake/snapshots.sqlite3'
+    config.journal_dir = 'cache/fake/journal'
+    config.plan_dir = 'cache/fake/plans'
+    config.metrics_dir = 'cache/fake/metrics'
+    config.log_dir = 'cache/fake/logs'
+    config.profile_dir = 'cache/fake/profiles'
+    config.session_path = 'cache/fake/session.pickle'
+    return fake
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a fake Wikibase API and SPARQL endpoint from fixture entities.')
+    parser.add_argument('fixtures', help='JSON file of entities: wbgetentities response, list, or one entity per line (.gz accepted)')
+    parser.add_argument('--port', type=int, default=8181)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, up to this many seconds')
+    parser.add_argument('--sparql-latency', type=float, default=0.0, help='seconds added to every SPARQL query')
+    parser.add_argument('--maxlag-rate', type=float, default=0.0, help='share of requests answered with a maxlag error')
+    parser.add_argument('--ratelimit-rate', type=float, default=0.0, help='share of edits answered with a ratelimited error')
+    parser.add_argument('--conflict-rate', type=float, default=0.0, help='share of edits hitting an edit conflict')
+    parser.add_argument('--seed', type=int, help='seed of the injected errors')
+    parser.add_argument('--output', help='write the entities with the edits to this file when stopped')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    fake_wikibase = FakeWikibase(load_fixtures(args.fixtures), port=args.port, latency=args.latency, jitter=args.jitter, sparql_latency=args.sparql_latency,
+                                 maxlag_rate=args.maxlag_rate, ratelimit_rate=args.ratelimit_rate, conflict_rate=args.conflict_rate, seed=args.seed)
+    print(f'API: {fake_wikibase.api_url}')
+    print(f'SPARQL: {fake_wikibase.sparql_url}')
+    try:
+        fake_wikibase.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake_wikibase.server.server_close()
+        print(dict(fake_wikibase.stats))
+        if args.output:
+            fake_wikibase.save(args.output)
@@ -0,0 +1,193 @@
+import logging
+
+from wikibaseintegrator.wbi_enums import WikibaseRank
+
+from population.snapshots import snapshot_key
+from population.sparql import entity_id, keyset_query
+from population.validity import current_at, geography_date, wikibase_date
+
+
+class Candidate:
+    """Facts about one item needed to know if it is the right one for an INSEE code in the geography of a census.
+
+    Dates are 'YYYY-MM-DD' strings so they compare without parsing.
+    """
+    __slots__ = ('item', 'codes', 'types', 'dissolved')
+
+    def __init__(self, item):
+        self.item = item
+        self.codes = set()  # (code, start, end) of the INSEE code statements
+        self.types = set()  # (start, end) of the instance of (P31) statements for the level type
+        self.dissolved = set()  # dissolved, abolished or demolished date (P576)
+
+    def valid_at(self, code, geography):
+        """Whether the item is not dissolved, is of the level type and has code in the geography of that day, see population.validity.current_at."""
+        if not all(current_at(date, geography) for date in self.dissolved):
+            return False
+        if not any(current_at(end, geography) for start, end in self.types):
+            return False
+        return any(current_at(end, geography) for value, start, end in self.codes if value == code)
+
+    def code_start(self, code):
+        starts = [start for value, start, end in self.codes if value == code and start]
+        return max(starts) if starts else ''
+
+
+def _date(binding, name):
+    if name not in binding:
+        return None
+    return wikibase_date(binding[name]['value'])
+
+
+class InseeIndex:
+    """INSEE code to candidate items of a level, with what is needed to pick the valid one in the geography of the census."""
+
+    def __init__(self):
+        self.by_code = {}
+        self.items = {}
+
+    def add(self, binding):
+        """Add one row of the query made by build_query."""
+        dissolved = [_date(binding, 'dissolved')] if 'dissolved' in binding else []
+        self.add_candidate(entity_id(binding['item']), [(binding['code']['value'], _date(binding, 'codeStart'), _date(binding, 'codeEnd'))],
+                           [(_date(binding, 'typeStart'), _date(binding, 'typeEnd'))], dissolved)
+
+    def add_candidate(self, item, codes, types, dissolved):
+        """Add the (code, start, end) code statements, (start, end) type statements and dissolution dates of item."""
+        candidate = self.items.get(item)
+        if candidate is None:
+            candidate = self.items[item] = Candidate(item)
+
+        candidate.codes.update(codes)
+        candidate.types.update(types)
+        candidate.dissolved.update(dissolved)
+
+        for code, _, _ in codes:
+            candidates = self.by_code.setdefault(code, [])
+            if candidate not in candidates:
+                candidates.append(candidate)
+
+    def merge(self, other):
+        """Add the candidates of another index, like the one of another shard of the level."""
+        for candidate in other.items.values():
+            self.add_candidate(candidate.item, candidate.codes, candidate.types, candidate.dissolved)
+
+    def valid(self, code, entities=None, point_in_time=None):
+        """Candidates of code valid in the geography of the census of point_in_time (default config.point_in_time), among entities when given."""
+        geography = geography_date(point_in_time)
+        return [candidate for candidate in self.by_code.get(code, []) if (entities is None or candidate.item in entities) and candidate.valid_at(code, geography)]
+
+    def resolve(self, code, entities=None, point_in_time=None):
+        """Return the only item valid for code in the geography of the census, None when there is none or several.
+
+        entities restricts the search to these items. Among several valid items, the one whose code started the most recently wins when
+        its start is the only one.
+        """
+        valid = self.valid(code, entities, point_in_time)
+        if len(valid) == 1:
+            return valid[0].item
+        if len(valid) > 1:
+            valid.sort(key=lambda candidate: candidate.code_start(code), reverse=True)
+            if valid[0].code_start(code) > valid[1].code_start(code):
+                return valid[0].item
+        logging.debug('%d valid items in the index for %s', len(valid), code)
+        return None
+
+
+def base_filter_patterns(level):
+    """(level type, triple patterns of the other base filter claims on ?item) of a level."""
+    level_type = None
+    filters = []
+    for claim in level.base_filter:
+        value = (claim.mainsnak.datavalue or {}).get('value')
+        if claim.mainsnak.property_number == 'P31':
+            level_type = value['id']
+        elif value:
+            filters.append(f"?item wdt:{claim.mainsnak.property_number} wd:{value['id']}.")
+    return level_type, ' '.join(filters)
+
+
+def state_types(level):
+    """Types (P31) of the items fetched for the level state, the level type unless the level shares its state with others."""
+    return tuple(getattr(level, 'state_types', None) or (base_filter_patterns(level)[0],))
+
+
+def state_key(level, kind):
+    """Snapshot key of what is fetched for the level, the same for the levels sharing their state."""
+    filters = [claim for claim in level.base_filter if claim.mainsnak.property_number != 'P31']
+    return snapshot_key(filters, kind=f"{kind}:{'+'.join(state_types(level))}")
+
+
+def type_patterns(level):
+    """Triple patterns binding ?item of one of the state types and its ?typeStatement."""
+    types = ' '.join(f'wd:{level_type}' for level_type in state_types(level))
+    return f'VALUES ?type {{ {types} }} ?item wdt:P31 ?type. ?item p:P31 ?typeStatement. ?typeStatement ps:P31 ?type.'
+
+
+def build_query(level, code_prefix=None):
+    """Query listing every (item, code statement, type statement, dissolution) of the level base filter, only the codes starting with code_prefix when given."""
+    _, filters = base_filter_patterns(level)
+    prefix_filter = f'FILTER(STRSTARTS(?code, "{code_prefix}"))' if code_prefix else ''
+    return f'''
+SELECT ?item ?code ?codeStart ?codeEnd ?typeStart ?typeEnd ?dissolved WHERE {{
+  {type_patterns(level)}
+  {filters}
+  ?item p:{level.insee_property} ?codeStatement.
+  ?codeStatement ps:{level.insee_property} ?code.
+  {prefix_filter}
+  {{cursor}}
+  OPTIONAL {{ ?codeStatement pq:P580 ?codeStart. }}
+  OPTIONAL {{ ?codeStatement pq:P582 ?codeEnd. }}
+  OPTIONAL {{ ?typeStatement pq:P580 ?typeStart. }}
+  OPTIONAL {{ ?typeStatement pq:P582 ?typeEnd. }}
+  OPTIONAL {{ ?item wdt:P576 ?dissolved. }}
+}}'''
+
+
+def build_index(level, page_size=10000):
+    index = InseeIndex()
+    for binding in keyset_query(build_query(level), page_size=page_size):
+        index.add(binding)
+    print(f'INSEE index built: {len(index.by_code)} codes, {len(index.items)} items')
+    return index
+
+
+def _statements(entity, prop):
+    if prop not in entity.claims:
+        return []
+    return [claim for claim in entity.claims.get(prop) if claim.rank != WikibaseRank.DEPRECATED]
+
+
+def _snak_date(snak):
+    value = (snak.datavalue or {}).get('value')
+    if not isinstance(value, dict):  # Unknown or no value
+        return None
+    return wikibase_date(value['time'], value.get('precision', 11))
+
+
+def _qualifier_date(claim, prop):
+    for snak in claim.qualifiers.get(prop) if prop in claim.qualifiers_order else []:
+        return _snak_date(snak)
+    return None
+
+
+def index_entities(level, entities, candidates):
+    """InseeIndex of the entities fetched for a row, candidates maps their ids to the fetched items."""
+    level_type, _ = base_filter_patterns(level)
+    index = InseeIndex()
+    for entity in entities:
+        item = candidates[entity]
+        codes = [(claim.mainsnak.datavalue['value'], _qualifier_date(claim, 'P580'), _qualifier_date(claim, 'P582'))
+                 for claim in _statements(item, level.insee_property) if claim.mainsnak.datavalue]
+        types = [(_qualifier_date(claim, 'P580'), _qualifier_date(claim, 'P582'))
+                 for claim in _statements(item, 'P31') if (claim.mainsnak.datavalue or {}).get('value', {}).get('id') == level_type]
+        dissolved = [_snak_date(claim.mainsnak) for claim in _statements(item, 'P576') if claim.mainsnak.datavalue]
+        index.add_candidate(entity, codes, types, [date for date in dissolved if date])
+    return index
+
+
+def select_valid(level, code, entities, candidates, point_in_time=None):
+    """(id_item, final_items) for the items sharing code: the ones valid in the geography of the census, with the same rules as the index, and the one to write if it can be told."""
+    index = index_entities(level, entities, candidates)
+    final_items = [candidate.item for candidate in index.valid(code, point_in_time=point_in_time)]
+    return index.resolve(code, point_in_time=point_in_time), final_items
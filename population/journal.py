@@ -0,0 +1,79 @@
+import os
+import threading
+
+import config
+from population.metrics import metrics
+
+WRITTEN = 'written'
+NOT_REQUIRED = 'not_required'
+UNRESOLVED = 'unresolved'
+ERROR = 'error'
+PLANNED = 'planned'
+
+# Rows with these outcomes are skipped when the run is restarted, the others are tried again
+COMPLETED = {WRITTEN, NOT_REQUIRED, PLANNED}
+
+
+class Journal:
+    """Append-only record of the INSEE codes processed by a level, one tab separated line per code.
+
+    Lines are flushed to the disk every sync_every records, a crash loses at most those rows which are simply processed again.
+    """
+
+    def __init__(self, path, sync_every=50):
+        self.path = path
+        self.sync_every = sync_every
+        self.outcomes = {}
+        self._unsynced = 0
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if os.path.exists(path):
+            with open(path, 'rb+') as journal_file:
+                complete = 0
+                for line in journal_file:
+                    if not line.endswith(b'\n'):  # Last line cut by a crash
+                        break
+                    complete += len(line)
+                    fields = line.decode('utf-8').rstrip('\n').split('\t')
+                    # A fragment a crash left in the middle of the file, the row is processed again
+                    if len(fields) < 2:
+                        continue
+                    self.outcomes[fields[0]] = fields[1]
+                # Drop the cut line, the next records start on a line of their own
+                journal_file.truncate(complete)
+
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, code_insee):
+        return self.outcomes.get(code_insee) in COMPLETED
+
+    def record(self, code_insee, outcome, id_item=None):
+        with self.lock:
+            self.outcomes[code_insee] = outcome
+            metrics.count('rows', outcome=outcome)
+            self.file.write(f'{code_insee}\t{outcome}\t{id_item or ""}\n')
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self._sync()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self._sync()
+                self.file.close()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._unsynced = 0
+
+
+def journal_path(year, name):
+    return os.path.join(getattr(config, 'journal_dir', 'journal'), year, name + '.tsv')
@@ -0,0 +1,72 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+def default_path():
+    return getattr(config, 'ledger_path', os.path.join(getattr(config, 'journal_dir', 'journal'), 'ledger.sqlite3'))
+
+
+def input_digest(path, *extra):
+    """sha256 of an input file and of what else decides the edits made from it (census date, stated in...)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1 << 20), b''):
+            digest.update(chunk)
+    for value in extra:
+        digest.update(b'\0' + str(value).encode())
+    return digest.hexdigest()
+
+
+class Ledger:
+    """What was written to Wikidata, kept between runs and years in a SQLite file.
+
+    applied has one row per (level, INSEE code): the item written, the amount and point in time sent and the revision the write created.
+    inputs has the digest of the input files whose run completed without error.
+    """
+
+    def __init__(self, path=None, commit_every=50):
+        self.path = path or default_path()
+        self.commit_every = commit_every
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Writes are recorded by the scheduler threads
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS applied (level TEXT NOT NULL, code TEXT NOT NULL, item TEXT NOT NULL, amount INTEGER NOT NULL, '
+                                'point_in_time TEXT NOT NULL, revid INTEGER, written REAL NOT NULL, PRIMARY KEY (level, code))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS inputs (level TEXT NOT NULL, digest TEXT NOT NULL, completed REAL NOT NULL, PRIMARY KEY (level, digest))')
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self._uncommitted = 0
+
+    def get(self, level, code):
+        """(item, amount, point in time, revid) last written for code, None if nothing was."""
+        with self.lock:
+            return self.connection.execute('SELECT item, amount, point_in_time, revid FROM applied WHERE level = ? AND code = ?', (level, code)).fetchone()
+
+    def record(self, level, code, item, amount, point_in_time, revid):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO applied (level, code, item, amount, point_in_time, revid, written) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (level, code, item, amount, point_in_time, revid, time.time()))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self.connection.commit()
+                self._uncommitted = 0
+
+    def input_completed(self, level, digest):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM inputs WHERE level = ? AND digest = ?', (level, digest)).fetchone() is not None
+
+    def complete_input(self, level, digest):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO inputs (level, digest, completed) VALUES (?, ?, ?)', (level, digest, time.time()))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
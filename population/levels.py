@@ -0,0 +1,20 @@
+import importlib
+
+# Level name -> script defining it, in the order they are usually run
+LEVEL_SCRIPTS = {
+    'regions': 'regions',
+    'departements': 'departements_fastrun',
+    'arrondissements': 'arrondissements',
+    'cantons': 'cantons',
+    'communes': 'communes_fastrun',
+    'arrondissements_communes': 'arrondissements_communes',
+}
+
+
+def load_level(name):
+    """Import the script of a level, they only run when executed directly, and return its Level."""
+    return importlib.import_module(LEVEL_SCRIPTS[name]).level
+
+
+def load_levels(names=None):
+    return [load_level(name) for name in names or LEVEL_SCRIPTS]
@@ -0,0 +1,143 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+import config
+
+# Profile name -> (console level, event log level, sampling rate per event type, 1.0 when missing)
+PROFILES = {
+    'quiet': (logging.WARNING, logging.INFO, {'not_required': 0.1}),
+    'debug': (logging.DEBUG, logging.DEBUG, {}),
+}
+DEFAULT_PROFILE = 'quiet'
+
+logger = logging.getLogger('population')
+
+_listener = None
+_log_name = None
+_sampling = {}
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queue the record as it is: the message is formatted by the listener thread, not by the thread doing the work."""
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, the fields of an event are top-level keys."""
+
+    def format(self, record):
+        line = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName
+        }
+        event_name = getattr(record, 'event', None)
+        if event_name:
+            line['event'] = event_name
+            line.update(record.fields)
+        else:
+            line['message'] = record.getMessage()
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(message)s')
+
+    def formatMessage(self, record):
+        event_name = getattr(record, 'event', None)
+        if event_name:
+            record.message = event_name + ' ' + ' '.join(f'{key}={value}' for key, value in record.fields.items())
+        return super().formatMessage(record)
+
+
+def log_path(name):
+    return os.path.join(getattr(config, 'log_dir', 'logs'), config.year, name + '.jsonl')
+
+
+def _event_file(name, level):
+    path = log_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    event_file = logging.FileHandler(path, encoding='utf-8')
+    event_file.setLevel(level)
+    event_file.setFormatter(JsonFormatter())
+    return event_file
+
+
+def setup_logging(name, profile=None):
+    """Send the logs of the process through a queue to the console and to logs/<year>/<name>.jsonl.
+
+    profile is 'quiet' or 'debug', by default the POPULATION_LOG_PROFILE environment variable, then config.log_profile, then quiet.
+    The logging is set up once per process, a later call for another name only moves the events to its file, like a worker of
+    population.runner starting its next level.
+    """
+    global _listener, _log_name, _sampling
+    if _listener is not None:
+        if name != _log_name:
+            _switch_event_file(name)
+        return
+
+    profile = profile or os.environ.get('POPULATION_LOG_PROFILE') or getattr(config, 'log_profile', DEFAULT_PROFILE)
+    console_level, file_level, sampling = PROFILES[profile]
+    _sampling = dict(sampling, **getattr(config, 'log_sampling', {}))
+
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(ConsoleFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_LazyQueueHandler(log_queue))
+    root.setLevel(min(console_level, file_level))
+    # The HTTP libraries are very talkative in debug
+    for library in ('urllib3', 'requests'):
+        logging.getLogger(library).setLevel(max(logging.INFO, root.level))
+
+    _listener = logging.handlers.QueueListener(log_queue, console, _event_file(name, file_level), respect_handler_level=True)
+    _listener.start()
+    _log_name = name
+    atexit.register(stop_logging)
+
+
+def _switch_event_file(name):
+    """Write the events queued so far to the current file, then the next ones to the file of name."""
+    global _listener, _log_name
+    console, event_file = _listener.handlers
+    _listener.stop()
+    event_file.close()
+    _listener = logging.handlers.QueueListener(_listener.queue, console, _event_file(name, event_file.level), respect_handler_level=True)
+    _listener.start()
+    _log_name = name
+
+
+def stop_logging():
+    """Write what is still in the queue, called at exit."""
+    global _listener, _log_name
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        _log_name = None
+
+
+def event(name, level=logging.INFO, **fields):
+    """Log one structured event, like a row decision. Nothing is built when the level is disabled or the event is sampled out."""
+    if not logger.isEnabledFor(level):
+        return
+    rate = _sampling.get(name, 1.0)
+    if rate < 1.0 and random.random() >= rate:
+        return
+    if rate < 1.0:
+        fields['sample_rate'] = rate
+    logger.log(level, name, extra={'event': name, 'fields': fields})
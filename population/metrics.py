@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+
+class Histogram:
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, the exact max for the last one."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': round(self.total, 3),
+            'mean': round(self.total / self.count, 4) if self.count else 0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'max': round(self.max, 4)
+        }
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of the stages of a run, shared by the threads of the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}  # (name, ((label, value), ...)) -> count
+        self.gauges = {}  # name -> last value
+        self.histograms = {}  # stage -> Histogram
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed_iter(self, iterable, stage):
+        """Yield from iterable, the time spent producing each element goes to stage."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe(stage, time.perf_counter() - start)
+            yield element
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def summary(self, **info):
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                if labels:
+                    counters.setdefault(name, {})[','.join(f'{key}={label}' for key, label in labels)] = value
+                else:
+                    counters[name] = value
+            stages = {stage: histogram.summary() for stage, histogram in sorted(self.histograms.items())}
+            gauges = dict(sorted(self.gauges.items()))
+        summary = dict(info)
+        summary.update({'started': self.started, 'seconds': round(time.time() - self.started, 3), 'stages': stages, 'counters': counters, 'gauges': gauges})
+        return summary
+
+    def prometheus(self, **labels):
+        """Metrics in the Prometheus text format, for the node exporter textfile collector."""
+        common = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+        lines = [
+            '# HELP wd_population_run_seconds Duration of the run.',
+            '# TYPE wd_population_run_seconds gauge',
+            f'wd_population_run_seconds{{{common}}} {time.time() - self.started:.3f}',
+            '# HELP wd_population_stage_seconds Time spent in each stage.',
+            '# TYPE wd_population_stage_seconds histogram'
+        ]
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                stage_labels = f'{common},stage="{stage}"' if common else f'stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'wd_population_stage_seconds_bucket{{{stage_labels},le="{le}"}} {cumulative}')
+                lines.append(f'wd_population_stage_seconds_sum{{{stage_labels}}} {histogram.total:.6f}')
+                lines.append(f'wd_population_stage_seconds_count{{{stage_labels}}} {histogram.count}')
+
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f'# TYPE wd_population_{name}_total counter')
+                for (counter_name, counter_labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        all_labels = ','.join(filter(None, [common] + [f'{key}="{label}"' for key, label in counter_labels]))
+                        lines.append(f'wd_population_{name}_total{{{all_labels}}} {value}')
+
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f'# TYPE wd_population_{name} gauge')
+                lines.append(f'wd_population_{name}{{{common}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the current process
+metrics = Metrics()
+
+
+def summary_path(name):
+    return os.path.join(getattr(config, 'metrics_dir', 'metrics'), config.year, name + '.json')
+
+
+def report(name, mode='run'):
+    """Print the time spent per stage, save the JSON summary of the run and the Prometheus text file if config.prometheus_textfile is set."""
+    summary = metrics.summary(level=name, mode=mode, year=config.year)
+
+    for stage, stats in summary['stages'].items():
+        print(f"{stage:<20} {stats['count']:>8} x {stats['mean']:>8.4f}s = {stats['total']:>10.1f}s  p95 {stats['p95']:.3g}s  max {stats['max']:.3g}s")
+    for counter, value in summary['counters'].items():
+        print(f'{counter:<20} {value}')
+    for gauge, value in summary['gauges'].items():
+        print(f'{gauge:<20} {value}')
+
+    path = summary_path(name if mode == 'run' else f'{name}.{mode}')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+    textfile = getattr(config, 'prometheus_textfile', None)
+    if textfile:
+        # Written aside then renamed, the collector never reads a partial file
+        with open(textfile + '.tmp', 'w', encoding='utf-8') as prometheus_file:
+            prometheus_file.write(metrics.prometheus(level=name, mode=mode))
+        os.replace(textfile + '.tmp', textfile)
+
+    print("--- %s seconds ---" % summary['seconds'])
+    return summary
@@ -0,0 +1,532 @@
+import argparse
+import json
+import logging
+import os
+
+from wikibaseintegrator.wbi_exceptions import MWApiError
+
+import config
+from population import journal
+from population.dump import load_dump_state
+from population.extract import load_sparql_state
+from population.fake_wikibase import FakeWikibase, load_fixtures, use_fake_wikibase
+from population.insee_index import build_index, select_valid, state_key
+from population.journal import Journal, journal_path
+from population.ledger import Ledger, input_digest
+from population.logs import event, setup_logging
+from population.metrics import metrics, report
+from population.profiling import profiled
+from population.scheduler import ReadStage, WriteScheduler
+from population.schemas import get_schema, input_path, read_records
+from population.snapshots import SnapshotStore
+from population.state import FastrunState
+from population.wikidata import MAX_ENTITIES_PER_REQUEST, apply_plan_entry, get_entities, get_revisions, get_wbi, plan_population, point_in_time_for, stated_in_for, write_backfill, write_population
+
+
+# State sources of --source. sparql and dump keep packed claim fingerprints, fastrun a WikibaseIntegrator container with every claim object of
+# the base filter, several times larger in each process
+SOURCES = ['sparql', 'dump', 'fastrun']
+DEFAULT_SOURCE = 'sparql'
+
+
+class Level:
+    """Description of one administrative level: where to read it and how to find its items."""
+
+    def __init__(self, name, base_filter, insee_property, schema, select_item=None, record_filter=None, state_types=None):
+        self.name = name
+        self.base_filter = base_filter
+        self.insee_property = insee_property
+        # Name of the INSEE file schema in population.schemas
+        self.schema = schema
+        # select_item(code_insee, entities, candidates) -> (id_item, final_items), used when several items share an INSEE code,
+        # by default the items valid in the geography of the census by population.insee_index.select_valid
+        self.select_item = select_item
+        # record_filter(record) -> bool, records returning False are ignored
+        self.record_filter = record_filter
+        # Types (P31) of the items fetched by --source sparql, the levels with the same other base filter claims and state_types share one extraction
+        self.state_types = state_types
+
+    @staticmethod
+    def label(record):
+        if record.department is None:
+            return record.name
+        return f'{record.name} ({record.department})'
+
+
+class LazyIndex:
+    """INSEE index of a level, built or loaded from its snapshot the first time an INSEE code has several items."""
+
+    def __init__(self, level, snapshots, index=None):
+        self.level = level
+        self.snapshots = snapshots
+        self.key = state_key(level, 'index')
+        self.index = index
+
+    def resolve(self, code_insee, entities, point_in_time=None):
+        if self.index is None:
+            self.index = self.snapshots.load(self.key)
+            if self.index is None:
+                with metrics.time('index_build'):
+                    self.index = build_index(self.level)
+                self.snapshots.save(self.key, self.index)
+        return self.index.resolve(code_insee, entities, point_in_time)
+
+
+def open_journal(level, suffix='', restart=False):
+    path = journal_path(config.year, level.name + suffix)
+    if restart and os.path.exists(path):
+        os.remove(path)
+    level_journal = Journal(path)
+    if level_journal.outcomes:
+        print(f'Resuming from {path}, {len(level_journal.outcomes)} codes already processed')
+    return level_journal
+
+
+def plan_path(level):
+    return os.path.join(getattr(config, 'plan_dir', 'plans'), config.year, level.name + '.jsonl')
+
+
+def open_state(level, snapshots, source=DEFAULT_SOURCE, refresh_snapshot=False):
+    """Where the items of the level and their current population come from: the fastrun container, the dedicated SPARQL extraction or the last dump ingested."""
+    if source == 'sparql':
+        return load_sparql_state(level, snapshots, refresh=refresh_snapshot)
+    if source == 'dump':
+        state = load_dump_state(level, snapshots)
+        if state is None:
+            raise SystemExit(f'No dump state for {level.name}, run python -m population.dump first')
+        return state
+    return FastrunState(level, snapshots, refresh=refresh_snapshot)
+
+
+def read_rows(level, years=None):
+    """Yield (code_insee, population, label) for the rows of the level CSV of config.year.
+
+    With years, the files of these years are read and population maps each year to the population of the code that year.
+    """
+    if not years:
+        # The file is parsed by the first read of the process, the next levels reading it get its records
+        with metrics.time('csv_parse'):
+            records = read_records(get_schema(level.schema))
+        for record in records:
+            if not level.record_filter or level.record_filter(record):
+                yield record.code, record.population, level.label(record)
+        return
+
+    rows = {}
+    for year in sorted(years):
+        schema = get_schema(level.schema, year)
+        with metrics.time('csv_parse'):
+            records = read_records(schema, year=year)
+        for record in records:
+            if not level.record_filter or level.record_filter(record):
+                populations, _ = rows.get(record.code, ({}, None))
+                populations[year] = record.population
+                # The label of the latest year wins
+                rows[record.code] = (populations, level.label(record))
+    for code_insee, (populations, label) in rows.items():
+        yield code_insee, populations, label
+
+
+def _lookup(state, code_insee, population):
+    """state.lookup for one census, or for every census of a {year: population} dict: a write is required as soon as one of them is missing."""
+    if not isinstance(population, dict):
+        return state.lookup(code_insee, population)
+
+    latest = max(population)
+    entities, write_required = [], False
+    for year, amount in sorted(population.items(), reverse=True):
+        year_entities, year_required = state.lookup(code_insee, amount, point_in_time_for(year), stated_in_for(year), preferred=year == latest)
+        entities = entities or year_entities
+        write_required = write_required or year_required
+        if not entities or write_required:
+            break
+    return entities, write_required
+
+
+def _skip_applied(wbi, level, rows, level_journal, ledger):
+    """Drop the rows the ledger says were written with the same amount to an item nobody edited since, yield the others."""
+    waiting = []
+    for row in rows:
+        code_insee, population, label = row
+        applied = ledger.get(level.name, code_insee) if code_insee not in level_journal else None
+        if applied and applied[1] == population and applied[2] == config.point_in_time:
+            waiting.append((row, applied))
+            if len(waiting) >= MAX_ENTITIES_PER_REQUEST:
+                yield from _check_revisions(wbi, waiting, level_journal)
+                waiting = []
+        else:
+            yield row
+    yield from _check_revisions(wbi, waiting, level_journal)
+
+
+def _check_revisions(wbi, waiting, level_journal):
+    if not waiting:
+        return
+
+    with metrics.time('revision_check'):
+        revisions = get_revisions(wbi, [applied[0] for row, applied in waiting])
+    for row, (id_item, amount, point_in_time, revid) in waiting:
+        if revid and revisions.get(id_item) == revid:
+            event('not_required', code=row[0], label=row[2], items=[id_item], reason='ledger')
+            level_journal.record(row[0], journal.NOT_REQUIRED, id_item)
+        else:
+            metrics.count('ledger_revision_moved')
+            yield row
+
+
+def resolve_rows(wbi, level, level_journal, source=DEFAULT_SOURCE, refresh_snapshot=False, years=None, ledger=None):
+    """Read the CSV of the level and yield (code_insee, population, label, id_item, candidates) for each row needing a write.
+
+    candidates maps the ids fetched for the current batch of rows to their entity, the other outcomes are recorded in the journal.
+    The rows come in the order of the CSV. An item read ahead before an earlier write to it ended is written with its older revision, the edit
+    conflict makes the writer read it again and replay the change.
+    With years, population is a {year: population} dict, see read_rows.
+    With a ledger, the rows already written to an item which did not change since are not looked up again.
+    """
+    snapshots = SnapshotStore()
+    # Opened by the first row which needs it, a rerun answered by the ledger never loads the container
+    state = index = None
+
+    # Rows needing a write wait here until their candidates can be fetched in a single wbgetentities call
+    pending = []
+    pending_ids = set()
+    # The batches are fetched ahead on other threads while the writes of the previous ones drain, and come back in the CSV order
+    reads = ReadStage()
+    # Census whose geography the items have to be valid in, the latest year of a backfill
+    point_in_time = point_in_time_for(max(years)) if years else None
+
+    rows = read_rows(level, years)
+    if ledger:
+        rows = _skip_applied(wbi, level, rows, level_journal, ledger)
+
+    try:
+        print('Start parsing CSV')
+        for code_insee, population, label in rows:
+            if code_insee not in level_journal:
+                if state is None:
+                    state = open_state(level, snapshots, source=source, refresh_snapshot=refresh_snapshot)
+                    index = LazyIndex(level, snapshots, state.index)
+                    if refresh_snapshot:
+                        snapshots.invalidate(index.key)
+
+                with metrics.time('lookup'):
+                    entities, write_required = _lookup(state, code_insee, population)
+                if not entities:
+                    event('unresolved', code=code_insee, label=label, reason='no_item')
+                    level_journal.record(code_insee, journal.UNRESOLVED)
+                    continue
+
+                if write_required:
+                    if len(entities) > 1:
+                        # Only the item chosen by the index has to be fetched, the others are fetched to be compared if it cannot decide
+                        id_item = index.resolve(code_insee, entities, point_in_time)
+                        if id_item:
+                            entities = [id_item]
+
+                    if len(pending_ids | set(entities)) > MAX_ENTITIES_PER_REQUEST:
+                        for batch, candidates in reads.submit(_candidates_reader(wbi, pending_ids), pending):
+                            yield from _select_pending(level, batch, candidates, level_journal, point_in_time)
+                        pending, pending_ids = [], set()
+                    pending.append((code_insee, population, label, entities))
+                    pending_ids.update(entities)
+                else:
+                    event('not_required', code=code_insee, label=label, items=entities)
+                    level_journal.record(code_insee, journal.NOT_REQUIRED)
+
+        if pending:
+            for batch, candidates in reads.submit(_candidates_reader(wbi, pending_ids), pending):
+                yield from _select_pending(level, batch, candidates, level_journal, point_in_time)
+        for batch, candidates in reads.drain():
+            yield from _select_pending(level, batch, candidates, level_journal, point_in_time)
+    finally:
+        reads.close()
+        # Keep what was loaded even after a crash
+        if state is not None:
+            state.save()
+        snapshots.close()
+
+
+def _candidates_reader(wbi, ids):
+    """Read of the candidates of a batch of pending rows, one request for all of them, run by the read stage."""
+    def read():
+        with metrics.time('fetch_candidates'):
+            candidates = get_entities(wbi, ids)
+        metrics.count('candidates_fetched', len(candidates))
+        return candidates
+    return read
+
+
+def _select_pending(level, pending, candidates, level_journal, point_in_time=None):
+    """Pick the item of each pending row among its fetched candidates, the winners are reused for the write."""
+    for code_insee, population, label, entities in pending:
+        entities = [entity for entity in entities if entity in candidates]
+
+        id_item = None
+        final_items = entities.copy()
+
+        if len(entities) > 1:
+            if level.select_item:
+                id_item, final_items = level.select_item(code_insee, entities, candidates)
+            else:
+                id_item, final_items = select_valid(level, code_insee, entities, candidates, point_in_time)
+
+        if not id_item and len(final_items) == 1:  # if only one item remains, we take it
+            id_item = final_items.pop()
+
+        if id_item:
+            yield code_insee, population, label, id_item, candidates
+        else:
+            event('unresolved', code=code_insee, label=label, reason='ambiguous', items=final_items)
+            level_journal.record(code_insee, journal.UNRESOLVED)
+
+
+def run_level(level, source=DEFAULT_SOURCE, refresh_snapshot=False, restart=False, years=None):
+    """Resolve the rows and write the population as soon as an item is found, return the metrics summary.
+
+    With years, the censuses of all these years are written to each item in a single edit.
+    The writes of a single year are kept in the ledger: a run on an input identical to the last complete run stops at once.
+    """
+    setup_logging(level.name)
+
+    ledger = digest = None
+    if not years:
+        ledger = Ledger()
+        level_input = input_path(get_schema(level.schema))
+        digest = input_digest(level_input, config.point_in_time, config.stated_in)
+        if ledger.input_completed(level.name, digest) and not (restart or refresh_snapshot):
+            print(f'{level_input} did not change since the last complete run, nothing to do')
+            ledger.close()
+            return
+
+    wbi = get_wbi()
+
+    metrics.reset()
+    run_journal = open_journal(level, '.backfill' if years else '', restart=restart)
+    scheduler = WriteScheduler()
+    completed = False
+    try:
+        for code_insee, population, label, id_item, candidates in resolve_rows(wbi, level, run_journal, source=source, refresh_snapshot=refresh_snapshot, years=years,
+                                                                               ledger=ledger):
+            event('write', code=code_insee, label=label, item=id_item, population=population)
+            scheduler.submit(id_item, _population_writer(wbi, candidates, id_item, population),
+                             _write_done(run_journal, code_insee, id_item, ledger, (level.name, population, config.point_in_time)))
+        completed = True
+    finally:
+        # Let the queued writes finish before closing the journal
+        scheduler.close()
+        run_journal.close()
+        if ledger:
+            if completed and journal.ERROR not in run_journal.outcomes.values():
+                ledger.complete_input(level.name, digest)
+            ledger.close()
+        summary = report(level.name, 'backfill' if years else 'run')
+    if scheduler.fatal is not None:
+        raise scheduler.fatal
+    return summary
+
+
+def plan_level(level, output=None, source=DEFAULT_SOURCE, refresh_snapshot=False, restart=False):
+    """Resolve the rows without credentials and append the edits to a JSONL plan instead of writing them."""
+    wbi = get_wbi(anonymous=True)
+    output = output or plan_path(level)
+
+    setup_logging(level.name)
+
+    metrics.reset()
+    plan_journal = open_journal(level, '.plan', restart=restart)
+    if restart and os.path.exists(output):
+        os.remove(output)
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    try:
+        with open(output, 'a', encoding='utf-8') as plan_file:
+            for code_insee, population, label, id_item, candidates in resolve_rows(wbi, level, plan_journal, source=source, refresh_snapshot=refresh_snapshot):
+                event('planned', code=code_insee, label=label, item=id_item, population=population)
+                entry = {'level': level.name, 'code': code_insee, 'label': label}
+                entry.update(plan_population(candidates[id_item], population))
+                plan_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                # The line must be on the disk before the journal says it is planned
+                plan_file.flush()
+                plan_journal.record(code_insee, journal.PLANNED, id_item)
+    finally:
+        plan_journal.close()
+        summary = report(level.name, 'plan')
+
+    print(f'Plan written to {output}')
+    return summary
+
+
+def apply_plan(level, path=None, restart=False):
+    """Write the edits of a plan as they are, nothing is resolved again."""
+    wbi = get_wbi()
+    path = path or plan_path(level)
+
+    setup_logging(level.name)
+
+    metrics.reset()
+    apply_journal = open_journal(level, '.apply', restart=restart)
+    ledger = Ledger()
+    scheduler = WriteScheduler()
+    seen = set()
+    try:
+        with open(path, encoding='utf-8') as plan_file:
+            for line in plan_file:
+                entry = json.loads(line)
+                # A crash during the plan can leave the same code twice at the end of the file
+                if entry['code'] in apply_journal or entry['code'] in seen:
+                    continue
+                seen.add(entry['code'])
+
+                event('write', code=entry['code'], label=entry['label'], item=entry['item'], population=entry['amount'])
+                scheduler.submit(entry['item'], _plan_entry_writer(wbi, entry),
+                                 _write_done(apply_journal, entry['code'], entry['item'], ledger, (level.name, entry['amount'], entry['point_in_time'])))
+    finally:
+        scheduler.close()
+        apply_journal.close()
+        ledger.close()
+        summary = report(level.name, 'apply')
+    if scheduler.fatal is not None:
+        raise scheduler.fatal
+    return summary
+
+
+def _is_conflict(error):
+    return getattr(error, 'code', None) == 'editconflict'
+
+
+def _refetch(wbi, id_item):
+    """Read id_item again after an edit conflict, None if it is gone."""
+    metrics.count('edit_conflicts')
+    with metrics.time('conflict_refetch'):
+        return get_entities(wbi, [id_item]).get(id_item)
+
+
+def _population_writer(wbi, candidates, id_item, population):
+    """Write the population to candidates[id_item], against the revision it was fetched at.
+
+    On an edit conflict only this item is fetched again and the change is replayed on it, at most config.conflict_retries times.
+    """
+    def write(**kwargs):
+        for conflict in range(getattr(config, 'conflict_retries', 3) + 1):
+            # Read the entity when the write runs: an earlier row of the batch may have written the same item
+            try:
+                if isinstance(population, dict):
+                    candidates[id_item] = write_backfill(candidates[id_item], population, **kwargs)
+                else:
+                    candidates[id_item] = write_population(candidates[id_item], population, **kwargs)
+                return candidates[id_item]
+            except MWApiError as e:
+                if not _is_conflict(e) or conflict == getattr(config, 'conflict_retries', 3):
+                    raise
+                event('edit_conflict', logging.WARNING, item=id_item, retry=conflict + 1)
+                item = _refetch(wbi, id_item)
+                if item is None:
+                    raise
+                candidates[id_item] = item
+    return write
+
+
+def _plan_entry_writer(wbi, entry):
+    """Write a plan entry, on an edit conflict the planned amount is applied again to the current revision of the item."""
+    def write(**kwargs):
+        try:
+            return apply_plan_entry(wbi, entry, **kwargs)
+        except MWApiError as e:
+            # The claims of an entry made for another year cannot be rebuilt with the current config
+            if not _is_conflict(e) or entry['year'] != config.year:
+                raise
+            conflict_error = e
+
+        for conflict in range(getattr(config, 'conflict_retries', 3)):
+            event('edit_conflict', logging.WARNING, item=entry['item'], retry=conflict + 1)
+            item = _refetch(wbi, entry['item'])
+            if item is None:
+                break
+            try:
+                return write_population(item, entry['amount'], **kwargs)
+            except MWApiError as e:
+                if not _is_conflict(e):
+                    raise
+                conflict_error = e
+        raise conflict_error
+    return write
+
+
+def _revision(result):
+    """Revision created by a write: the entity returned by write_population or the wbeditentity response of a plan entry."""
+    if isinstance(result, dict):
+        return result.get('entity', {}).get('lastrevid')
+    return getattr(result, 'lastrevid', None)
+
+
+def _write_done(level_journal, code_insee, id_item, ledger=None, applied=None):
+    """Callback recording the outcome of a write, and with a ledger the applied (level name, amount, point in time)."""
+    def callback(result, error):
+        if error:
+            event('write_error', logging.WARNING, code=code_insee, item=id_item, error=error)
+            level_journal.record(code_insee, journal.ERROR, id_item)
+        else:
+            revid = _revision(result)
+            event('written', code=code_insee, item=id_item, revid=revid)
+            if ledger:
+                level_name, amount, point_in_time = applied
+                ledger.record(level_name, code_insee, id_item, amount, point_in_time, revid)
+            level_journal.record(code_insee, journal.WRITTEN, id_item)
+    return callback
+
+
+def backfill_years(years=None):
+    """Years of a backfill, years or those of config.stated_in_by_year, exit at once when one has no "stated in" item."""
+    years = years or sorted(getattr(config, 'stated_in_by_year', {}))
+    if not years:
+        raise SystemExit('No year to backfill, use --years or stated_in_by_year in config.py')
+    for year in years:
+        try:
+            stated_in_for(year)
+        except KeyError as e:
+            raise SystemExit(e.args[0])
+    return years
+
+
+def main(level):
+    parser = argparse.ArgumentParser(description='Update the population of the items of this level from the INSEE CSV.')
+    parser.add_argument('mode', nargs='?', choices=['run', 'plan', 'apply', 'backfill'], default='run',
+                        help='run: resolve and write, plan: resolve and save the edits without writing, apply: write a saved plan, '
+                             'backfill: write the censuses of several years in one edit per item')
+    parser.add_argument('--years', nargs='+', help='census years of the backfill, default the years of stated_in_by_year in config.py')
+    parser.add_argument('--plan', help='plan file, default plans/<year>/<level>.jsonl')
+    parser.add_argument('--source', choices=SOURCES, default=DEFAULT_SOURCE,
+                        help='read the current state from the paginated extraction of population.extract (default) or from the last dump ingested by population.dump, '
+                             'both kept as compact claim fingerprints, or from a fastrun container, which holds every claim object in memory')
+    parser.add_argument('--refresh-snapshot', action='store_true', help='ignore and rebuild the snapshot of the state')
+    parser.add_argument('--restart', action='store_true', help='forget the journal of the previous run and process every row again')
+    parser.add_argument('--log-profile', choices=['quiet', 'debug'], help='quiet: warnings on the console and row decisions in logs/<year>/<level>.jsonl, debug: everything')
+    parser.add_argument('--fake', metavar='FIXTURES', help='run against a local fake Wikibase serving these entities instead of Wikidata')
+    parser.add_argument('--profile', nargs='?', const='sample', choices=['sample', 'cprofile'],
+                        help='profile the run, sampling all the threads (default) or with cProfile, and write profiles/<year>/<level>.txt and the stacks')
+    args = parser.parse_args()
+
+    fake = None
+    if args.fake:
+        fake = use_fake_wikibase(FakeWikibase(load_fixtures(args.fake)).start())
+
+    setup_logging(level.name, args.log_profile)
+
+    try:
+        with profiled(level.name if args.mode == 'run' else f'{level.name}.{args.mode}', args.profile):
+            _run_mode(level, args)
+    finally:
+        if fake:
+            fake.stop()
+
+
+def _run_mode(level, args):
+    if args.mode == 'plan':
+        plan_level(level, output=args.plan, source=args.source, refresh_snapshot=args.refresh_snapshot, restart=args.restart)
+    elif args.mode == 'apply':
+        apply_plan(level, path=args.plan, restart=args.restart)
+    elif args.mode == 'backfill':
+        run_level(level, source=args.source, refresh_snapshot=args.refresh_snapshot, restart=args.restart, years=backfill_years(args.years))
+    else:
+        run_level(level, source=args.source, refresh_snapshot=args.refresh_snapshot, restart=args.restart)
@@ -0,0 +1,181 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+# Stage of a sample: the first rule matching a frame of its stack, from the innermost frame, wins. (stage, file path part, function names or None for any)
+STAGE_RULES = (
+    ('rate_limit', ('population/scheduler.py',), {'acquire', '_wait_until_resumed'}),
+    ('http', ('socket.py', 'ssl.py', 'http/client.py', 'urllib3/'), None),
+    ('deserialization', ('json/', 'orjson', 'wikibaseintegrator/entities/', 'wikibaseintegrator/models/'), None),
+    ('lookup', ('wikibaseintegrator/wbi_fastrun.py', 'population/state.py', 'population/insee_index.py'), None),
+    ('csv_parse', ('population/schemas.py', 'population/archives.py', 'csv.py', 'zipfile'), None),
+)
+# Files of the innermost frame of a thread with nothing to do
+IDLE_FILES = ('threading.py', 'queue.py', 'concurrent/futures/', 'selectors.py', 'socketserver.py')
+
+TOP = 30
+
+
+def profile_path(name, extension):
+    return os.path.join(getattr(config, 'profile_dir', 'profiles'), config.year, f'{name}.{extension}')
+
+
+def _frame_name(code):
+    return f'{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}'
+
+
+def stage_of(codes):
+    """Stage of a stack of code objects, innermost last, see STAGE_RULES."""
+    for code in reversed(codes):
+        path = code.co_filename.replace('\\', '/')
+        for stage, parts, functions in STAGE_RULES:
+            if any(part in path for part in parts) and (functions is None or code.co_name in functions):
+                return stage
+    return 'other'
+
+
+class Sampler:
+    """Sampling profiler: a thread records the stacks of all the other threads every interval seconds.
+
+    Nothing is added to the code being profiled, so the threads of the read stage and of the write scheduler are measured as they run.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}  # (thread group, code objects from the outermost) -> samples
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.seconds = time.perf_counter() - self.started
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                # write_0, write_1... are one group
+                key = (names.get(thread_id, 'thread').rstrip('0123456789').rstrip('_'), tuple(reversed(codes)))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def collapsed(self):
+        """Lines 'thread;outer;...;inner samples' for flamegraph.pl or speedscope."""
+        lines = {}
+        for (group, codes), count in self.stacks.items():
+            line = ';'.join([group] + [_frame_name(code) for code in codes])
+            lines[line] = lines.get(line, 0) + count
+        return ''.join(f'{line} {count}\n' for line, count in sorted(lines.items()))
+
+    def table(self, top=TOP):
+        """Samples per stage, then the top functions by own and total samples, idle threads left out."""
+        stages = {}
+        own = {}
+        total = {}
+        busy = 0
+        for (group, codes), count in self.stacks.items():
+            if not codes or any(part in codes[-1].co_filename.replace('\\', '/') for part in IDLE_FILES):
+                continue
+            busy += count
+            stage = stage_of(codes)
+            stages[stage] = stages.get(stage, 0) + count
+            leaf = _frame_name(codes[-1])
+            own[leaf] = own.get(leaf, 0) + count
+            for name in {_frame_name(code) for code in codes}:
+                total[name] = total.get(name, 0) + count
+
+        def seconds(count):
+            return count * self.seconds / self.samples if self.samples else 0.0
+
+        lines = [f'{self.samples} samples over {self.seconds:.1f}s, {busy} busy thread samples', '', f"{'stage':<20} {'seconds':>10} {'share':>7}"]
+        for stage, count in sorted(stages.items(), key=lambda item: -item[1]):
+            lines.append(f'{stage:<20} {seconds(count):>10.2f} {count / busy:>7.1%}')
+        lines += ['', f"{'own':>8} {'total':>8}  function"]
+        for name, count in sorted(own.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f'{seconds(count):>8.2f} {seconds(total[name]):>8.2f}  {name}')
+        return '\n'.join(lines) + '\n'
+
+
+def _cprofile_table(profile, top=TOP):
+    """Time per stage from the cumulative time of the functions of each stage, then the top functions by own time."""
+    stats = pstats.Stats(profile)
+    stages = {}
+    for (filename, _, function), (_, _, own_time, cumulative, callers) in stats.stats.items():
+        path = filename.replace('\\', '/')
+        for stage, parts, functions in STAGE_RULES:
+            if any(part in path for part in parts) and (functions is None or function in functions):
+                # Only the entry points of a stage, the calls from inside it are already in their cumulative time
+                if not any(any(part in caller[0].replace('\\', '/') for part in parts) for caller in callers):
+                    stages[stage] = stages.get(stage, 0.0) + cumulative
+                break
+
+    output = io.StringIO()
+    output.write(f"{'stage':<20} {'seconds':>10}\n")
+    for stage, seconds in sorted(stages.items(), key=lambda item: -item[1]):
+        output.write(f'{stage:<20} {seconds:>10.2f}\n')
+    output.write('\n')
+    pstats.Stats(profile, stream=output).sort_stats('tottime').print_stats(top)
+    return output.getvalue()
+
+
+@contextmanager
+def profiled(name, mode='sample'):
+    """Profile the block and write profiles/<year>/<name>.txt with the time per stage and the hot functions.
+
+    mode 'sample' also writes <name>.collapsed, the sampled stacks of every thread; 'cprofile', or 'sample' without sys._current_frames, writes
+    <name>.pstats, which only measures the main thread.
+    """
+    if not mode:
+        yield
+        return
+
+    path = profile_path(name, 'txt')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if mode == 'sample' and hasattr(sys, '_current_frames'):
+        sampler = Sampler(getattr(config, 'profile_interval', 0.005))
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            with open(profile_path(name, 'collapsed'), 'w', encoding='utf-8') as collapsed_file:
+                collapsed_file.write(sampler.collapsed())
+            table = sampler.table()
+            with open(path, 'w', encoding='utf-8') as table_file:
+                table_file.write(table)
+            print(table)
+            print(f"Profile written to {path} and {profile_path(name, 'collapsed')}")
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(profile_path(name, 'pstats'))
+        table = _cprofile_table(profile)
+        with open(path, 'w', encoding='utf-8') as table_file:
+            table_file.write(table)
+        print(table)
+        print(f"Profile written to {path} and {profile_path(name, 'pstats')}")
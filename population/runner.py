@@ -0,0 +1,193 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from types import SimpleNamespace
+
+import config
+from population import scheduler, schemas, wikidata
+from population.extract import STATE_KIND
+from population.fake_wikibase import FakeWikibase, load_fixtures, use_fake_wikibase
+from population.insee_index import state_key
+from population.levels import LEVEL_SCRIPTS, load_level
+from population.logs import setup_logging
+from population.metrics import summary_path
+from population.pipeline import DEFAULT_SOURCE, SOURCES, apply_plan, backfill_years, plan_level, run_level
+from population.scheduler import SharedTokenBucket
+
+MODES = ['run', 'plan', 'apply', 'backfill']
+
+_log_profile = None
+
+
+def _init_worker(bucket, login_lock, fake_urls, log_profile, inputs):
+    """Runs in each worker process before its first level."""
+    global _log_profile
+    _log_profile = log_profile
+    schemas.use_inputs(inputs)
+    if fake_urls:
+        use_fake_wikibase(SimpleNamespace(api_url=fake_urls[0], sparql_url=fake_urls[1]))
+    scheduler.use_shared_bucket(bucket)
+    wikidata.use_login_lock(login_lock)
+
+
+def _run_worker(name, mode, options):
+    """Run one level in a worker process and return its metrics summary."""
+    level = load_level(name)
+    setup_logging(name, _log_profile)
+    if mode == 'plan':
+        return plan_level(level, source=options['source'], refresh_snapshot=options['refresh_snapshot'], restart=options['restart'])
+    if mode == 'apply':
+        return apply_plan(level, restart=options['restart'])
+    return run_level(level, source=options['source'], refresh_snapshot=options['refresh_snapshot'], restart=options['restart'], years=options['years'])
+
+
+def preload_inputs(names, years=None):
+    """Read the INSEE files of the levels names once for all the processes, return (inputs, {level name: error}) for the levels whose file cannot be read.
+
+    A missing file or a bad row fails its own level only, the others run.
+    """
+    try:
+        return schemas.preload_inputs([load_level(name).schema for name in names], years), {}
+    except Exception:
+        pass
+    # Level by level to find the failing ones, the tables read before the failure are not read again
+    inputs = {}
+    failed = {}
+    for name in names:
+        try:
+            inputs.update(schemas.preload_inputs([load_level(name).schema], years))
+        except Exception:
+            failed[name] = {'error': traceback.format_exc()}
+            print(f'{name} failed:\n{failed[name]["error"]}')
+    return inputs, failed
+
+
+def run_levels(names, mode='run', processes=None, source=DEFAULT_SOURCE, refresh_snapshot=False, restart=False, years=None, log_profile=None, fake_urls=None):
+    """Run levels in parallel processes sharing one edit budget and one login, return {level name: summary or error}.
+
+    The first process to write logs in and saves the session, the others wait for it and reuse it; nobody logs in when nothing is written.
+
+    communes is started first, with fewer processes than levels the shorter ones run while it goes on.
+    """
+    context = multiprocessing.get_context('spawn')
+    bucket = SharedTokenBucket(getattr(config, 'edits_per_minute', 60) / 60, burst=getattr(config, 'write_workers', 4), context=context)
+    login_lock = context.Lock()
+    options = {'source': source, 'refresh_snapshot': refresh_snapshot, 'restart': restart, 'years': years}
+    # The INSEE files are read once here for all the levels instead of once per process, communes and the municipal arrondissements share theirs
+    inputs, results = preload_inputs(names, years) if mode != 'apply' else ({}, {})
+
+    ordered = sorted((name for name in names if name not in results), key=lambda name: name != 'communes')
+    if not ordered:
+        return results
+
+    # Levels sharing their extracted state start when the first of them is done and has saved it, instead of extracting it again at the same time
+    followers = {}
+    if source == 'sparql' and mode != 'apply':
+        first = {}
+        for name in ordered:
+            key = state_key(load_level(name), STATE_KIND)
+            if key in first:
+                followers.setdefault(first[key], []).append(name)
+            else:
+                first[key] = name
+        ordered = list(first.values())
+
+    with ProcessPoolExecutor(max_workers=processes or len(ordered), mp_context=context, initializer=_init_worker,
+                             initargs=(bucket, login_lock, fake_urls, log_profile, inputs)) as executor:
+        futures = {executor.submit(_run_worker, name, mode, options): name for name in ordered}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    results[name] = {'error': traceback.format_exc()}
+                    print(f'{name} failed:\n{results[name]["error"]}')
+                else:
+                    print(f'{name} done')
+                for follower in followers.pop(name, []):
+                    futures[executor.submit(_run_worker, follower, mode, options)] = follower
+    return results
+
+
+def aggregate(results, mode, seconds):
+    """One report for all the levels: duration, rows per outcome and edit rate of each level, the counters summed and the edit rate of all the levels."""
+    report = {'mode': mode, 'year': config.year, 'seconds': round(seconds, 3), 'levels': {}, 'counters': {}}
+    for name, summary in results.items():
+        if summary is None:  # Nothing to do, the ledger knew the input
+            report['levels'][name] = {'skipped': True}
+            continue
+        if 'error' in summary:
+            report['levels'][name] = {'error': summary['error']}
+            continue
+        report['levels'][name] = {'seconds': summary['seconds'], 'rows': summary['counters'].get('rows', {}),
+                                  'edits_per_minute': summary.get('gauges', {}).get('edits_per_minute', 0.0)}
+        for counter, value in summary['counters'].items():
+            if isinstance(value, dict):
+                total = report['counters'].setdefault(counter, {})
+                for label, count in value.items():
+                    total[label] = total.get(label, 0) + count
+            else:
+                report['counters'][counter] = report['counters'].get(counter, 0) + value
+    report['edits_per_minute'] = round(report['counters'].get('edits', 0) * 60 / seconds, 1) if seconds > 0 else 0.0
+    return report
+
+
+def print_report(report):
+    for name, level_report in report['levels'].items():
+        if 'error' in level_report:
+            print(f'{name:<26} failed')
+        elif level_report.get('skipped'):
+            print(f'{name:<26} input unchanged')
+        else:
+            rows = ', '.join(f'{label.split("=", 1)[1]} {count}' for label, count in sorted(level_report['rows'].items()))
+            print(f"{name:<26} {level_report['seconds']:>10.1f}s  {level_report['edits_per_minute']:>7.1f} edits/minute  {rows}")
+    for counter, value in report['counters'].items():
+        print(f'{counter:<26} {value}')
+    print(f"{'edits_per_minute':<26} {report['edits_per_minute']}")
+    print("--- %s seconds ---" % report['seconds'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several levels at once, in parallel processes sharing one edit budget and one login.')
+    parser.add_argument('mode', nargs='?', choices=MODES, default='run')
+    parser.add_argument('--levels', nargs='+', choices=list(LEVEL_SCRIPTS), help='levels to run, all by default')
+    parser.add_argument('--processes', type=int, help='levels running at the same time, all by default')
+    parser.add_argument('--years', nargs='+', help='census years of the backfill, default the years of stated_in_by_year in config.py')
+    parser.add_argument('--source', choices=SOURCES, default=DEFAULT_SOURCE, help='see the level scripts, a fastrun container is held by every process')
+    parser.add_argument('--refresh-snapshot', action='store_true')
+    parser.add_argument('--restart', action='store_true')
+    parser.add_argument('--log-profile', choices=['quiet', 'debug'])
+    parser.add_argument('--fake', metavar='FIXTURES', help='run against a local fake Wikibase serving these entities instead of Wikidata')
+    args = parser.parse_args()
+
+    fake = None
+    urls = None
+    if args.fake:
+        fake = use_fake_wikibase(FakeWikibase(load_fixtures(args.fake)).start())
+        urls = (fake.api_url, fake.sparql_url)
+
+    setup_logging('runner', args.log_profile)
+
+    years = backfill_years(args.years) if args.mode == 'backfill' else None
+
+    start_time = time.time()
+    try:
+        level_results = run_levels(args.levels or list(LEVEL_SCRIPTS), args.mode, processes=args.processes, source=args.source, refresh_snapshot=args.refresh_snapshot,
+                                   restart=args.restart, years=years, log_profile=args.log_profile, fake_urls=urls)
+    finally:
+        if fake:
+            fake.stop()
+
+    run_report = aggregate(level_results, args.mode, time.time() - start_time)
+    print_report(run_report)
+
+    path = summary_path(f'all.{args.mode}')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as report_file:
+        json.dump(run_report, report_file, indent=2)
@@ -0,0 +1,269 @@
+import logging
+import multiprocessing
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from wikibaseintegrator.wbi_exceptions import MaxRetriesReachedException, MWApiError
+from wikibaseintegrator.wbi_login import LoginError
+
+import config
+from population import transport
+from population.metrics import metrics
+
+# API error codes meaning "slow down", the write is retried after a pause
+THROTTLE_CODES = {'maxlag', 'ratelimited', 'actionthrottled'}
+
+
+class TokenBucket:
+    """Thread-safe token bucket, rate is in tokens per second."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SharedTokenBucket:
+    """Token bucket kept in shared memory, one edit budget for the writes of several processes.
+
+    Created by the parent with a multiprocessing context and handed to the workers when they start.
+    """
+
+    def __init__(self, rate, burst=1, context=multiprocessing):
+        self.max_rate = rate
+        self.burst = burst
+        self._rate = context.Value('d', rate, lock=False)
+        self._tokens = context.Value('d', burst, lock=False)
+        # Wall clock, the monotonic clocks of two processes are not comparable everywhere
+        self._updated = context.Value('d', time.time(), lock=False)
+        self.lock = context.Lock()
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    @rate.setter
+    def rate(self, value):
+        with self.lock:
+            self._rate.value = value
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                tokens = min(self.burst, self._tokens.value + max(0.0, now - self._updated.value) * self._rate.value)
+                self._updated.value = now
+                if tokens >= 1:
+                    self._tokens.value = tokens - 1
+                    return
+                self._tokens.value = tokens
+                wait = (1 - tokens) / self._rate.value
+            time.sleep(wait)
+
+
+# Budget shared with the other processes of population.runner, set in the workers by use_shared_bucket
+shared_bucket = None
+
+
+def use_shared_bucket(bucket):
+    global shared_bucket
+    shared_bucket = bucket
+
+
+class WriteScheduler:
+    """Run the writes in a pool of threads while keeping under an edit rate budget.
+
+    The rate is halved and every worker pauses when the API answers with maxlag or a rate limit, at least for the Retry-After of the answer, then
+    it goes back up slowly on success.
+    Writes to the same item are never run concurrently. When the process is a worker of population.runner, the edit rate is the one shared by all
+    the workers. A failed login stops the level: the next submit raises its LoginError, kept in fatal.
+    """
+
+    def __init__(self, max_in_flight=None, edits_per_minute=None, max_attempts=5):
+        self.max_in_flight = max_in_flight or getattr(config, 'write_workers', 4)
+        self.max_rate = (edits_per_minute or getattr(config, 'edits_per_minute', 60)) / 60
+        self.max_attempts = max_attempts
+        # First pause after a throttle error, doubled at each new attempt
+        self.pause = getattr(config, 'throttle_pause', 5)
+
+        if shared_bucket is not None:
+            self.bucket = shared_bucket
+            self.max_rate = shared_bucket.max_rate
+        else:
+            self.bucket = TokenBucket(self.max_rate, burst=self.max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='write')
+        # Limit the number of queued writes, each one holds a full entity
+        self.slots = threading.BoundedSemaphore(self.max_in_flight * 4)
+
+        self.lock = threading.Lock()
+        self.item_locks = {}
+        self.paused_until = 0
+        self.edits = 0
+        self.throttled = 0
+        self.failed = 0
+        self.fatal = None
+        self.started = time.monotonic()
+        self.recent_edits = deque()
+
+    def submit(self, id_item, write, callback):
+        """Queue write() for id_item, callback(result, error) is called from the worker thread once it is done."""
+        if self.fatal is not None:
+            raise self.fatal
+        self.slots.acquire()
+        self.executor.submit(self._run, id_item, write, callback)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        metrics.gauge('edits_per_minute', round(self.average_edits_per_minute(), 1))
+        logging.info('%d edits, %d throttled, %d failed, %.1f edits/minute', self.edits, self.throttled, self.failed, self.average_edits_per_minute())
+
+    def edits_per_minute(self):
+        """Edits done during the last minute."""
+        with self.lock:
+            self._forget_old_edits(time.monotonic())
+            return len(self.recent_edits)
+
+    def average_edits_per_minute(self):
+        elapsed = time.monotonic() - self.started
+        return self.edits * 60 / elapsed if elapsed > 0 else 0.0
+
+    def _run(self, id_item, write, callback):
+        try:
+            with self._item_lock(id_item):
+                try:
+                    result, error = self._write_with_retries(write)
+                except LoginError as e:
+                    # Every other write would fail the same way
+                    logging.error('Login failed, stopping the writes: %s', e)
+                    metrics.count('api_errors', code=type(e).__name__)
+                    with self.lock:
+                        self.failed += 1
+                        self.fatal = e
+                    result, error = None, e
+                except Exception as e:
+                    # Not an API error: a bug, or a connection still failing after the retries of the transport. The row is recorded as failed
+                    logging.exception('Write failed for %s', id_item)
+                    metrics.count('api_errors', code=type(e).__name__)
+                    with self.lock:
+                        self.failed += 1
+                    result, error = None, e
+                try:
+                    callback(result, error)
+                except Exception:
+                    logging.exception('Write callback failed for %s', id_item)
+        finally:
+            self.slots.release()
+
+    def _item_lock(self, id_item):
+        with self.lock:
+            return self.item_locks.setdefault(id_item, threading.Lock())
+
+    def _write_with_retries(self, write):
+        for attempt in range(1, self.max_attempts + 1):
+            self._wait_until_resumed()
+            self.bucket.acquire()
+            metrics.count('write_attempts')
+            if attempt > 1:
+                metrics.count('write_retries')
+            try:
+                # One try inside the library: it sleeps for Retry-After and gives the hand back to us
+                with metrics.time('write'):
+                    result = write(max_retries=1)
+            except (MWApiError, MaxRetriesReachedException) as e:
+                metrics.count('api_errors', code=getattr(e, 'code', None) or type(e).__name__)
+                if not self._is_throttle(e) or attempt == self.max_attempts:
+                    with self.lock:
+                        self.failed += 1
+                    return None, e
+                self._slow_down(attempt, e, transport.retry_after())
+                continue
+
+            self._speed_up()
+            return result, None
+
+    @staticmethod
+    def _is_throttle(error):
+        return isinstance(error, MaxRetriesReachedException) or getattr(error, 'code', None) in THROTTLE_CODES
+
+    def _wait_until_resumed(self):
+        while True:
+            wait = self.paused_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _slow_down(self, attempt, error, retry_after=None):
+        pause = max(retry_after or 0, min(300, self.pause * 2 ** (attempt - 1)) * random.uniform(1, 1.5))
+        with self.lock:
+            self.throttled += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self.bucket.rate = max(self.max_rate / 16, self.bucket.rate / 2)
+        logging.warning('Throttled by the API (%s), pausing writes for %.0f seconds, %.1f edits/minute, %d edits during the last minute', error, pause,
+                        self.bucket.rate * 60, self.edits_per_minute())
+
+    def _speed_up(self):
+        now = time.monotonic()
+        metrics.count('edits')
+        with self.lock:
+            self.edits += 1
+            self.recent_edits.append(now)
+            self._forget_old_edits(now)
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 20)
+
+    def _forget_old_edits(self, now):
+        while self.recent_edits and self.recent_edits[0] < now - 60:
+            self.recent_edits.popleft()
+
+
+class ReadStage:
+    """Run reads on a pool of threads ahead of their use, separately from the writes, and give their results back in the order they were submitted.
+
+    Reads are not limited by the edit rate: read_workers (default 4) run at once, and at most read_ahead (default twice read_workers) are
+    waiting to be used, so the rows read ahead stay bounded while the writes drain.
+    """
+
+    def __init__(self, workers=None, ahead=None):
+        self.workers = workers or getattr(config, 'read_workers', 4)
+        self.ahead = ahead or getattr(config, 'read_ahead', self.workers * 2)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='read')
+        self.pending = deque()
+
+    def submit(self, read, context):
+        """Start read() and yield the (context, result) of the oldest reads which are done or can no longer wait."""
+        self.pending.append((context, self.executor.submit(read)))
+        while self.pending and (len(self.pending) > self.ahead or self.pending[0][1].done()):
+            yield self._next()
+
+    def drain(self):
+        """Yield the (context, result) of all the reads left, in order."""
+        while self.pending:
+            yield self._next()
+
+    def _next(self):
+        context, future = self.pending.popleft()
+        with metrics.time('read_wait'):
+            result = future.result()
+        return context, result
+
+    def close(self):
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,303 @@
+import csv
+import glob
+import os
+from collections import namedtuple
+from operator import itemgetter
+
+import config
+from population.archives import iter_archive_tables
+
+Record = namedtuple('Record', ['code', 'population', 'name', 'department'])
+
+# Rows read before giving up on finding the header line
+HEADER_SEARCH_ROWS = 20
+
+
+class Schema:
+    """Columns of one INSEE file, found by their header name.
+
+    columns is the (code, population, name, department) positions used when the file has no recognizable header.
+    sheets are the names of the same table in the xlsx workbooks, local_code the headers of a code given without its département, as they do.
+    """
+
+    def __init__(self, filename, code, name, columns, department=None, population=('PMUN', 'Population municipale'), width=None, sheets=(), local_code=()):
+        self.filename = filename
+        self.code = code
+        self.name = name
+        self.department = department
+        self.population = population
+        self.columns = columns
+        # Codes are left-padded with zeros to this width when a spreadsheet dropped them
+        self.width = width
+        self.sheets = sheets
+        self.local_code = local_code
+
+    def compile(self, header):
+        """Return an itemgetter extracting (code, population, name, department) from the rows under header, None if header is not ours."""
+        header = [column.strip() for column in header]
+        code = _find(header, self.code)
+        positions = [code if code is not None else _find(header, self.local_code), _find(header, self.population), _find(header, self.name)]
+        if None in positions:
+            return None
+        if self.department:
+            positions.append(_find(header, self.department))
+            if positions[-1] is None:
+                return None
+        if code is None:
+            if not self.department:
+                return None
+            return _with_department(itemgetter(*positions), self.width)
+        return itemgetter(*positions)
+
+    def positional(self):
+        return itemgetter(*[column for column in self.columns if column is not None])
+
+
+def _find(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def _with_department(extract, width):
+    """Wrap extract to prefix the local code with its département, '01' and '004' -> '01004', '971' and '101' -> '97101'."""
+    def extract_full_code(row):
+        code, population, name, department = extract(row)
+        code = code.strip()
+        department = normalize_department(department)
+        if width and code.isdigit():
+            # Leading zeros a spreadsheet dropped, 4 -> 004 for a commune
+            code = code.zfill(width - 2)
+        full_code = department + code
+        if width and len(full_code) > width:
+            full_code = department[:max(width - len(code), 0)] + code
+        return full_code, population, name, department
+    return extract_full_code
+
+
+SCHEMAS = {
+    'regions': Schema('donnees_regions.csv', code=('REG', 'Code région'), name=('Région', 'Nom de la région'), columns=(0, 5, 1, None), width=2, sheets=('Régions',)),
+    'departements': Schema('donnees_departements.csv', code=('DEP', 'Code département'), name=('Département', 'Nom du département'), department=('DEP', 'Code département'),
+                           columns=(2, 7, 3, 2), width=2, sheets=('Départements',)),
+    'arrondissements': Schema('donnees_arrondissements.csv', code=('ARR',), name=('Arrondissement', "Nom de l'arrondissement"), department=('DEP', 'Code département'),
+                              columns=(5, 8, 6, 2), width=3, sheets=('Arrondissements',), local_code=('Code arrondissement',)),
+    'cantons': Schema('donnees_cantons.csv', code=('CAN',), name=('Canton', 'Nom du canton'), department=('DEP', 'Code département'), columns=(4, 7, 5, 2), width=4,
+                      sheets=('Cantons et métropoles', 'Cantons'), local_code=('Code canton',)),
+    'communes': Schema('donnees_communes.csv', code=('COM',), name=('Commune', 'Nom de la commune'), department=('DEP', 'Code département'), columns=(6, 8, 7, 2), width=5,
+                       sheets=('Communes',), local_code=('Code commune',)),
+}
+
+# Départements of Corsica, numbered 20 before 1976: a code of theirs saved as a number by a spreadsheet reads 20xxx
+CORSICA = ('2A', '2B')
+
+# INSEE codes of the municipal arrondissements of Paris (751xx), Lyon (6938x) and Marseille (132xx), listed in the communes file
+MUNICIPAL_ARRONDISSEMENT_PREFIXES = ('751', '6938', '132')
+
+# Archives published by INSEE, read when the CSV file of a level is not in annees/<year>/
+ARCHIVE_PATTERNS = ('*.zip', '*.xlsx')
+
+# Files of a given year which do not follow the default schema, keyed by (schema name, year)
+YEAR_SCHEMAS = {}
+
+
+def is_municipal_arrondissement(code):
+    return code.startswith(MUNICIPAL_ARRONDISSEMENT_PREFIXES)
+
+
+def get_schema(name, year=None):
+    year = year or config.year
+    return YEAR_SCHEMAS.get((name, year), SCHEMAS[name])
+
+
+def schema_path(schema, year=None):
+    return os.path.join('annees', year or config.year, schema.filename)
+
+
+def archive_path(year=None):
+    """INSEE archive (zip or xlsx) of annees/<year>/, config.archive_path for config.year, None when there is none."""
+    year = year or config.year
+    if year == config.year and getattr(config, 'archive_path', None):
+        return config.archive_path
+    for pattern in ARCHIVE_PATTERNS:
+        paths = sorted(glob.glob(os.path.join('annees', year, pattern)))
+        if paths:
+            return paths[0]
+    return None
+
+
+def input_path(schema, year=None):
+    """File the records of schema are read from: its CSV file, else the archive of the year."""
+    path = schema_path(schema, year)
+    if os.path.exists(path):
+        return path
+    return archive_path(year) or path
+
+
+def read_records(schema, path=None, year=None):
+    """Rows of an INSEE CSV file, or the table of schema in the INSEE archive of year, as Record, with a normalized code and the population as an int.
+
+    A file is parsed once per process: the levels reading the same file, like communes and the municipal arrondissements, share its records.
+    """
+    return read_input(schema, path or input_path(schema, year), year)
+
+
+# (path, modification time) -> {CSV file name: [Record]} of the tables already read by this process
+_inputs = {}
+
+
+def _input_key(path):
+    return os.path.abspath(path), os.path.getmtime(path)
+
+
+def _is_archive(path):
+    return path.lower().endswith(('.zip', '.xlsx'))
+
+
+def read_input(schema, path, year=None):
+    """[Record] of schema in an INSEE CSV file or archive, parsed once and kept for the other levels of the process.
+
+    The file is parsed as it is read, an archive without extracting it, but the records are kept in a list: they are shared with the levels
+    reading the same table and handed by population.runner to its processes. Only the table of schema is read from an archive.
+    """
+    tables = _inputs.setdefault(_input_key(path), {})
+    if schema.filename not in tables:
+        if _is_archive(path):
+            tables.update(read_archive(path, year, [schema]))
+        else:
+            with open(path, newline='', encoding='utf-8') as csvfile:
+                tables[schema.filename] = list(parse_rows(schema, csv.reader(csvfile, delimiter=';')))
+    return tables[schema.filename]
+
+
+def read_archive(path, year=None, schemas=None):
+    """Records of the tables of schemas (default all) in an INSEE archive, {CSV file name of the schema: [Record]}.
+
+    The archive is read in one pass, which stops once they are all found. ValueError when one of them is not in it.
+    """
+    year = year or config.year
+    wanted = {schema.filename: schema for schema in schemas or [get_schema(name, year) for name in SCHEMAS]}
+    by_table = dict(wanted)
+    by_table.update({sheet: schema for schema in wanted.values() for sheet in schema.sheets})
+
+    records = {}
+    for table, rows, positional in iter_archive_tables(path):
+        schema = by_table.get(table)
+        # The first table of a level wins, a CSV file or a sheet
+        if schema is None or schema.filename in records:
+            continue
+        records[schema.filename] = list(parse_rows(schema, rows, positional=positional))
+        if len(records) == len(wanted):
+            break
+
+    missing = [filename for filename in wanted if filename not in records]
+    if missing:
+        raise ValueError(f"No {', '.join(missing)} table in {path}")
+    return records
+
+
+def preload_inputs(names, years=None):
+    """Read once the tables of the schemas names for years (default config.year), return them for use_inputs.
+
+    The tables of several levels in the same archive are read in one pass.
+    """
+    inputs = {}
+    for year in years or [config.year]:
+        by_path = {}
+        for name in set(names):
+            schema = get_schema(name, year)
+            by_path.setdefault(input_path(schema, year), []).append(schema)
+        for path, path_schemas in by_path.items():
+            tables = _inputs.setdefault(_input_key(path), {})
+            missing = [schema for schema in path_schemas if schema.filename not in tables]
+            if missing and _is_archive(path):
+                tables.update(read_archive(path, year, missing))
+            for schema in missing:
+                read_input(schema, path, year)
+            inputs[_input_key(path)] = tables
+    return inputs
+
+
+def use_inputs(inputs):
+    """Use files read by another process, see preload_inputs."""
+    _inputs.update(inputs)
+
+
+def parse_rows(schema, rows, positional=True):
+    """Turn the rows of an INSEE table, header included, into Record.
+
+    positional=False raises ValueError when no header is found instead of using the historical CSV column positions.
+    """
+    rows = iter(rows)
+    extract = None
+    skipped = []
+    for row in rows:
+        extract = schema.compile(row)
+        if extract:
+            break
+        skipped.append(row)
+        if len(skipped) >= HEADER_SEARCH_ROWS:
+            break
+
+    if extract is None and not positional:
+        raise ValueError(f'No header found for {schema.filename}')
+    if extract is None:
+        # No header, use the historical positions and keep only the rows starting with a numeric code
+        extract = schema.positional()
+        rows = _numeric_rows(skipped, rows)
+
+    has_department = schema.department is not None
+    for row in rows:
+        try:
+            values = extract(row)
+        except IndexError:  # Blank or notes line
+            continue
+
+        department = normalize_department(values[3]) if has_department else None
+        code = normalize_code(schema, values[0], department)
+
+        try:
+            population = int(values[1])
+        except ValueError:
+            population = _parse_population(values[1])
+            if population is None:
+                continue
+
+        yield Record(code, population, values[2], department)
+
+
+def normalize_department(department):
+    """'1' -> '01', '2a' -> '2A'"""
+    department = department.strip().upper()
+    return department.zfill(2) if department.isdigit() and len(department) < 2 else department
+
+
+def normalize_code(schema, code, department=None):
+    """INSEE code of a row in upper case, with the leading zeros a spreadsheet dropped put back, checked against the département of the row.
+
+    A Corsican code saved as a number (20004 in 2A) is rebuilt from the département (2A004). ValueError when the code is not in the département,
+    a wrong code would not find its item or, worse, find another one.
+    """
+    code = code.strip().upper()
+    if schema.width and len(code) < schema.width and code.isdigit():
+        code = code.zfill(schema.width)
+    if department is None or code.startswith(department):
+        return code
+    if department in CORSICA and code.isdigit() and code.startswith('20'):
+        return department + code[2:]
+    raise ValueError(f'{schema.filename}: INSEE code {code} is not in its département {department}')
+
+
+def _numeric_rows(skipped, rows):
+    for row in skipped:
+        if row and row[0].isnumeric():
+            yield row
+    for row in rows:
+        if row and row[0].isnumeric():
+            yield row
+
+
+def _parse_population(value):
+    # Thousands separators from a spreadsheet export
+    value = value.replace(' ', '').replace('\xa0', '').replace('\u202f', '')
+    return int(value) if value.isdigit() else None
@@ -0,0 +1,86 @@
+import argparse
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+from datetime import datetime
+
+import config
+
+DEFAULT_PATH = 'cache/snapshots.sqlite3'
+DEFAULT_MAX_AGE = 7 * 24 * 3600  # one week, in seconds
+
+
+def snapshot_key(base_filter, point_in_time=None, kind='fastrun'):
+    """Build the key of a snapshot from what it holds, the base filter triples and the census date."""
+    triples = [[claim.mainsnak.property_number, (claim.mainsnak.datavalue or {}).get('value')] for claim in base_filter]
+    return json.dumps({'kind': kind, 'base_filter': triples, 'point_in_time': point_in_time or config.point_in_time}, sort_keys=True, default=str)
+
+
+class SnapshotStore:
+    """Pickled objects (fastrun containers, lookup tables) kept in a SQLite file between runs."""
+
+    def __init__(self, path=None, max_age=None):
+        self.path = path or getattr(config, 'snapshot_path', DEFAULT_PATH)
+        self.max_age = max_age if max_age is not None else getattr(config, 'snapshot_max_age', DEFAULT_MAX_AGE)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Several levels can run at once in population.runner, wait for the lock of the others
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS snapshots (key TEXT PRIMARY KEY, created REAL NOT NULL, data BLOB NOT NULL)')
+        self.connection.commit()
+
+    def load(self, key, max_age=None):
+        max_age = self.max_age if max_age is None else max_age
+        row = self.connection.execute('SELECT created, data FROM snapshots WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        created, data = row
+        if time.time() - created > max_age:
+            logging.info(f'Snapshot {key} is older than {max_age} seconds, ignoring it')
+            return None
+
+        try:
+            return pickle.loads(zlib.decompress(data))
+        except Exception as e:  # A snapshot written by another version of the library is not fatal, we rebuild it
+            logging.warning(f'Unable to load snapshot {key}: {e}')
+            return None
+
+    def save(self, key, obj):
+        try:
+            data = zlib.compress(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            logging.warning(f'Unable to save snapshot {key}: {e}')
+            return
+        self.connection.execute('INSERT OR REPLACE INTO snapshots (key, created, data) VALUES (?, ?, ?)', (key, time.time(), data))
+        self.connection.commit()
+
+    def invalidate(self, key=None):
+        """Remove one snapshot, or all of them when no key is given."""
+        if key is None:
+            self.connection.execute('DELETE FROM snapshots')
+        else:
+            self.connection.execute('DELETE FROM snapshots WHERE key = ?', (key,))
+        self.connection.commit()
+
+    def list(self):
+        return self.connection.execute('SELECT key, created, LENGTH(data) FROM snapshots ORDER BY created').fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List or invalidate the fastrun snapshots.')
+    parser.add_argument('--invalidate', action='store_true', help='remove all the snapshots')
+    args = parser.parse_args()
+
+    store = SnapshotStore()
+    if args.invalidate:
+        store.invalidate()
+    for key, created, size in store.list():
+        print(f'{datetime.fromtimestamp(created).isoformat()} {size:>12} {key}')
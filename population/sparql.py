@@ -0,0 +1,44 @@
+from wikibaseintegrator import wbi_helpers
+
+ENTITY_PREFIX = 'http://www.wikidata.org/entity/'
+
+
+def entity_id(binding):
+    """Return the id of an entity from a SPARQL binding, 'Q90' for 'http://www.wikidata.org/entity/Q90'.
+
+    None for another value, like the blank node (.well-known/genid/...) SPARQL gives for an unknown value.
+    """
+    value = binding['value']
+    if binding.get('type', 'uri') != 'uri' or not value.startswith(ENTITY_PREFIX):
+        return None
+    return value[len(ENTITY_PREFIX):]
+
+
+def keyset_pages(query, page_size=10000, key='item', cursor=None):
+    """Run query page by page, ordered on ?key and filtered after the last key seen instead of using OFFSET.
+
+    query must contain a {cursor} placeholder inside its WHERE clause. Yield (bindings, cursor) per page: the bindings of every key
+    fully read so far and the cursor to give back to restart after them. The rows of the last key of a page are read again by the
+    next page, so a key must have less than page_size rows.
+    """
+    while True:
+        cursor_filter = f'FILTER(STR(?{key}) >= "{cursor}")' if cursor else ''
+        page_query = query.replace('{cursor}', cursor_filter) + f'\nORDER BY STR(?{key})\nLIMIT {page_size}'
+        bindings = wbi_helpers.execute_sparql_query(page_query)['results']['bindings']
+
+        if len(bindings) < page_size:
+            yield bindings, None
+            return
+
+        last = bindings[-1][key]['value']
+        complete = [binding for binding in bindings if binding[key]['value'] != last]
+        if not complete:
+            raise ValueError(f'More than {page_size} rows for {last}, use a bigger page size')
+        cursor = last
+        yield complete, cursor
+
+
+def keyset_query(query, page_size=10000, key='item'):
+    """Yield all the bindings of query, see keyset_pages."""
+    for bindings, _ in keyset_pages(query, page_size=page_size, key=key):
+        yield from bindings
@@ -0,0 +1,160 @@
+import re
+import struct
+
+from wikibaseintegrator import wbi_fastrun
+from wikibaseintegrator.datatypes import ExternalID
+from wikibaseintegrator.wbi_enums import WikibaseRank
+
+import config
+from population.insee_index import InseeIndex
+from population.metrics import metrics
+from population.snapshots import snapshot_key
+from population.validity import wikibase_date
+from population.wikidata import population_claim
+
+PREFERRED = 'preferred'
+NORMAL = 'normal'
+RANKS = {'deprecated': 0, NORMAL: 1, PREFERRED: 2}
+
+# item, amount, point in time (YYYYMMDD), determination method, stated in, rank
+FINGERPRINT = struct.Struct('<IqIIIB')
+QID = re.compile(r'Q(\d+)$')
+
+
+def population_fingerprint(population, point_in_time=None, stated_in=None, preferred=True):
+    """(amount, point in time, determination method, stated in, rank) of the claim written for population."""
+    return f'+{population}', point_in_time or config.point_in_time, 'Q39825', stated_in or config.stated_in, PREFERRED if preferred else NORMAL
+
+
+def _qid_number(value):
+    """'Q90' -> 90, 0 for no item or a value which is not one"""
+    match = QID.match(value or '')
+    return int(match.group(1)) if match else 0
+
+
+def _amount(amount):
+    try:
+        return int(amount)
+    except (TypeError, ValueError):
+        return -1  # Missing or not a whole number, never equal to a census value
+
+
+def _day(time_value):
+    """'+2020-01-01T00:00:00Z' -> 20200101, 0 for no date, a value which is not a date or a date before year 0
+
+    '+2020-00-00T00:00:00Z' of a dump is 20200101 like the '2020-01-01T00:00:00Z' SPARQL gives for it.
+    """
+    day = wikibase_date(time_value)
+    if day is None or time_value.startswith('-'):
+        return 0
+    return int(day.replace('-', ''))
+
+
+def pack_fingerprint(item, fingerprint):
+    """Fixed-width bytes of an item and one of its claim fingerprints, see population_fingerprint."""
+    amount, point_in_time, method, stated_in, rank = fingerprint
+    return FINGERPRINT.pack(_qid_number(item), _amount(amount), _day(point_in_time), _qid_number(method), _qid_number(stated_in), RANKS.get(rank, 1))
+
+
+class ClaimStore:
+    """P1082 claims of the items of a level, packed by pack_fingerprint in a single set.
+
+    A claim takes about 100 bytes, its packed bytes and their set slot, instead of the claim, qualifier and reference objects of a fastrun container,
+    and looking one up is a set lookup.
+    """
+    __slots__ = ('fingerprints', 'items')
+
+    def __init__(self):
+        self.fingerprints = set()
+        self.items = 0
+
+    def add(self, item, fingerprints):
+        self.items += 1
+        self.fingerprints.update(pack_fingerprint(item, fingerprint) for fingerprint in fingerprints)
+
+    def merge(self, other):
+        self.items += other.items
+        self.fingerprints.update(other.fingerprints)
+
+    def has(self, item, fingerprint):
+        return pack_fingerprint(item, fingerprint) in self.fingerprints
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+
+class FastrunState:
+    """Items and P1082 claims of a level read through a fastrun container, kept in the snapshot store."""
+
+    index = None
+
+    def __init__(self, level, snapshots, refresh=False):
+        self.level = level
+        self.snapshots = snapshots
+        self.key = snapshot_key(level.base_filter)
+        if refresh:
+            snapshots.invalidate(self.key)
+
+        with metrics.time('snapshot_load'):
+            self.frc = snapshots.load(self.key)
+        if self.frc is not None:
+            print('Fastrun container loaded from snapshot')
+        else:
+            print('Creating fastrun container')
+            self.frc = wbi_fastrun.get_fastrun_container(base_filter=level.base_filter, use_qualifiers=True, use_references=True, use_rank=True, cache=True)
+        self.warm = False
+
+    def lookup(self, code_insee, population, point_in_time=None, stated_in=None, preferred=True):
+        """Return the items having code_insee and whether the population claim has to be written on them.
+
+        point_in_time, stated_in and preferred describe the claim of another census than config.year.
+        """
+        rank = WikibaseRank.PREFERRED if preferred else WikibaseRank.NORMAL
+        claims = [
+            ExternalID(prop_nr=self.level.insee_property, value=code_insee),
+            population_claim(population, point_in_time, stated_in, rank)
+        ]
+
+        # The first lookup loads the whole base filter in the container
+        with metrics.time('get_entities' if self.warm else 'container_warmup'):
+            entities = self.frc.get_entities(claims=claims, cache=True, query_limit=1000000)
+        if not entities:
+            return [], False
+
+        with metrics.time('write_required'):
+            write_required = self.frc.write_required(claims=claims, entity_filter=entities, property_filter='P1082', cache=True, query_limit=1000000)
+
+        if not self.warm:
+            # The first lookups loaded the whole base filter, save it before the long write phase
+            self.save()
+            self.warm = True
+
+        return list(entities), write_required
+
+    def save(self):
+        # The container is filled lazily by the lookups, this keeps what was loaded so far
+        self.snapshots.save(self.key, self.frc)
+
+
+class PopulationState:
+    """Items and P1082 claims of a level built outside of the fastrun container, from a dump or a dedicated query.
+
+    claims is the ClaimStore of the fingerprints of their P1082 claims, see population_fingerprint.
+    """
+
+    def __init__(self, index=None, claims=None):
+        self.index = index or InseeIndex()
+        self.claims = claims if claims is not None else ClaimStore()
+
+    def lookup(self, code_insee, population, point_in_time=None, stated_in=None, preferred=True):
+        entities = [candidate.item for candidate in self.index.by_code.get(code_insee, [])]
+        if not entities:
+            return [], False
+        return entities, self.write_required(entities, population, point_in_time, stated_in, preferred)
+
+    def write_required(self, entities, population, point_in_time=None, stated_in=None, preferred=True):
+        fingerprint = population_fingerprint(population, point_in_time, stated_in, preferred)
+        return not any(self.claims.has(entity, fingerprint) for entity in entities)
+
+    def save(self):
+        pass
@@ -0,0 +1,115 @@
+import logging
+import random
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from wikibaseintegrator import wbi_helpers
+from wikibaseintegrator.wbi_config import config as wbi_config
+
+import config
+from population.metrics import metrics
+
+# (connect, read) timeouts in seconds per endpoint, overridden by config.http_timeouts
+TIMEOUTS = {
+    'api': (5, 60),
+    'sparql': (5, 300),
+    'other': (5, 60)
+}
+RETRY_STATUSES = {500, 502, 503, 504}
+
+# Retry-After of the last API response of each thread, read by population.scheduler after a throttle error
+_last_response = threading.local()
+
+
+def endpoint_of(url):
+    if url.startswith(wbi_config['SPARQL_ENDPOINT_URL']):
+        return 'sparql'
+    if url.startswith(wbi_config['MEDIAWIKI_API_URL']):
+        return 'api'
+    return 'other'
+
+
+class Transport(HTTPAdapter):
+    """Pooled keep-alive connections with a timeout per endpoint, a jittered retry of 5xx and connection errors and the latency of each request in the metrics.
+
+    A retried write is sent again with the same base revision, so it cannot overwrite an edit made in between.
+    """
+    __attrs__ = HTTPAdapter.__attrs__ + ['retries', 'backoff', 'timeouts']
+
+    def __init__(self, pool_size=10, retries=3, backoff=1.0, timeouts=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        # pool_block: the threads wait for a free connection instead of opening throwaway ones
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=0)
+
+    def send(self, request, timeout=None, **kwargs):
+        endpoint = endpoint_of(request.url)
+        if timeout is None:
+            timeout = self.timeouts.get(endpoint, self.timeouts['other'])
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = super().send(request, timeout=timeout, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                metrics.observe(f'http_{endpoint}', time.perf_counter() - start)
+                metrics.count('http_requests', endpoint=endpoint, status=type(e).__name__)
+                if attempt == self.retries:
+                    raise
+                delay = self._delay(attempt)
+                logging.info('%s on %s, retrying in %.1f seconds', type(e).__name__, endpoint, delay)
+            else:
+                metrics.observe(f'http_{endpoint}', time.perf_counter() - start)
+                metrics.count('http_requests', endpoint=endpoint, status=response.status_code)
+                if endpoint == 'api':
+                    _last_response.retry_after = response.headers.get('Retry-After')
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                delay = self._delay(attempt, response.headers.get('Retry-After'))
+                logging.info('HTTP %d on %s, retrying in %.1f seconds', response.status_code, endpoint, delay)
+                # Read the body, the connection goes back to the pool instead of being closed
+                response.content
+
+            metrics.count('http_retries', endpoint=endpoint)
+            time.sleep(delay)
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), 60)
+        # Full jitter, the threads and processes hitting the same failure do not come back together
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+
+def retry_after():
+    """Seconds the last API response of this thread asked to wait with Retry-After, None without one."""
+    value = getattr(_last_response, 'retry_after', None)
+    return int(value) if value and value.isdigit() else None
+
+
+def mount(session):
+    """Send the requests of session through a Transport built from config, return the session."""
+    pool_size = getattr(config, 'http_pool_size', getattr(config, 'write_workers', 4) + getattr(config, 'read_workers', 4))
+    transport = Transport(pool_size=pool_size, retries=getattr(config, 'http_retries', 3),
+                          timeouts=getattr(config, 'http_timeouts', None))
+    session.mount('https://', transport)
+    session.mount('http://', transport)
+    # requests asks for gzip already, say it for the Wikimedia caches and keep the connections open
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+
+
+def install(login=None):
+    """Use the transport for the anonymous requests of WikibaseIntegrator and for the session of login.
+
+    WikibaseIntegrator sends the API calls without login through wbi_helpers.default_session and SPARQL through wbi_helpers.helpers_session.
+    """
+    for name in ('default_session', 'helpers_session'):
+        anonymous_session = getattr(wbi_helpers, name, None)
+        if anonymous_session is not None and not isinstance(anonymous_session.get_adapter('https://'), Transport):
+            mount(anonymous_session)
+    session = login.get_session() if login is not None else None
+    if session is not None and not isinstance(session.get_adapter('https://'), Transport):
+        mount(session)
@@ -0,0 +1,64 @@
+import re
+from functools import lru_cache
+
+import config
+
+# Wikibase time precisions
+PRECISION_YEAR = 9
+PRECISION_MONTH = 10
+PRECISION_DAY = 11
+
+# '+2020-03-17T00:00:00Z' of the API, '2020-03-17T00:00:00Z' of SPARQL
+TIME = re.compile(r'([+-]?)(\d+)-(\d\d)-(\d\d)')
+
+
+@lru_cache(maxsize=65536)
+def wikibase_date(time, precision=PRECISION_DAY):
+    """First day of the period a Wikibase time covers at its precision, as 'YYYY-MM-DD' which compares as a string.
+
+    '+2020-00-00T00:00:00Z' at year precision -> '2020-01-01', '+2020-03-17T00:00:00Z' at month precision -> '2020-03-01'.
+    The time of the day is ignored. Comparing these first days with a census day gives the same answer as comparing the census
+    day truncated to the precision of the value: a start in 2020 is before 2020-06-01, an end in 2020 is not after it.
+    None for no time or a value which is not a time, like the blank node SPARQL gives for an unknown value; '0000-01-01' for a year before year 0.
+    """
+    match = TIME.match(time or '')
+    if match is None:
+        return None
+    sign, year, month, day = match.groups()
+    if sign == '-':
+        return '0000-01-01'
+    if precision <= PRECISION_YEAR or month == '00':
+        return f'{year[-4:]:0>4}-01-01'
+    if precision == PRECISION_MONTH or day == '00':
+        return f'{year[-4:]:0>4}-{month}-01'
+    return f'{year[-4:]:0>4}-{month}-{day}'
+
+
+@lru_cache(maxsize=None)
+def census_date(point_in_time=None):
+    """'+2020-01-01T00:00:00Z' -> '2020-01-01', of config.point_in_time by default"""
+    return wikibase_date(point_in_time or config.point_in_time)
+
+
+@lru_cache(maxsize=None)
+def geography_date(point_in_time=None):
+    """Day of the geography the populations of a census are published in, of config.point_in_time by default.
+
+    The populations légales of a census are published at the end of the second year after it, for the communes existing on January 1st
+    of that year: '+2020-01-01T00:00:00Z' -> '2022-01-01'. config.geography_date overrides it for config.point_in_time.
+    """
+    if not point_in_time or point_in_time == config.point_in_time:
+        configured = getattr(config, 'geography_date', None)
+        if configured:
+            return wikibase_date(configured)
+    census = census_date(point_in_time)
+    return f'{int(census[:4]) + 2:04d}-01-01'
+
+
+def current_at(end, geography):
+    """Whether something ending at end (a wikibase_date day or None) still exists in the geography of that day.
+
+    Only the end matters: an item, a type or a code started after the census, like the commune born from a merger, is the one the
+    populations are published for.
+    """
+    return not end or end > geography
@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import pickle
+import threading
+from contextlib import nullcontext
+
+import requests
+from wikibaseintegrator import WikibaseIntegrator, wbi_helpers, wbi_login
+from wikibaseintegrator.datatypes import Item, Quantity, Time
+from wikibaseintegrator.entities import ItemEntity
+from wikibaseintegrator.wbi_config import config as wbi_config
+from wikibaseintegrator.wbi_enums import ActionIfExists, WikibaseRank
+from wikibaseintegrator.wbi_login import LoginError
+
+# Import local config for user and password
+import config
+from population import transport
+
+wbi_config['USER_AGENT'] = 'WikibaseIntegrator/1.0 Update French Population'
+# Another Wikibase, like population.fake_wikibase, can replace Wikidata
+if hasattr(config, 'mediawiki_api_url'):
+    wbi_config['MEDIAWIKI_API_URL'] = config.mediawiki_api_url
+if hasattr(config, 'sparql_endpoint_url'):
+    wbi_config['SPARQL_ENDPOINT_URL'] = config.sparql_endpoint_url
+transport.install()
+
+# wbgetentities refuses more than 50 ids per request for non-bot accounts
+MAX_ENTITIES_PER_REQUEST = 50
+
+qualifiers = [
+    Time(prop_nr='P585', time=config.point_in_time),  # point in time
+    Item(prop_nr='P459', value='Q39825')  # determination method: census
+]
+
+references = [
+    [
+        Item(value=config.stated_in, prop_nr='P248')  # stated in: Populations légales XXXX
+    ]
+]
+
+_wbi = None
+_anonymous_wbi = None
+# Held while a process logs in, shared by the processes of population.runner so that only the first one does
+_login_lock = None
+
+def session_path():
+    return getattr(config, 'session_path', 'cache/session.pickle')
+
+
+def _save_session(login):
+    """Keep the cookies of a new login for the next runs, readable by the owner only."""
+    path = session_path()
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    saved = {'user': config.user, 'api': wbi_config['MEDIAWIKI_API_URL'], 'cookies': login.get_session().cookies}
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as session_file:
+        pickle.dump(saved, session_file)
+
+
+def _restore_session():
+    """Login using the cookies saved by the last login, None when there are none or the session expired."""
+    path = session_path()
+    try:
+        with open(path, 'rb') as session_file:
+            saved = pickle.load(session_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if saved.get('user') != config.user or saved.get('api') != wbi_config['MEDIAWIKI_API_URL']:
+        return None
+
+    session = requests.Session()
+    session.cookies.update(saved['cookies'])
+    transport.mount(session)
+    try:
+        # One token request instead of a login, an expired session gets the anonymous token and a LoginError
+        return wbi_login._Login(session=session)
+    except LoginError:
+        logging.info('The saved session expired, logging in again')
+        os.remove(path)
+        return None
+
+
+class LazyLogin:
+    """Login of the writes, opened by the first write: the session saved by the last login when it is still valid, else a new login.
+
+    Runs which write nothing (plan, an unchanged input, every row already up to date) never reach the login endpoint. A failed login is not tried
+    again: the next writes get the same LoginError.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.login = None
+        self.error = None
+
+    @property
+    def logged_in(self):
+        return self.login is not None
+
+    def get(self):
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            if self.login is None:
+                with _login_lock or nullcontext():
+                    login = _restore_session()
+                    if login is None:
+                        print('Logging in')
+                        try:
+                            login = wbi_login.Login(user=config.user, password=config.password)
+                        except LoginError as e:
+                            self.error = e
+                            raise
+                        transport.install(login)
+                        _save_session(login)
+                self.login = login
+        return self.login
+
+    def __getattr__(self, name):
+        # Everything else is the login itself, WikibaseIntegrator only calls get_session and get_edit_token
+        if name.startswith('_') or name in ('lock', 'login', 'error'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+def get_wbi(anonymous=False):
+    """Return the shared WikibaseIntegrator instance, which logs in on its first write; anonymous=True gives a read-only instance."""
+    global _wbi, _anonymous_wbi
+    if anonymous:
+        if _anonymous_wbi is None:
+            _anonymous_wbi = WikibaseIntegrator()
+        return _anonymous_wbi
+
+    if _wbi is None:
+        _wbi = WikibaseIntegrator(login=LazyLogin(), is_bot=True)
+    return _wbi
+
+
+def point_in_time_for(year):
+    """Census date of year, from config.point_in_time_by_year, config.point_in_time for config.year, else January 1st."""
+    point_in_time = getattr(config, 'point_in_time_by_year', {}).get(year)
+    if point_in_time:
+        return point_in_time
+    if year == config.year:
+        return config.point_in_time
+    return f'+{year}-01-01T00:00:00Z'
+
+
+def stated_in_for(year):
+    """"Populations légales" item of year, from config.stated_in_by_year or config.stated_in for config.year."""
+    stated_in = getattr(config, 'stated_in_by_year', {}).get(year)
+    if stated_in:
+        return stated_in
+    if year == config.year:
+        return config.stated_in
+    raise KeyError(f'No stated in item for {year}, add it to stated_in_by_year in config.py')
+
+
+def use_login_lock(lock):
+    """Log in under lock, a lock of the processes running the levels: the first one logs in and saves the session, the others reuse it."""
+    global _login_lock
+    _login_lock = lock
+
+
+def population_claim(population, point_in_time=None, stated_in=None, rank=WikibaseRank.PREFERRED):
+    """P1082 claim of the census, of config.year unless point_in_time and stated_in are given."""
+    if point_in_time is None and stated_in is None:
+        return Quantity(amount=population, prop_nr='P1082', references=references, qualifiers=qualifiers, rank=rank)
+
+    claim_qualifiers = [
+        Time(prop_nr='P585', time=point_in_time or config.point_in_time),
+        Item(prop_nr='P459', value='Q39825')
+    ]
+    claim_references = [[Item(value=stated_in or config.stated_in, prop_nr='P248')]]
+    return Quantity(amount=population, prop_nr='P1082', references=claim_references, qualifiers=claim_qualifiers, rank=rank)
+
+
+def get_entities(wbi, entity_ids, props=('claims', 'info')):
+    """Fetch several items with one wbgetentities call per group of MAX_ENTITIES_PER_REQUEST ids.
+
+    Return a dict of entity id to ItemEntity, missing entities are left out.
+    """
+    return {entity_id: wbi.item.new().from_json(json_data=entity_json) for entity_id, entity_json in _wbgetentities(wbi, entity_ids, props)}
+
+
+def get_revisions(wbi, entity_ids):
+    """Return a dict of entity id to its last revision id, only the page info is fetched."""
+    return {entity_id: entity_json.get('lastrevid') for entity_id, entity_json in _wbgetentities(wbi, entity_ids, ('info',))}
+
+
+def _wbgetentities(wbi, entity_ids, props):
+    """Yield (entity id, entity JSON) of the existing entities, MAX_ENTITIES_PER_REQUEST ids per request."""
+    entity_ids = list(dict.fromkeys(entity_ids))
+    for i in range(0, len(entity_ids), MAX_ENTITIES_PER_REQUEST):
+        data = {
+            'action': 'wbgetentities',
+            'ids': '|'.join(entity_ids[i:i + MAX_ENTITIES_PER_REQUEST]),
+            'props': '|'.join(props),
+            'format': 'json'
+        }
+        # Reads do not wait for a login, they use the session once a write opened it
+        login = wbi.login if getattr(wbi.login, 'logged_in', True) else None
+        json_data = wbi_helpers.mediawiki_api_call_helper(data=data, login=login, allow_anonymous=True, is_bot=wbi.is_bot)
+        for entity_id, entity_json in json_data['entities'].items():
+            if 'missing' not in entity_json:
+                yield entity_id, entity_json
+
+
+def prepare_population(item, population):
+    """Demote the existing P1082 claims and add the census value as preferred, without writing the item."""
+    for claim in item.claims.get('P1082'):
+        claim.rank = WikibaseRank.NORMAL
+
+        # Clean duplicate qualifiers
+        if len(claim.qualifiers.get('P585')) > 1:
+            claim.qualifiers.remove(qualifier=Time(prop_nr='P585', time=config.point_in_time))
+
+        # Clean duplicate references
+        if len(claim.references.references) > 1:
+            claim.references.remove(reference_to_remove=Item(value=config.stated_in, prop_nr='P248'))
+
+    item.claims.add(claims=population_claim(population), action_if_exists=ActionIfExists.APPEND_OR_REPLACE)
+    return item
+
+
+def edit_entity(wbi, entity_id, claims, summary, baserevid=None, **kwargs):
+    """Send claims with wbeditentity. With baserevid, an edit made since that revision gives an editconflict MWApiError instead of being overwritten."""
+    data = {
+        'action': 'wbeditentity',
+        'id': entity_id,
+        'data': json.dumps({'claims': claims}),
+        'summary': summary,
+        'format': 'json'
+    }
+    if baserevid:
+        data['baserevid'] = baserevid
+    if wbi.is_bot:
+        data['bot'] = ''
+    return wbi_helpers.mediawiki_api_call_helper(data=data, login=wbi.login, is_bot=wbi.is_bot, **kwargs)
+
+
+def write_claims(item, summary, **kwargs):
+    """Write the P1082 claims of item against the revision it was read at and return the entity saved."""
+    json_data = edit_entity(item.api, item.id, item.claims.get_json().get('P1082', []), summary, baserevid=item.lastrevid, **kwargs)
+    # item.api is a copy of the WikibaseIntegrator instance made before it had .item
+    return ItemEntity(api=item.api).from_json(json_data=json_data['entity'])
+
+
+def write_population(item, population, **kwargs):
+    """Demote the existing P1082 claims, add the census value as preferred and write the item."""
+    prepare_population(item, population)
+    return write_claims(item, 'Update population for ' + config.year, **kwargs)
+
+
+def prepare_backfill(item, populations):
+    """Add the claims of several censuses, populations maps a year to its population, without writing the item.
+
+    Only the latest census is preferred, unless the item already has a preferred claim for a later date which then stays preferred.
+    """
+    latest = point_in_time_for(max(populations))
+    newer = False
+    for claim in item.claims.get('P1082'):
+        if claim.rank != WikibaseRank.PREFERRED:
+            continue
+        # An unknown point in time has no datavalue
+        dates = [qualifier.datavalue['value']['time'] for qualifier in claim.qualifiers.get('P585') if qualifier.datavalue]
+        if dates and max(dates) > latest:
+            newer = True
+        else:
+            claim.rank = WikibaseRank.NORMAL
+
+    for year, population in sorted(populations.items()):
+        rank = WikibaseRank.PREFERRED if point_in_time_for(year) == latest and not newer else WikibaseRank.NORMAL
+        item.claims.add(claims=population_claim(population, point_in_time_for(year), stated_in_for(year), rank), action_if_exists=ActionIfExists.APPEND_OR_REPLACE)
+    return item
+
+
+def write_backfill(item, populations, **kwargs):
+    """Write the claims of several censuses in one edit."""
+    prepare_backfill(item, populations)
+    return write_claims(item, 'Update population for ' + ', '.join(sorted(populations)), **kwargs)
+
+
+def plan_population(item, population):
+    """Describe the edit write_population would make on item, apply_plan_entry replays it as is."""
+    old_preferred = []
+    for claim in item.claims.get('P1082'):
+        if claim.rank == WikibaseRank.PREFERRED:
+            old_preferred.append({
+                'id': claim.id,
+                'amount': (claim.mainsnak.datavalue or {}).get('value', {}).get('amount'),
+                'point_in_time': [qualifier.datavalue['value']['time'] for qualifier in claim.qualifiers.get('P585')]
+            })
+
+    prepare_population(item, population)
+
+    return {
+        'item': item.id,
+        'baserevid': item.lastrevid,
+        'year': config.year,
+        'point_in_time': config.point_in_time,
+        'amount': population,
+        'old_preferred': old_preferred,
+        'demote': [claim['id'] for claim in old_preferred],
+        # Full P1082 claims after the edit, what item.write(limit_claims=['P1082']) would send
+        'claims': item.claims.get_json()['P1082']
+    }
+
+
+def apply_plan_entry(wbi, entry, **kwargs):
+    """Send the claims of a plan entry with wbeditentity, against the revision seen when the plan was made."""
+    return edit_entity(wbi, entry['item'], entry['claims'], 'Update population for ' + entry['year'], baserevid=entry.get('baserevid'), **kwargs)
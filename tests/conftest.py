@@ -0,0 +1,44 @@
+import os
+import shutil
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+sys.path.insert(0, ROOT)
+
+# config.py holds the credentials and is not versioned, the tests bring their own
+config = types.ModuleType('config')
+config.user = 'Fake@population'
+config.password = 'fake'
+config.year = '2020'
+config.point_in_time = '+2020-01-01T00:00:00Z'
+config.stated_in = 'Q90000'
+# The fake Wikibase has no edit budget to respect, the halved rate after a throttle error stays fast
+config.edits_per_minute = 6000
+sys.modules['config'] = config
+
+from population import schemas, wikidata  # noqa: E402
+from population.fake_wikibase import FakeWikibase, load_fixtures, use_fake_wikibase  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory holding annees/2020/donnees_regions.csv, everything written by the run stays in it."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join('annees', config.year))
+    shutil.copy(os.path.join(FIXTURES, 'donnees_regions.csv'), os.path.join('annees', config.year))
+    schemas._inputs.clear()
+    return tmp_path
+
+
+@pytest.fixture
+def fake(workdir, monkeypatch):
+    """Fake Wikibase serving tests/fixtures/regions.json, used by WikibaseIntegrator and by population for this test."""
+    monkeypatch.setattr(wikidata, '_wbi', None)
+    monkeypatch.setattr(wikidata, '_anonymous_wbi', None)
+    with FakeWikibase(load_fixtures(os.path.join(FIXTURES, 'regions.json')), seed=1) as fake_wikibase:
+        use_fake_wikibase(fake_wikibase)
+        yield fake_wikibase
@@ -0,0 +1,59 @@
+"""Wikibase JSON of the items used by the tests, completed like the fake Wikibase serves them."""
+from wikibaseintegrator import WikibaseIntegrator
+from wikibaseintegrator.entities import ItemEntity
+
+from population.fake_wikibase import _complete_statement
+
+
+def item_value(item):
+    return {'value': {'entity-type': 'item', 'numeric-id': int(item[1:]), 'id': item}, 'type': 'wikibase-entityid'}
+
+
+def time_value(day):
+    return {'value': {'time': f'+{day}T00:00:00Z', 'timezone': 0, 'before': 0, 'after': 0, 'precision': 11, 'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'},
+            'type': 'time'}
+
+
+def snak(prop, datavalue, datatype):
+    return {'snaktype': 'value', 'property': prop, 'datavalue': datavalue, 'datatype': datatype}
+
+
+def statement(prop, datavalue, datatype, rank='normal', start=None, end=None, qualifiers=None, references=()):
+    qualifiers = dict(qualifiers or {})
+    if start:
+        qualifiers['P580'] = [snak('P580', time_value(start), 'time')]
+    if end:
+        qualifiers['P582'] = [snak('P582', time_value(end), 'time')]
+    claim = {'mainsnak': snak(prop, datavalue, datatype), 'type': 'statement', 'rank': rank, 'references': list(references)}
+    if qualifiers:
+        claim['qualifiers'] = qualifiers
+    return claim
+
+
+def population_statement(amount, day, stated_in=None, rank='normal', references=None):
+    qualifiers = {'P585': [snak('P585', time_value(day), 'time')], 'P459': [snak('P459', item_value('Q39825'), 'wikibase-item')]}
+    if references is None:
+        references = [{'snaks': {'P248': [snak('P248', item_value(stated_in), 'wikibase-item')]}}] if stated_in else []
+    return statement('P1082', {'value': {'amount': f'+{amount}', 'unit': '1'}, 'type': 'quantity'}, 'quantity', rank, qualifiers=qualifiers, references=references)
+
+
+def commune(item, codes, types=((None, None),), dissolved=None, populations=()):
+    """Commune of France, codes are (code, start, end) and types (start, end) of its P31 statements, days as 'YYYY-MM-DD'."""
+    claims = {
+        'P31': [statement('P31', item_value('Q484170'), 'wikibase-item', start=start, end=end) for start, end in types],
+        'P17': [statement('P17', item_value('Q142'), 'wikibase-item')],
+        'P374': [statement('P374', {'value': code, 'type': 'string'}, 'external-id', start=start, end=end) for code, start, end in codes],
+    }
+    if dissolved:
+        claims['P576'] = [statement('P576', time_value(dissolved), 'time')]
+    if populations:
+        claims['P1082'] = list(populations)
+    entity = {'id': item, 'type': 'item', 'labels': {}, 'descriptions': {}, 'aliases': {}, 'sitelinks': {}, 'claims': claims, 'lastrevid': 1}
+    for statements in claims.values():
+        for claim in statements:
+            _complete_statement(entity, claim)
+    return entity
+
+
+def item_entity(entity):
+    return ItemEntity(api=WikibaseIntegrator()).from_json(json_data=entity)
@@ -0,0 +1,42 @@
+import communes_fastrun
+from population.dump import _fingerprints
+from population.extract import _add_claims, build_population_query
+from population.sparql import keyset_query
+from population.state import ClaimStore, population_fingerprint
+from tests.entities import commune, item_value, population_statement, snak, time_value
+
+
+def _reference(stated_in):
+    return {'snaks': {'P248': [snak('P248', item_value(stated_in), 'wikibase-item')]}}
+
+
+UNKNOWN_DATE = {'snaktype': 'somevalue', 'property': 'P585', 'datatype': 'time'}
+UNKNOWN_ITEM = {'snaktype': 'somevalue', 'property': 'P248', 'datatype': 'wikibase-item'}
+
+
+def _statements():
+    # Stated in two "Populations légales", one reference each
+    current = population_statement(1500, '2020-01-01', rank='preferred', references=[_reference('Q80000'), _reference('Q90000')])
+    # Year precision, two points in time, no reference
+    year = population_statement(1400, '2015-01-01')
+    year_value = {'value': dict(time_value('2015-01-01')['value'], time='+2015-00-00T00:00:00Z', precision=9), 'type': 'time'}
+    year['qualifiers']['P585'] = [snak('P585', year_value, 'time'), snak('P585', time_value('2016-01-01'), 'time')]
+    # Unknown point in time and source
+    unknown = population_statement(1300, '2010-01-01', references=[{'snaks': {'P248': [UNKNOWN_ITEM]}}])
+    unknown['qualifiers']['P585'] = [UNKNOWN_DATE]
+    return [current, year, unknown]
+
+
+def test_dump_and_sparql_give_the_same_fingerprints(fake):
+    fake.add_entity(commune('Q1001', [('01004', None, None)], populations=_statements()))
+
+    from_sparql = ClaimStore()
+    _add_claims(from_sparql, keyset_query(build_population_query(communes_fastrun.level)))
+    from_dump = ClaimStore()
+    from_dump.add('Q1001', _fingerprints(fake.entities['Q1001']))
+
+    assert from_dump.fingerprints == from_sparql.fingerprints
+    assert len(from_dump) == 5
+    # The census claim is found whichever reference gives the stated in
+    assert from_dump.has('Q1001', population_fingerprint(1500))
+    assert from_dump.has('Q1001', population_fingerprint(1500, stated_in='Q80000'))
@@ -0,0 +1,167 @@
+import time
+
+import pytest
+
+import communes_fastrun
+import config
+from wikibaseintegrator.wbi_config import config as wbi_config
+
+from population import extract, fake_sparql
+from population.extract import CircuitBreaker, _add_claims, _fingerprint, build_population_query, extract_sharded, extract_state
+from population.insee_index import build_query
+from population.snapshots import SnapshotStore
+from population.sparql import entity_id, keyset_pages
+from population.state import ClaimStore, population_fingerprint
+from tests.entities import commune, population_statement
+
+# Communes of three départements, one population claim each
+CODES = {'Q1001': '01004', 'Q1002': '01005', 'Q1003': '02001', 'Q1004': '02002', 'Q1005': '2A004'}
+
+GENID = 'http://www.wikidata.org/.well-known/genid/4b0e4ab9ce4b1c5e53b87bfe4b2c3e8a'
+
+
+def _binding(point_in_time, method, stated_in, item='Q13947', amount='+2573180', rank='PreferredRank'):
+    def uri(value):
+        return {'type': 'uri', 'value': value}
+
+    return {'item': uri(f'http://www.wikidata.org/entity/{item}'), 'amount': {'type': 'literal', 'value': amount}, 'pointInTime': point_in_time, 'method': method,
+            'statedIn': stated_in, 'rank': uri(f'http://wikiba.se/ontology#{rank}')}
+
+
+def test_unknown_values_are_not_items_or_dates():
+    # P585, P459 and P248 set to "unknown value" come back as blank nodes
+    binding = _binding({'type': 'uri', 'value': GENID}, {'type': 'uri', 'value': GENID}, {'type': 'uri', 'value': GENID})
+
+    assert _fingerprint(binding) == ('+2573180', None, None, None, 'preferred')
+
+    claims = ClaimStore()
+    _add_claims(claims, [binding])
+    assert len(claims) == 1
+    assert not claims.has('Q13947', population_fingerprint(2573180))
+
+
+def test_known_values_match_the_written_claim():
+    binding = _binding({'type': 'literal', 'value': '2020-01-01T00:00:00Z', 'datatype': 'http://www.w3.org/2001/XMLSchema#dateTime'},
+                       {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q39825'}, {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q90000'})
+
+    claims = ClaimStore()
+    _add_claims(claims, [binding])
+    assert claims.has('Q13947', population_fingerprint(2573180))
+
+
+@pytest.fixture
+def communes(fake):
+    for id_item, code in CODES.items():
+        fake.add_entity(commune(id_item, [(code, None, None)], populations=[population_statement(1000 + int(id_item[1:]), '2015-01-01', stated_in='Q90000')]))
+    return fake
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    # The départements of CODES and one without communes, instead of the hundred of them
+    monkeypatch.setattr(extract, 'DEPARTEMENT_PREFIXES', ['01', '02', '2A', '03'])
+
+
+@pytest.fixture
+def snapshots(workdir):
+    store = SnapshotStore('cache/snapshots.sqlite3')
+    yield store
+    store.close()
+
+
+def _fail_queries(fake, monkeypatch, failing):
+    """Answer with an error the queries for which failing(text) is true."""
+    sparql = fake.sparql
+
+    def flaky_sparql(text):
+        if failing(text):
+            raise fake_sparql.SparqlError('Query timeout')
+        return sparql(text)
+
+    monkeypatch.setattr(fake, 'sparql', flaky_sparql)
+    # WikibaseIntegrator backs off for 15 seconds before giving up
+    monkeypatch.setitem(wbi_config, 'BACKOFF_MAX_TRIES', 1)
+
+
+def test_circuit_breaker_opens_then_half_opens():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    # Open: no query until the cooldown is over
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    # Half open: one query is tried, its failure opens the breaker again at once
+    assert breaker.allow()
+    breaker.failure()
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    # Closed: a single failure does not open it
+    breaker.failure()
+    assert breaker.allow()
+
+
+def test_keyset_pages_read_every_item_once_and_resume(communes):
+    query = build_query(communes_fastrun.level)
+
+    pages = list(keyset_pages(query, page_size=2))
+    items = [entity_id(binding['item']) for bindings, _ in pages for binding in bindings]
+    assert items == sorted(CODES)
+    # The last key of a full page is read again by the next one
+    assert [cursor for _, cursor in pages] == ['http://www.wikidata.org/entity/Q1002', 'http://www.wikidata.org/entity/Q1003',
+                                               'http://www.wikidata.org/entity/Q1004', 'http://www.wikidata.org/entity/Q1005', None]
+
+    resumed = list(keyset_pages(query, page_size=2, cursor=pages[1][1]))
+    assert [entity_id(binding['item']) for bindings, _ in resumed for binding in bindings] == items[2:]
+
+
+def test_interrupted_extraction_resumes_after_the_last_page(communes, snapshots, monkeypatch):
+    # The claims query fails after its first page
+    claims_pages = []
+
+    def second_claims_page(text):
+        if 'P1082' in text:
+            claims_pages.append(text)
+        return len(claims_pages) > 1
+
+    _fail_queries(communes, monkeypatch, second_claims_page)
+
+    with pytest.raises(Exception):
+        extract_state(communes_fastrun.level, snapshots, page_size=2)
+
+    monkeypatch.undo()
+    communes.stats.clear()
+    state = extract_state(communes_fastrun.level, snapshots, page_size=2)
+
+    assert sorted(state.index.items) == sorted(CODES)
+    assert all(state.claims.has(id_item, ('+' + str(1000 + int(id_item[1:])), '2015-01-01T00:00:00Z', 'Q39825', 'Q90000', 'normal')) for id_item in CODES)
+    # Only the claims pages from the one which failed are read again, 2 items of 5 per page
+    assert communes.stats['sparql'] == 4
+
+
+def test_failed_shard_falls_back_to_its_last_snapshot(communes, shards, snapshots, monkeypatch):
+    monkeypatch.setattr(config, 'shard_failures', 3, raising=False)
+    state, complete = extract_sharded(communes_fastrun.level, snapshots)
+    assert complete
+    assert len(state.index.items) == len(CODES)
+
+    # The shard of 02 times out, the others are extracted again
+    _fail_queries(communes, monkeypatch, lambda text: '"02"' in text)
+    communes.add_entity(commune('Q1006', [('01006', None, None)]))
+    state, complete = extract_sharded(communes_fastrun.level, snapshots, refresh=True)
+
+    assert not complete
+    assert sorted(state.index.items) == sorted(list(CODES) + ['Q1006'])
+    assert state.claims.has('Q1003', ('+2003', '2015-01-01T00:00:00Z', 'Q39825', 'Q90000', 'normal'))
+
+
+def test_failed_shard_without_snapshot_fails_the_extraction(communes, shards, snapshots, monkeypatch):
+    _fail_queries(communes, monkeypatch, lambda text: '"2A"' in text)
+
+    with pytest.raises(RuntimeError, match='2A'):
+        extract_sharded(communes_fastrun.level, snapshots)
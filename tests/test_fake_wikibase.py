@@ -0,0 +1,40 @@
+import json
+
+import requests
+
+from population.wikidata import get_entities, get_wbi
+
+
+def _api(fake, **params):
+    return requests.post(fake.api_url, data=dict(params, format='json'), timeout=10).json()
+
+
+def test_fixture_entities_read_by_wikibaseintegrator(fake):
+    entities = get_entities(get_wbi(anonymous=True), ['Q13917', 'Q13947', 'Q404'])
+
+    assert sorted(entities) == ['Q13917', 'Q13947']
+    claim = entities['Q13917'].claims.get('P1082')[0]
+    # Filled by the fake, the fixture has none
+    assert claim.id.startswith('Q13917$')
+    assert claim.qualifiers.get('P585')[0].hash
+    assert claim.references.references[0].hash
+
+
+def test_edit_on_an_old_revision_is_a_conflict(fake):
+    lastrevid = fake.entities['Q13947']['lastrevid']
+    claims = {'P1082': [{'mainsnak': {'snaktype': 'value', 'property': 'P1082', 'datatype': 'quantity',
+                                                 'datavalue': {'value': {'amount': '+1', 'unit': '1'}, 'type': 'quantity'}}}]}
+
+    result = _api(fake, action='wbeditentity', id='Q13947', data=json.dumps({'claims': claims}), baserevid=lastrevid - 1, token='+\\')
+    assert result['error']['code'] == 'editconflict'
+
+    result = _api(fake, action='wbeditentity', id='Q13947', data=json.dumps({'claims': claims}), baserevid=lastrevid, token='+\\')
+    assert result['entity']['lastrevid'] > lastrevid
+    assert len(result['entity']['claims']['P1082']) == 2
+
+
+def test_maxlag_injected_only_when_asked(fake):
+    fake.maxlag_rate = 1.0
+
+    assert _api(fake, action='wbgetentities', ids='Q13917', maxlag='5')['error']['code'] == 'maxlag'
+    assert 'Q13917' in _api(fake, action='wbgetentities', ids='Q13917')['entities']
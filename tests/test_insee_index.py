@@ -0,0 +1,69 @@
+import communes_fastrun
+from population.insee_index import InseeIndex, select_valid
+from tests.entities import commune, item_entity
+
+CENSUS = '+2020-01-01T00:00:00Z'  # published in the geography of 2022-01-01
+
+
+def _resolve(entities, code):
+    """InseeIndex.resolve of the index built from the items, and select_valid on the same items fetched from the API."""
+    index = InseeIndex()
+    for entity in entities:
+        index.add_candidate(entity['id'], *_facts(entity))
+    candidates = {entity['id']: item_entity(entity) for entity in entities}
+    id_item, _ = select_valid(communes_fastrun.level, code, list(candidates), candidates, CENSUS)
+    assert index.resolve(code, point_in_time=CENSUS) == id_item
+    return id_item
+
+
+def _facts(entity):
+    def qualifier(claim, prop):
+        snaks = claim.get('qualifiers', {}).get(prop)
+        return snaks[0]['datavalue']['value']['time'][1:11] if snaks else None
+
+    claims = entity['claims']
+    codes = [(claim['mainsnak']['datavalue']['value'], qualifier(claim, 'P580'), qualifier(claim, 'P582')) for claim in claims['P374']]
+    types = [(qualifier(claim, 'P580'), qualifier(claim, 'P582')) for claim in claims['P31']]
+    dissolved = [claim['mainsnak']['datavalue']['value']['time'][1:11] for claim in claims.get('P576', [])]
+    return codes, types, dissolved
+
+
+def test_merger_writes_the_new_commune():
+    old = commune('Q1001', [('01004', '1943-01-01', '2022-01-01')], dissolved='2022-01-01')
+    new = commune('Q1002', [('01004', '2022-01-01', None)], types=[('2022-01-01', None)])
+
+    assert _resolve([old, new], '01004') == 'Q1002'
+
+
+def test_code_started_after_the_census_wins():
+    old = commune('Q1001', [('01004', '1943-01-01', '2024-01-01')], dissolved='2024-01-01')
+    new = commune('Q1002', [('01004', '2024-01-01', None)], types=[('2024-01-01', None)])
+
+    # Both exist in 2022, the code started after the census decides
+    assert _resolve([old, new], '01004') == 'Q1002'
+    # Dissolved before the geography of the census
+    old = commune('Q1001', [('01004', '1943-01-01', None)], dissolved='2021-01-01')
+    assert _resolve([old, new], '01004') == 'Q1002'
+
+
+def test_split_keeps_the_code_on_the_commune_still_using_it():
+    old = commune('Q1001', [('01004', None, '2021-01-01')], types=[(None, '2021-01-01')])
+    kept = commune('Q1002', [('01004', '2021-01-01', None)])
+    other = commune('Q1003', [('01450', '2021-01-01', None)])
+
+    assert _resolve([old, kept, other], '01004') == 'Q1002'
+
+
+def test_renamed_code_follows_the_item():
+    renamed = commune('Q1001', [('01004', None, '2021-01-01'), ('01999', '2021-01-01', None)])
+    reused = commune('Q1002', [('01004', '2021-01-01', None)])
+
+    assert _resolve([renamed, reused], '01999') == 'Q1001'
+    assert _resolve([renamed, reused], '01004') == 'Q1002'
+
+
+def test_two_current_items_without_dates_are_ambiguous():
+    first = commune('Q1001', [('01004', None, None)])
+    second = commune('Q1002', [('01004', None, None)])
+
+    assert _resolve([first, second], '01004') is None
@@ -0,0 +1,27 @@
+from population import journal
+from population.journal import Journal
+
+
+def test_resume_after_a_cut_line(tmp_path):
+    path = tmp_path / 'regions.tsv'
+    path.write_text('11\twritten\tQ13917\n24\tnot_required\t\n2A0', encoding='utf-8')
+
+    level_journal = Journal(str(path))
+    level_journal.record('27', journal.WRITTEN, 'Q18578267')
+    level_journal.close()
+
+    assert path.read_text(encoding='utf-8') == '11\twritten\tQ13917\n24\tnot_required\t\n27\twritten\tQ18578267\n'
+    level_journal = Journal(str(path))
+    level_journal.close()
+    assert level_journal.outcomes == {'11': 'written', '24': 'not_required', '27': 'written'}
+
+
+def test_fragment_closed_by_an_older_run_is_skipped(tmp_path):
+    path = tmp_path / 'regions.tsv'
+    path.write_text('11\twritten\tQ13917\n2A0\n24\twritten\tQ13947\n', encoding='utf-8')
+
+    level_journal = Journal(str(path))
+    level_journal.close()
+
+    assert level_journal.outcomes == {'11': 'written', '24': 'written'}
+    assert '2A0' not in level_journal
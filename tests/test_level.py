@@ -0,0 +1,68 @@
+import pytest
+from wikibaseintegrator import wbi_helpers
+
+import config
+import regions
+from population.journal import Journal, journal_path
+from population.pipeline import run_level
+
+WRITTEN = {'24': 'Q13947', '27': 'Q18578267', '53': 'Q16961'}
+
+
+def _outcomes():
+    level_journal = Journal(journal_path(config.year, 'regions'))
+    level_journal.close()
+    return level_journal.outcomes
+
+
+def _preferred_amounts(fake, id_item):
+    return [statement['mainsnak']['datavalue']['value']['amount'] for statement in fake.entities[id_item]['claims']['P1082'] if statement['rank'] == 'preferred']
+
+
+def _assert_written(fake):
+    assert _outcomes() == {'11': 'not_required', '24': 'written', '27': 'written', '53': 'written', '94': 'unresolved'}
+    assert _preferred_amounts(fake, 'Q13947') == ['+2573180']
+    assert _preferred_amounts(fake, 'Q18578267') == ['+2805580']
+    assert _preferred_amounts(fake, 'Q16961') == ['+3354854']
+    # Up to date, not touched
+    assert _preferred_amounts(fake, 'Q13917') == ['+12000000']
+
+
+def test_clean_run(fake):
+    summary = run_level(regions.level, source='sparql')
+
+    _assert_written(fake)
+    assert fake.stats['edits'] == 3
+    assert summary['counters']['rows'] == {'outcome=not_required': 1, 'outcome=unresolved': 1, 'outcome=written': 3}
+
+    # The ledger knows the input, the second run does nothing
+    assert run_level(regions.level, source='sparql') is None
+    assert fake.stats['edits'] == 3
+
+
+def test_conflicts_are_replayed(fake, monkeypatch):
+    monkeypatch.setattr(config, 'write_workers', 1, raising=False)
+    monkeypatch.setattr(config, 'conflict_retries', 10, raising=False)
+    fake.conflict_rate = 0.5
+
+    summary = run_level(regions.level, source='sparql')
+
+    _assert_written(fake)
+    assert fake.stats['injected_conflict'] > 0
+    assert summary['counters']['edit_conflicts'] == fake.stats['injected_conflict']
+
+
+@pytest.mark.parametrize('error', ['maxlag', 'ratelimited'])
+def test_throttled_writes_back_off_and_succeed(fake, monkeypatch, error):
+    monkeypatch.setattr(config, 'write_workers', 1, raising=False)
+    monkeypatch.setattr(config, 'throttle_pause', 0.01, raising=False)
+    # WikibaseIntegrator waits at least 5 seconds on maxlag before giving the hand back
+    monkeypatch.setattr(wbi_helpers, 'sleep', lambda seconds: None)
+    setattr(fake, 'maxlag_rate' if error == 'maxlag' else 'ratelimit_rate', 0.25)
+
+    summary = run_level(regions.level, source='sparql')
+
+    _assert_written(fake)
+    assert fake.stats[error] > 0
+    assert summary['counters']['write_retries'] > 0
+    assert sum(count for label, count in summary['counters']['api_errors'].items()) == summary['counters']['write_retries']
@@ -0,0 +1,23 @@
+import json
+
+from population.logs import event, log_path, setup_logging, stop_logging
+
+
+def _events(name):
+    with open(log_path(name), encoding='utf-8') as log_file:
+        return [json.loads(line).get('event') for line in log_file]
+
+
+def test_each_level_of_a_process_logs_to_its_file(workdir):
+    stop_logging()
+    try:
+        setup_logging('regions')
+        event('written', code='24')
+        # Next level run by the same worker of population.runner
+        setup_logging('departements')
+        event('unresolved', code='2A')
+    finally:
+        stop_logging()
+
+    assert _events('regions') == ['written']
+    assert _events('departements') == ['unresolved']
@@ -0,0 +1,13 @@
+import pytest
+
+import config
+from population.pipeline import backfill_years
+
+
+def test_backfill_years_need_a_stated_in(monkeypatch):
+    monkeypatch.setattr(config, 'stated_in_by_year', {'2019': 'Q80000'}, raising=False)
+
+    assert backfill_years() == ['2019']
+    assert backfill_years(['2019', '2020']) == ['2019', '2020']
+    with pytest.raises(SystemExit, match='2018'):
+        backfill_years(['2018', '2019'])
@@ -0,0 +1,16 @@
+from population import schemas
+from population.runner import aggregate, preload_inputs
+
+
+def test_a_missing_input_fails_its_level_only(workdir):
+    inputs, failed = preload_inputs(['regions', 'departements'])
+
+    assert list(failed) == ['departements']
+    assert 'FileNotFoundError' in failed['departements']['error']
+    # The records of regions are ready for the workers
+    schemas._inputs.clear()
+    schemas.use_inputs(inputs)
+    assert [record.code for record in schemas.read_records(schemas.get_schema('regions'))] == ['11', '24', '27', '53', '94']
+
+    report = aggregate(failed, 'run', 1.0)
+    assert 'error' in report['levels']['departements']
@@ -0,0 +1,47 @@
+import time
+
+from wikibaseintegrator.wbi_exceptions import MWApiError
+
+import config
+from population.metrics import metrics
+from population.scheduler import WriteScheduler
+
+
+def test_unexpected_write_error_reaches_the_callback():
+    outcomes = {}
+
+    def write(**kwargs):
+        raise KeyError('claims')
+
+    scheduler = WriteScheduler(max_in_flight=2, edits_per_minute=6000)
+    scheduler.submit('Q1', write, lambda result, error: outcomes.update(Q1=(result, error)))
+    scheduler.submit('Q2', lambda **kwargs: 'saved', lambda result, error: outcomes.update(Q2=(result, error)))
+    scheduler.close()
+
+    assert outcomes['Q1'][0] is None
+    assert isinstance(outcomes['Q1'][1], KeyError)
+    assert outcomes['Q2'] == ('saved', None)
+    assert (scheduler.edits, scheduler.failed) == (1, 1)
+
+
+def test_retry_after_is_the_least_pause(monkeypatch):
+    monkeypatch.setattr(config, 'throttle_pause', 0.01, raising=False)
+    scheduler = WriteScheduler(max_in_flight=1, edits_per_minute=6000)
+
+    scheduler._slow_down(1, MWApiError({'error': {'code': 'ratelimited', 'info': 'Slow down'}}), retry_after=30)
+    scheduler.close()
+
+    assert scheduler.paused_until - time.monotonic() > 29
+    assert scheduler.bucket.rate == scheduler.max_rate / 2
+
+
+def test_edit_rate_is_published():
+    metrics.reset()
+    scheduler = WriteScheduler(max_in_flight=2, edits_per_minute=6000)
+    for id_item in ('Q1', 'Q2', 'Q3'):
+        scheduler.submit(id_item, lambda **kwargs: 'saved', lambda result, error: None)
+    scheduler.close()
+
+    summary = metrics.summary()
+    assert summary['counters']['edits'] == 3
+    assert summary['gauges']['edits_per_minute'] > 0
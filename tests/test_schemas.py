@@ -0,0 +1,51 @@
+import os
+import zipfile
+
+import pytest
+
+import config
+from population.schemas import get_schema, parse_rows, read_records
+
+
+def _archive():
+    """INSEE archive of the year with the regions CSV only."""
+    path = os.path.join('annees', config.year, 'ensemble.zip')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.write(os.path.join('annees', config.year, 'donnees_regions.csv'), 'donnees_regions.csv')
+    os.remove(os.path.join('annees', config.year, 'donnees_regions.csv'))
+    return path
+
+
+def test_archive_read_for_the_requested_level_only(workdir):
+    _archive()
+
+    records = read_records(get_schema('regions'))
+
+    assert [record.code for record in records] == ['11', '24', '27', '53', '94']
+    with pytest.raises(ValueError, match='donnees_departements.csv'):
+        read_records(get_schema('departements'))
+
+
+def test_codes_saved_as_numbers_are_rebuilt():
+    rows = [['DEP', 'COM', 'Commune', 'PMUN'], ['1', '1004', 'Ambérieu-en-Bugey', '14514'], ['2A', '20004', 'Afa', '3199'], ['2b', '20033', 'Bastia', '48503'],
+            ['971', '97101', 'Les Abymes', '53491']]
+
+    records = list(parse_rows(get_schema('communes'), rows))
+
+    assert [(record.code, record.department) for record in records] == [('01004', '01'), ('2A004', '2A'), ('2B033', '2B'), ('97101', '971')]
+
+
+def test_code_outside_its_departement_is_rejected():
+    rows = [['DEP', 'COM', 'Commune', 'PMUN'], ['22', '35238', 'Rennes', '222485']]
+
+    with pytest.raises(ValueError, match='35238 is not in its département 22'):
+        list(parse_rows(get_schema('communes'), rows))
+
+
+def test_local_codes_of_a_workbook_are_padded():
+    rows = [['Code département', 'Code commune', 'Nom de la commune', 'Population municipale'], ['1', '4', 'Ambérieu-en-Bugey', '14514'], ['2A', '4', 'Afa', '3199'],
+            ['971', '101', 'Les Abymes', '53491']]
+
+    records = list(parse_rows(get_schema('communes'), rows, positional=False))
+
+    assert [record.code for record in records] == ['01004', '2A004', '97101']
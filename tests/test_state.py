@@ -0,0 +1,57 @@
+from population.state import ClaimStore, PopulationState, population_fingerprint
+
+BACKFILL = ('+2015-01-01T00:00:00Z', 'Q80000')
+
+
+def _state(claims):
+    """State of one region, 24 -> Q13947, having the population claims given as fingerprints."""
+    state = PopulationState()
+    state.index.add_candidate('Q13947', [('24', None, None)], [(None, None)], [])
+    state.claims.add('Q13947', claims)
+    return state
+
+
+def test_no_write_when_the_preferred_claim_exists():
+    state = _state([population_fingerprint(2573180), population_fingerprint(2500000, *BACKFILL, preferred=False)])
+
+    assert state.lookup('24', 2573180) == (['Q13947'], False)
+    assert not state.write_required(['Q13947'], 2500000, *BACKFILL, preferred=False)
+
+
+def test_write_when_any_part_of_the_claim_differs():
+    amount, point_in_time, method, stated_in, rank = population_fingerprint(2573180)
+    state = _state([('+2573181', point_in_time, method, stated_in, rank), (amount, '+2019-01-01T00:00:00Z', method, stated_in, rank),
+                    (amount, point_in_time, None, stated_in, rank), (amount, point_in_time, method, 'Q80000', rank), (amount, point_in_time, method, stated_in, 'normal')])
+
+    assert state.write_required(['Q13947'], 2573180)
+
+
+def test_claim_of_another_item_does_not_count():
+    state = _state([population_fingerprint(2573180)])
+
+    assert state.write_required(['Q16961'], 2573180)
+    assert not state.write_required(['Q16961', 'Q13947'], 2573180)
+
+
+def test_backfill_claims_are_looked_up_with_their_rank():
+    state = _state([population_fingerprint(2500000, *BACKFILL, preferred=True)])
+
+    # A past census written as preferred is not the normal rank claim a backfill writes
+    assert state.write_required(['Q13947'], 2500000, *BACKFILL, preferred=False)
+    assert not state.write_required(['Q13947'], 2500000, *BACKFILL, preferred=True)
+
+
+def test_unknown_code_has_nothing_to_write():
+    assert _state([]).lookup('94', 340440) == ([], False)
+
+
+def test_claim_store_merge_keeps_both_shards():
+    first, second = ClaimStore(), ClaimStore()
+    first.add('Q1', [population_fingerprint(10)])
+    second.add('Q2', [population_fingerprint(20)])
+
+    first.merge(second)
+
+    assert (first.items, len(first)) == (2, 2)
+    assert first.has('Q1', population_fingerprint(10)) and first.has('Q2', population_fingerprint(20))
+    assert not first.has('Q1', population_fingerprint(20))
@@ -0,0 +1,27 @@
+import pytest
+from wikibaseintegrator import wbi_helpers
+from wikibaseintegrator.wbi_exceptions import MaxRetriesReachedException
+
+from population import transport
+from population.metrics import metrics
+from population.wikidata import get_entities, get_wbi
+
+
+def test_anonymous_reads_go_through_the_transport(fake):
+    metrics.reset()
+
+    get_entities(get_wbi(), ['Q13917'])
+
+    assert metrics.counters[('http_requests', (('endpoint', 'api'), ('status', 200)))] == 1
+    assert metrics.histograms['http_api'].count == 1
+
+
+def test_retry_after_of_a_maxlag_answer(fake, monkeypatch):
+    fake.maxlag_rate = 1
+    # WikibaseIntegrator waits at least 5 seconds on maxlag before giving the hand back
+    monkeypatch.setattr(wbi_helpers, 'sleep', lambda seconds: None)
+
+    with pytest.raises(MaxRetriesReachedException):
+        wbi_helpers.mediawiki_api_call_helper(data={'action': 'wbgetentities', 'ids': 'Q13917', 'format': 'json'}, allow_anonymous=True, max_retries=1)
+
+    assert transport.retry_after() == 1
@@ -0,0 +1,16 @@
+from population.insee_index import _date
+from population.validity import PRECISION_MONTH, PRECISION_YEAR, wikibase_date
+
+
+def test_wikibase_date():
+    assert wikibase_date('+2020-03-17T00:00:00Z') == '2020-03-17'
+    assert wikibase_date('+2020-03-17T00:00:00Z', PRECISION_MONTH) == '2020-03-01'
+    assert wikibase_date('+2020-00-00T00:00:00Z', PRECISION_YEAR) == '2020-01-01'
+    assert wikibase_date('2015-01-01T00:00:00Z') == '2015-01-01'
+    assert wikibase_date('-0500-00-00T00:00:00Z') == '0000-01-01'
+
+
+def test_unknown_value_is_no_date():
+    assert wikibase_date(None) is None
+    assert wikibase_date('http://www.wikidata.org/.well-known/genid/0a1b2c3d4e5f') is None
+    assert _date({'end': {'type': 'uri', 'value': 'http://www.wikidata.org/.well-known/genid/0a1b2c3d4e5f'}}, 'end') is None
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+from wikibaseintegrator.wbi_enums import WikibaseRank
+from wikibaseintegrator.wbi_login import LoginError
+
+import config
+import regions
+from population import wikidata
+from population.pipeline import run_level
+from population.wikidata import get_entities, get_wbi, prepare_backfill, session_path, write_population
+
+
+def test_write_population_returns_the_saved_item(fake):
+    wbi = get_wbi()
+    item = get_entities(wbi, ['Q13947'])['Q13947']
+    lastrevid = item.lastrevid
+
+    saved = write_population(item, 2573180)
+
+    assert saved.id == 'Q13947'
+    assert saved.lastrevid > lastrevid
+    claims = saved.claims.get('P1082')
+    assert [claim.rank for claim in claims] == [WikibaseRank.NORMAL, WikibaseRank.PREFERRED]
+    assert claims[1].mainsnak.datavalue['value']['amount'] == '+2573180'
+    assert claims[1].qualifiers.get('P585')[0].datavalue['value']['time'] == config.point_in_time
+    assert fake.stats['edits'] == 1
+
+
+def test_no_login_before_the_first_write(fake):
+    wbi = get_wbi()
+    get_entities(wbi, ['Q13947'])
+
+    assert not wbi.login.logged_in
+    assert fake.stats['login'] == 0
+
+
+def test_expired_session_logs_in_again(fake, monkeypatch):
+    write_population(get_entities(get_wbi(), ['Q13947'])['Q13947'], 2573180)
+    assert os.path.exists(session_path())
+    # The next run finds the saved session expired
+    fake.sessions.clear()
+    monkeypatch.setattr(wikidata, '_wbi', None)
+
+    saved = write_population(get_entities(get_wbi(), ['Q16961'])['Q16961'], 3354854)
+
+    assert saved.lastrevid
+    assert fake.stats['login'] == 2
+    assert fake.stats['edits'] == 2
+
+
+def test_failed_login_stops_the_level(fake):
+    fake.password = 'another'
+
+    with pytest.raises(LoginError):
+        run_level(regions.level, source='sparql')
+
+    assert fake.stats['login'] == 1
+    assert fake.stats['edits'] == 0
+
+
+def _p1082(item):
+    return sorted((claim.qualifiers.get('P585')[0].datavalue['value']['time'], claim.mainsnak.datavalue['value']['amount'], claim.rank.value,
+                   claim.references.references[0].snaks.get('P248')[0].datavalue['value']['id']) for claim in item.claims.get('P1082'))
+
+
+def test_backfill_prefers_only_the_latest_census(fake, monkeypatch):
+    monkeypatch.setattr(config, 'stated_in_by_year', {'2015': 'Q80000'}, raising=False)
+    # Q13947 has the preferred claim of 2015, stated in Q80000
+    item = get_entities(get_wbi(), ['Q13947'])['Q13947']
+
+    prepare_backfill(item, {'2015': 2550000, '2020': 2573180})
+
+    # The 2015 claim is the one already there, not a copy
+    assert _p1082(item) == [('+2015-01-01T00:00:00Z', '+2550000', 'normal', 'Q80000'), ('+2020-01-01T00:00:00Z', '+2573180', 'preferred', 'Q90000')]
+
+
+def test_backfill_keeps_a_later_preferred_claim(fake, monkeypatch):
+    monkeypatch.setattr(config, 'stated_in_by_year', {'2015': 'Q80000', '2019': 'Q80001'}, raising=False)
+    # Q13917 has the preferred claim of 2020
+    item = get_entities(get_wbi(), ['Q13917'])['Q13917']
+
+    prepare_backfill(item, {'2015': 11900000, '2019': 11950000})
+
+    assert _p1082(item) == [('+2015-01-01T00:00:00Z', '+11900000', 'normal', 'Q80000'), ('+2019-01-01T00:00:00Z', '+11950000', 'normal', 'Q80001'),
+                            ('+2020-01-01T00:00:00Z', '+12000000', 'preferred', 'Q90000')]
+
+
+def test_backfill_demotes_a_preferred_claim_without_a_known_date(fake, monkeypatch):
+    claim = fake.entities['Q13917']['claims']['P1082'][0]
+    claim['qualifiers']['P585'] = [{'snaktype': 'somevalue', 'property': 'P585', 'hash': 'unknown', 'datatype': 'time'}]
+    item = get_entities(get_wbi(), ['Q13917'])['Q13917']
+
+    prepare_backfill(item, {'2020': 12000000})
+
+    ranks = {claim.qualifiers.get('P585')[0].snaktype.value: claim.rank.value for claim in item.claims.get('P1082')}
+    assert ranks == {'somevalue': 'normal', 'value': 'preferred'}